@@ -0,0 +1,148 @@
+"""Бенчмарк режима «Аудио»: прежний формат "bestaudio/best" без обработки против
+нового (аудио, которое копируется в AUDIO_FORMAT, видео поменьше, извлечение звука).
+
+Генерирует клипы ffmpeg, раздаёт их локальным HTTP-сервером и описывает
+метаданными в стиле площадок (--load-info-json), чтобы выбор формата yt-dlp
+работал как на настоящей ссылке:
+  muxed    — только видео со звуком в 1080p/720p/360p (TikTok, Instagram);
+  separate — отдельные видео, opus/webm и aac/m4a (YouTube).
+Считает байты, отданные источником, время (скачивание + обработка) и что
+в итоге уходит в send_audio.
+
+    python benchmarks/bench_audio.py [--runs 3] [--duration 60]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+from common import CountingHandler, import_bot, make_clip, report, serve
+
+# (файл, аргументы ffmpeg, поля формата для метаданных)
+FIXTURES = (
+    ("muxed_1080.mp4", ["-s", "1920x1080", "-c:v", "libx264", "-c:a", "aac", "-b:a", "128k"],
+     {"height": 1080, "width": 1920, "vcodec": "avc1.640028", "acodec": "mp4a.40.2"}),
+    ("muxed_720.mp4", ["-s", "1280x720", "-c:v", "libx264", "-c:a", "aac", "-b:a", "128k"],
+     {"height": 720, "width": 1280, "vcodec": "avc1.64001f", "acodec": "mp4a.40.2"}),
+    ("muxed_360.mp4", ["-s", "640x360", "-c:v", "libx264", "-c:a", "aac", "-b:a", "128k"],
+     {"height": 360, "width": 640, "vcodec": "avc1.42001e", "acodec": "mp4a.40.2"}),
+    ("video_1080.mp4", ["-s", "1920x1080", "-c:v", "libx264", "-an"],
+     {"height": 1080, "width": 1920, "vcodec": "avc1.640028", "acodec": "none"}),
+    ("audio_opus.webm", ["-vn", "-c:a", "libopus", "-b:a", "160k"],
+     {"vcodec": "none", "acodec": "opus", "abr": 160}),
+    ("audio_aac.m4a", ["-vn", "-c:a", "aac", "-b:a", "128k"],
+     {"vcodec": "none", "acodec": "mp4a.40.2", "abr": 128}),
+)
+
+SCENARIOS = {
+    "muxed": ("muxed_1080.mp4", "muxed_720.mp4", "muxed_360.mp4"),
+    "separate": ("video_1080.mp4", "audio_opus.webm", "audio_aac.m4a", "muxed_360.mp4"),
+}
+
+
+def make_fixtures(directory, duration):
+    for name, args, _ in FIXTURES:
+        make_clip(
+            os.path.join(directory, name), duration, size="1920x1080",
+            args=("-preset", "ultrafast", "-crf", "28", *args), noise=True
+        )
+
+
+def write_info(directory, base_url, scenario, duration):
+    """Метаданные в формате yt-dlp с форматами сценария"""
+    fields = {name: extra for name, _, extra in FIXTURES}
+    formats = []
+    for name in SCENARIOS[scenario]:
+        path = os.path.join(directory, name)
+        formats.append({
+            "format_id": os.path.splitext(name)[0], "url": f"{base_url}/{name}",
+            "ext": os.path.splitext(name)[1].lstrip("."), "protocol": "http",
+            "filesize": os.path.getsize(path),
+            "tbr": os.path.getsize(path) * 8 / 1000 / duration, **fields[name],
+        })
+    info = {
+        "id": scenario, "title": scenario, "extractor": "generic", "extractor_key": "Generic",
+        "webpage_url": f"{base_url}/{scenario}", "duration": duration, "formats": formats,
+    }
+    path = os.path.join(directory, f"{scenario}.info.json")
+    with open(path, "w") as f:
+        json.dump(info, f)
+    return path
+
+
+def ytdlp(bot, info_path, fmt, prefix):
+    """Скачивание через CLI как в боте, возвращает (путь, поля медиа)"""
+    subprocess.run(
+        ["yt-dlp", "-q", "--no-progress", "-f", fmt,
+         "--print-to-file", bot.MEDIA_TEMPLATE, f"{prefix}.media.json",
+         "-o", f"{prefix}_%(id)s.%(ext)s", "--load-info-json", info_path],
+        check=True
+    )
+    path = bot.job_files(os.path.basename(prefix))[0]
+    return path, bot.load_media(f"{prefix}.media.json") or {}
+
+
+async def run(bot, info_path, mode, runs):
+    """mode: before — "bestaudio/best" как есть, after — ytdlp_options + extract_audio"""
+    timings, served, sizes, outputs = [], [], [], set()
+    for i in range(runs):
+        job = bot.Job(user_id=0, chat_id=0, message_id=None, url=info_path, quality="audio")
+        prefix = bot.job_prefix(job.job_id)
+        bot.make_job_dir(job.job_id)
+        CountingHandler.sent = 0
+        started = time.perf_counter()
+        if mode == "before":
+            path, media = await asyncio.to_thread(ytdlp, bot, info_path, "bestaudio/best", prefix)
+        else:
+            fmt = bot.ytdlp_options("https://example.com/", "audio")["format"]
+            path, media = await asyncio.to_thread(ytdlp, bot, info_path, fmt, prefix)
+            path, media = await bot.extract_audio(job, path, media)
+        timings.append(time.perf_counter() - started)
+        served.append(CountingHandler.sent)
+        sizes.append(os.path.getsize(path))
+        outputs.add(f"{os.path.splitext(path)[1].lstrip('.')} (v:{media.get('vcodec')}, a:{media.get('acodec')})")
+        await bot.remove_job_files(job.job_id)
+    return timings, served, sizes, outputs
+
+
+def summary(served, sizes, outputs):
+    """Сколько скачано у источника, сколько уходит в send_audio и что именно"""
+    mb = 1024 ** 2
+    return (
+        f"downloaded={statistics.mean(served) / mb:7.1f} MB "
+        f"sent={statistics.mean(sizes) / mb:6.1f} MB  {', '.join(sorted(outputs))}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--duration", type=int, default=60)
+    args = parser.parse_args()
+    if not shutil.which("ffmpeg"):
+        raise SystemExit("Нужен ffmpeg в PATH")
+
+    work_dir = tempfile.mkdtemp(prefix="bench-audio-")
+    media_dir = os.path.join(work_dir, "media")
+    os.makedirs(media_dir)
+    make_fixtures(media_dir, args.duration)
+    base_url = serve(media_dir, CountingHandler)
+    bot = import_bot(work_dir)
+
+    print(f"Клипы: {args.duration}s, AUDIO_FORMAT={bot.AUDIO_FORMAT}, {bot.AUDIO_BITRATE} kbit/s")
+    for scenario in SCENARIOS:
+        info_path = write_info(media_dir, base_url, scenario, args.duration)
+        print(f"\n{scenario}:")
+        for mode in ("before", "after"):
+            timings, served, sizes, outputs = asyncio.run(run(bot, info_path, mode, args.runs))
+            report(mode, timings, summary(served, sizes, outputs))
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Бенчмарк выходов yt-dlp: ротация через прокси, 429 и снятие выхода с платформы.
+
+Поднимает локальный источник с тестовым клипом и два фейковых HTTP-прокси:
+  proxy   — раздаёт файлы источника (как честный прокси);
+  limited — отвечает 429 на долю --ratio запросов, остальное раздаёт.
+Скачивает клип через download() из bot.py (метаданные, выбор выхода, повтор
+через другой выход с паузой retry_delay) при разных наборах PROXIES:
+  direct          — только прямой выход;
+  proxy           — только честный прокси;
+  limited,proxy   — ограниченный прокси первым: сколько стоят 429 и повторы,
+                    пока выход не снят (EGRESS_BENCH_AFTER подряд).
+
+    python benchmarks/bench_egress.py [--runs 10] [--ratio 1.0] [--clip-seconds 2]
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+from common import QuietHandler, import_bot, make_clip, report, serve
+
+SCENARIOS = (("direct",), ("proxy",), ("limited", "proxy"))
+
+
+class OriginHandler(QuietHandler):
+    """Любой /clip/<n>.mp4 — один и тот же файл: у каждой ссылки свой ключ кэша метаданных.
+    Запросы через прокси приходят с абсолютным URL — берётся только путь"""
+    ratio = 0.0  # доля ответов 429
+    requests = 0
+    limited = 0
+
+    def translate_path(self, path):
+        path = urlsplit(path).path
+        return super().translate_path("/clip.mp4" if path.startswith("/clip/") else path)
+
+    def send_head(self):
+        type(self).requests += 1
+        if random.random() < self.ratio:
+            type(self).limited += 1
+            self.send_error(429, "Too Many Requests")
+            return None
+        return super().send_head()
+
+
+class ProxyHandler(OriginHandler):
+    pass
+
+
+class LimitedHandler(OriginHandler):
+    pass
+
+
+async def run(bot, origin, specs, runs):
+    """runs скачиваний с набором выходов specs. Возвращает времена и
+    (успехов, 429/403, снят ли) по выходам в порядке specs"""
+    bot.egress_pool = [bot.make_egress(number, spec) for number, spec in enumerate(specs, 1)]
+    bot.platform_buckets.clear()
+    timings = []
+    for i in range(runs):
+        job = bot.Job(user_id=0, chat_id=0, message_id=None, url=f"{origin}/clip/{i}.mp4", quality="best")
+        started = time.perf_counter()
+        try:
+            await bot.download(job, allow_stream=False)
+            timings.append(time.perf_counter() - started)
+        except bot.DownloadFailed as e:
+            print(f"  ❌ {job.url}: {e.kind}")
+        await bot.disk.release(job.job_id)
+        await bot.remove_job_files(job.job_id)
+    return timings, [(egress.ok, egress.failed, bool(egress.benched)) for egress in bot.egress_pool]
+
+
+async def bench(bot, origin, proxies, runs):
+    for scenario in SCENARIOS:
+        for handler in (ProxyHandler, LimitedHandler):
+            handler.requests = handler.limited = 0
+        timings, egresses = await run(bot, origin, [proxies[name] for name in scenario], runs)
+        report(",".join(scenario), timings,
+               f"429 от limited: {LimitedHandler.limited} из {LimitedHandler.requests}")
+        for name, (ok, failed, benched) in zip(scenario, egresses):
+            print(f"  {'':<22}   {name:<8} ok={ok:<3} 429/403={failed}" + (" — снят" if benched else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--ratio", type=float, default=1.0, help="доля ответов 429 у limited")
+    parser.add_argument("--clip-seconds", type=int, default=2)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench-egress-")
+    media_dir = os.path.join(work_dir, "media")
+    os.makedirs(media_dir)
+    clip = make_clip(os.path.join(media_dir, "clip.mp4"), args.clip_seconds)
+    origin = serve(media_dir, OriginHandler)
+    LimitedHandler.ratio = args.ratio
+    random.seed(0)  # одинаковая последовательность 429 от запуска к запуску
+    proxies = {"direct": "direct", "proxy": serve(media_dir, ProxyHandler),
+               "limited": serve(media_dir, LimitedHandler)}
+    bot = import_bot(work_dir)
+
+    print(
+        f"Клип: {os.path.getsize(clip) / 1024 ** 2:.1f} MB, скачиваний {args.runs}, "
+        f"429 у limited: {args.ratio:.0%}, EGRESS_RETRIES={bot.EGRESS_RETRIES}, "
+        f"снятие после {bot.EGRESS_BENCH_AFTER} подряд"
+    )
+    asyncio.run(bench(bot, origin, proxies, args.runs))
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Бенчмарк движков yt-dlp: холодный CLI (процесс на скачивание) против прогретого пула.
+
+Поднимает локальный HTTP-сервер с тестовым клипом и скачивает его N раз
+каждым движком через generic-экстрактор.
+
+    python benchmarks/bench_engine.py [--runs 10] [--workers 2]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from common import import_bot, make_clip, report, serve
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench-engine-")
+    media_dir = os.path.join(work_dir, "media")
+    os.makedirs(media_dir)
+    make_clip(os.path.join(media_dir, "clip.mp4"), 5)
+    url = f"{serve(media_dir)}/clip.mp4"
+    bot = import_bot(work_dir, ENGINE_WORKERS=str(args.workers))
+
+    options = bot.ytdlp_options(url, "audio")  # "bestaudio/best" — без слияния
+    template = os.path.join(work_dir, "out", "%(id)s.%(ext)s")
+
+    # Холодный CLI: каждый запуск — новый интерпретатор и импорт экстракторов
+    cli = []
+    for i in range(args.runs):
+        started = time.perf_counter()
+        subprocess.run(
+            ["yt-dlp", "-q", "--force-overwrites", *bot.ytdlp_args(options), "-o", template, url],
+            check=True
+        )
+        cli.append(time.perf_counter() - started)
+
+    # Прогретый пул: интерпретатор и экстракторы уже загружены
+    started = time.perf_counter()
+    bot.start_engine()
+    warmup = time.perf_counter() - started
+    pool = []
+    for i in range(args.runs):
+        started = time.perf_counter()
+        result = bot.engine_pool.submit(
+            bot.engine_download, f"bench{i}", url,
+            {**options, "outtmpl": template, "overwrites": True}
+        ).result()
+        if result["returncode"] != 0:
+            raise SystemExit(f"Ошибка пула: {result['error']}")
+        pool.append(time.perf_counter() - started)
+    bot.engine_pool.shutdown()
+
+    print(f"Фикстура: {url} ({os.path.getsize(os.path.join(media_dir, 'clip.mp4')) // 1024} KB)")
+    report("cli (cold)", cli)
+    report("pool (warm)", pool)
+    print(f"Прогрев пула ({args.workers} процессов): {warmup:.3f}s")
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
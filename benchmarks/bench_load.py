@@ -0,0 +1,393 @@
+"""Нагрузочный бенчмарк: бот целиком против фейкового Telegram и фейкового источника.
+
+Поднимает фейковый Bot API (getUpdates / sendMessage / editMessageText /
+sendVideo / ...), локальный HTTP-источник с тестовым клипом (его скачивает
+generic-экстрактор yt-dlp) и запускает bot.py отдельным процессом. N
+пользователей одновременно присылают ссылку и нажимают кнопку quality_ —
+как в Telegram, через апдейты long polling.
+
+Итог: задания в секунду, перцентили задержек по стадиям (по JSON-логу бота
+и по ответам Bot API), пиковые RSS и место на диске, число подпроцессов.
+RSS и подпроцессы считаются по /proc (Linux).
+
+    python benchmarks/bench_load.py [--users 20] [--rounds 2] [--quality best]
+                                    [--same-link] [--local-api] [--clip-seconds 10]
+
+Настройки бота (JOB_WORKERS, DOWNLOAD_SLOTS, YTDLP_ENGINE, ...) берутся из окружения.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+from common import REPO_DIR, QuietHandler, make_clip, report, serve
+
+TOKEN = "123456:benchmark"
+
+# bot.py принимает только ссылки известных платформ — источник регистрируется
+# как платформа с профилем по умолчанию, остальное — обычный запуск
+BOOTSTRAP = (
+    "import sys; sys.path.insert(0, {repo!r}); import bot; "
+    "profile = bot.Platform('bench', ('127.0.0.1',)); bot.PLATFORMS[profile.name] = profile; "
+    "bot.PLATFORM_HOSTS['127.0.0.1'] = [profile]; bot.PLATFORM_IDS[profile.name] = []; bot.main()"
+)
+
+# Стадии задания по событиям лога бота: (название, событие начала, событие конца)
+LOG_STAGES = (
+    ("queue", "job_created", "download_start"),
+    ("download", "download_start", "downloaded"),
+    ("deliver", "downloaded", "job_finished"),
+)
+
+
+class OriginHandler(QuietHandler):
+    """Любой /clip/<n>.mp4 — один и тот же файл: у каждой ссылки свой ключ кэша"""
+
+    def translate_path(self, path):
+        return super().translate_path("/clip.mp4" if path.startswith("/clip/") else path)
+
+
+class FakeBotAPI:
+    """Минимальный Bot API: отдаёт апдейты driver'а и записывает ответы бота"""
+
+    def __init__(self):
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1000)
+        self.new_update = asyncio.Event()
+        self.waiters = {}  # {chat_id: asyncio.Queue} — ответы бота в чат
+        self.calls = {}  # {method: число вызовов}
+        self.uploaded = 0  # байт получено в sendVideo/sendAudio/...
+
+    def push(self, update):
+        self.updates.append({"update_id": next(self.update_ids), **update})
+        self.new_update.set()
+
+    def inbox(self, chat_id):
+        return self.waiters.setdefault(chat_id, asyncio.Queue())
+
+    def message(self, chat_id, **fields):
+        return {
+            "message_id": next(self.message_ids), "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, **fields,
+        }
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), float(params.get("timeout") or 0) or 0.1)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+    async def read_file(self, field):
+        """Размер отправленного файла: multipart или file:// (локальный Bot API)"""
+        if isinstance(field, str):
+            path = field[len("file://"):] if field.startswith("file://") else None
+            return os.path.getsize(path) if path and os.path.exists(path) else 0
+        size = 0
+        while True:
+            chunk = field.file.read(1024 * 1024)
+            if not chunk:
+                return size
+            size += len(chunk)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        chat_id = int(params.get("chat_id") or 0)
+        result = True
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        elif method == "getUpdates":
+            result = await self.get_updates(params)
+        elif method in ("sendMessage", "editMessageText", "editMessageCaption"):
+            markup = json.loads(params.get("reply_markup") or "null")
+            result = self.message(chat_id, text=params.get("text", ""), reply_markup=markup)
+            if method != "sendMessage":
+                result["message_id"] = int(params.get("message_id") or 0)
+            self.inbox(chat_id).put_nowait((method, result))
+        elif method in ("sendVideo", "sendAudio", "sendDocument"):
+            kind = method[len("send"):].lower()
+            size = await self.read_file(params.get(kind))
+            self.uploaded += size
+            media = {"file_id": f"{kind}{next(self.message_ids)}", "file_unique_id": "u", "file_size": size}
+            if kind != "document":
+                media["duration"] = 0
+            if kind == "video":
+                media.update(width=0, height=0)
+            result = self.message(chat_id, **{kind: media})
+            self.inbox(chat_id).put_nowait((method, result))
+        elif method == "sendMediaGroup":
+            media = json.loads(params.get("media") or "[]")
+            result = []
+            for item in media:
+                size = await self.read_file(params.get(item["media"][len("attach://"):], item["media"]))
+                self.uploaded += size
+                result.append(self.message(chat_id, **{item["type"]: {
+                    "file_id": f"{item['type']}{next(self.message_ids)}", "file_unique_id": "u",
+                    "duration": 0, "width": 0, "height": 0, "file_size": size,
+                }}))
+            self.inbox(chat_id).put_nowait((method, result))
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self):
+        app = web.Application(client_max_size=4 * 1024 ** 3)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return runner, f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+
+class Sampler:
+    """Пиковые RSS, место на диске и подпроцессы бота (раз в 100 ms, /proc)"""
+
+    def __init__(self, pid, download_dir):
+        self.pid = pid
+        self.download_dir = download_dir
+        self.rss_bot = self.rss_total = self.disk = self.children = 0
+        self.spawned = set()
+
+    def descendants(self):
+        parents = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    pass
+        found, frontier = [], [self.pid]
+        while frontier:
+            pid = frontier.pop()
+            children = [child for child, parent in parents.items() if parent == pid]
+            found += children
+            frontier += children
+        return found
+
+    @staticmethod
+    def rss(pid):
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    def disk_usage(self):
+        total = 0
+        for root, _, files in os.walk(self.download_dir):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def sample(self):
+        children = self.descendants()
+        self.spawned.update(children)
+        bot_rss = self.rss(self.pid)
+        self.rss_bot = max(self.rss_bot, bot_rss)
+        self.rss_total = max(self.rss_total, bot_rss + sum(self.rss(pid) for pid in children))
+        self.children = max(self.children, len(children))
+        self.disk = max(self.disk, self.disk_usage())
+
+    async def run(self):
+        while True:
+            await asyncio.to_thread(self.sample)
+            await asyncio.sleep(0.1)
+
+
+async def wait_reply(inbox, predicate, timeout):
+    """Ждёт ответ бота в чат, для которого predicate вернёт не None"""
+    deadline = time.monotonic() + timeout
+    while True:
+        method, result = await asyncio.wait_for(inbox.get(), max(0.01, deadline - time.monotonic()))
+        value = predicate(method, result)
+        if value is not None:
+            return value
+
+
+def keyboard_button(quality):
+    """Кнопка quality_<quality> (или первая quality_, если такой нет) в клавиатуре ответа"""
+    def predicate(method, result):
+        if not isinstance(result, dict):
+            return None
+        buttons = [
+            button["callback_data"]
+            for row in (result.get("reply_markup") or {}).get("inline_keyboard", [])
+            for button in row if button.get("callback_data", "").startswith("quality_")
+        ]
+        if not buttons:
+            return None
+        data = f"quality_{quality}" if f"quality_{quality}" in buttons else buttons[0]
+        return result, data
+    return predicate
+
+
+def delivered(method, result):
+    if method in ("sendVideo", "sendAudio", "sendDocument", "sendMediaGroup"):
+        return "ok"
+    text = result.get("text", "") if isinstance(result, dict) else ""
+    if text.startswith("❌") or "Не удалось" in text or "Ошибка" in text:
+        return "failed"
+    return None
+
+
+async def user_session(api, user_id, links, quality, timeout, timings):
+    """Один пользователь: ссылка → клавиатура → кнопка → файл, links раз подряд"""
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    inbox = api.inbox(user_id)
+    for url in links:
+        started = time.perf_counter()
+        api.push({"message": {
+            "message_id": next(api.message_ids), "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "from": user, "text": url,
+        }})
+        try:
+            message, data = await wait_reply(inbox, keyboard_button(quality), timeout)
+            pressed = time.perf_counter()
+            timings["keyboard"].append(pressed - started)
+            api.push({"callback_query": {
+                "id": str(next(api.update_ids)), "from": user, "message": message,
+                "chat_instance": str(user_id), "data": data,
+            }})
+            outcome = await wait_reply(inbox, delivered, timeout)
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+        timings[outcome].append(time.perf_counter() - started)
+        if outcome == "ok":
+            timings["press_to_file"].append(time.perf_counter() - pressed)
+
+
+async def read_log(stream, events):
+    """JSON-события лога бота: {job_id: {event: ts}}"""
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+        if line.startswith(b"{"):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("job_id"):
+                events.setdefault(record["job_id"], {}).setdefault(record["event"], record["ts"])
+
+
+async def run(args, work_dir, origin):
+    api = FakeBotAPI()
+    runner, api_url = await api.start()
+    env = {
+        **os.environ, "BOT_TOKEN": TOKEN, "BOT_API_URL": api_url,
+        "BOT_API_LOCAL": "1" if args.local_api else "0",
+        "DATA_DIR": os.path.join(work_dir, "data"), "METRICS_PORT": "0",
+        "ROLE": "all", "WEBHOOK_URL": "", "PYTHONUNBUFFERED": "1",
+    }
+    env.pop("GDRIVE_JSON", None)
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-c", BOOTSTRAP.format(repo=REPO_DIR),
+        cwd=work_dir, env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+    )
+    events = {}
+    reader = asyncio.create_task(read_log(process.stdout, events))
+    sampler = Sampler(process.pid, os.path.join(work_dir, "downloads"))
+    sampling = asyncio.create_task(sampler.run())
+    while not api.calls.get("getUpdates"):
+        if process.returncode is not None:
+            raise SystemExit("bot.py завершился при запуске")
+        await asyncio.sleep(0.05)
+
+    timings = {key: [] for key in ("keyboard", "press_to_file", "ok", "failed", "timeout")}
+    counter = itertools.count()
+    sessions = []
+    for user in range(args.users):
+        links = [
+            f"{origin}/clip/{0 if args.same_link else next(counter)}.mp4" for _ in range(args.rounds)
+        ]
+        sessions.append(user_session(api, 10_000 + user, links, args.quality, args.timeout, timings))
+    started = time.perf_counter()
+    await asyncio.gather(*sessions)
+    elapsed = time.perf_counter() - started
+
+    process.send_signal(signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), 60)
+    except asyncio.TimeoutError:
+        process.kill()
+    await reader
+    sampling.cancel()
+    await runner.cleanup()
+    return api, timings, events, sampler, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=2, help="ссылок подряд у каждого пользователя")
+    parser.add_argument("--quality", default="best", help="кнопка quality_<...>, например best, audio, 720")
+    parser.add_argument("--same-link", action="store_true", help="у всех одна ссылка (дедупликация и кэш)")
+    parser.add_argument("--local-api", action="store_true", help="отправка file:// как локальному Bot API")
+    parser.add_argument("--clip-seconds", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=600, help="s на одну ссылку")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench-load-")
+    media_dir = os.path.join(work_dir, "media")
+    os.makedirs(media_dir)
+    clip = make_clip(os.path.join(media_dir, "clip.mp4"), args.clip_seconds, size="1280x720")
+    origin = serve(media_dir, OriginHandler)
+
+    api, timings, events, sampler, elapsed = asyncio.run(run(args, work_dir, origin))
+
+    done = timings["ok"]
+    total = args.users * args.rounds
+    print(
+        f"Клип: {os.path.getsize(clip) / 1024 ** 2:.1f} MB, пользователей {args.users} × {args.rounds} ссылок, "
+        f"кнопка quality_{args.quality}{', одна ссылка' if args.same_link else ''}"
+    )
+    print(f"Готово {len(done)} из {total}, ошибок {len(timings['failed'])}, таймаутов {len(timings['timeout'])}")
+    print(f"Пропускная способность: {len(done) / elapsed:.2f} заданий/s за {elapsed:.1f}s")
+    print("\nЗадержки (driver):")
+    report("ссылка → клавиатура", timings["keyboard"])
+    report("кнопка → файл", timings["press_to_file"])
+    report("ссылка → файл", done)
+    print("\nСтадии (лог бота):")
+    for name, start, end in LOG_STAGES:
+        values = [job[end] - job[start] for job in events.values() if start in job and end in job]
+        report(name, values)
+    print("\nРесурсы:")
+    print(f"  пиковый RSS бота       {sampler.rss_bot / 1024 ** 2:.0f} MB")
+    print(f"  пиковый RSS с детьми   {sampler.rss_total / 1024 ** 2:.0f} MB")
+    print(f"  пик места на диске     {sampler.disk / 1024 ** 2:.1f} MB")
+    print(f"  подпроцессов           пик {sampler.children}, всего {len(sampler.spawned)}")
+    print(f"  отправлено в Bot API   {api.uploaded / 1024 ** 2:.1f} MB")
+    print("  вызовы Bot API         " + ", ".join(
+        f"{method}={count}" for method, count in sorted(api.calls.items()) if method != "getUpdates"
+    ))
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
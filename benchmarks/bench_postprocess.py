@@ -0,0 +1,74 @@
+"""Бенчмарк постобработки: перепаковка в mp4 (копирование потоков) против
+перекодирования под лимит (режим «сжать до N MB»).
+
+Генерирует клипы ffmpeg (h264 + aac в mkv) и прогоняет их через remux и
+fit_to_limit из bot.py — с теми же аргументами ffmpeg, что и в боте.
+
+    python benchmarks/bench_postprocess.py [--runs 3] [--duration 30] [--limit-mb 2]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from common import H264_AAC, import_bot, make_clip, report
+
+CLIPS = (("720p", "1280x720"), ("1080p", "1920x1080"))
+
+
+async def run(bot, clip, duration, runs):
+    media = {"ext": "mkv", "vcodec": "avc1", "acodec": "mp4a", "duration": duration}
+    remux, fit = ([], []), ([], [])
+    for i in range(runs):
+        for timings, step in ((remux, bot.remux), (fit, bot.fit_to_limit)):
+            job = bot.Job(user_id=0, chat_id=0, message_id=None, url=clip, quality="fit")
+            source = f"{bot.job_prefix(job.job_id)}_clip.mkv"
+            bot.make_job_dir(job.job_id)
+            shutil.copy(clip, source)
+            started = time.perf_counter()
+            result = await step(job, source, media)
+            timings[0].append(time.perf_counter() - started)
+            if not result or result[0] == source:
+                raise SystemExit(f"{step.__name__}: не удалось обработать {clip}")
+            timings[1].append(os.path.getsize(result[0]))
+            await bot.remove_job_files(job.job_id)
+    return remux, fit
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--duration", type=int, default=30)
+    parser.add_argument("--limit-mb", type=float, default=2)
+    args = parser.parse_args()
+    if not shutil.which("ffmpeg"):
+        raise SystemExit("Нужен ffmpeg в PATH")
+
+    work_dir = tempfile.mkdtemp(prefix="bench-postprocess-")
+    # Шумная картинка — чтобы кодеку было что сжимать
+    clips = [
+        (name, make_clip(os.path.join(work_dir, f"{name}.mkv"), args.duration, size,
+                         args=(*H264_AAC, "-crf", "28"), noise=True))
+        for name, size in CLIPS
+    ]
+    bot = import_bot(work_dir)
+    bot.TELEGRAM_VIDEO_LIMIT = args.limit_mb
+
+    print(
+        f"Клипы: {args.duration}s, лимит {args.limit_mb} MB, "
+        f"перекодирование: {bot.FIT_THREADS} потоков ffmpeg"
+    )
+    for name, clip in clips:
+        remux, fit = asyncio.run(run(bot, clip, args.duration, args.runs))
+        print(f"\n{name} ({os.path.getsize(clip) / 1024 ** 2:.1f} MB)")
+        for label, (timings, sizes) in (("remux (-c copy)", remux), ("fit (libx264)", fit)):
+            report(label, timings, f"size={statistics.mean(sizes) / 1024 ** 2:.1f} MB")
+        print(f"  {'':<22} перекодирование медленнее в {statistics.mean(fit[0]) / statistics.mean(remux[0]):.0f}×")
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
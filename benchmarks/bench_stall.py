@@ -0,0 +1,120 @@
+"""Бенчмарк докачки после зависания: источник замолкает посреди файла, сторож
+(STALL_TIMEOUT) прерывает попытку, повтор докачивает .part с того же места.
+
+Локальный источник отдаёт случайные байты с поддержкой Range; первый запрос
+скачивания каждой ссылки после --stall-after MB перестаёт отправлять данные. Скачивание
+идёт через download() из bot.py — CLI yt-dlp, затем прогретый пул воркеров.
+Проверяется, что задание завершилось, файл целый, а повтор начался с Range
+(докачка, а не скачивание заново). Если нет — код выхода 1.
+
+    python benchmarks/bench_stall.py [--size-mb 4] [--stall-after 1] [--stall-timeout 3]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from common import QuietHandler, import_bot, report, serve
+
+HOLD_SECONDS = 60  # сколько зависший ответ держит соединение
+
+
+class StallingHandler(QuietHandler):
+    """/clip/<n>.mp4 — один и тот же файл. Первый запрос ссылки — извлечение метаданных
+    (generic-экстрактор), второй — скачивание: он зависает после stall_after байт"""
+    data = b""
+    stall_after = 0
+    requests = {}  # {путь: [начало Range или 0, ...]}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        header = self.headers.get("Range")
+        start = int(header.split("=")[1].split("-")[0]) if header else 0
+        with self.lock:
+            seen = self.requests.setdefault(self.path, [])
+            stall = len(seen) == 1
+            seen.append(start)
+        size = len(self.data)
+        self.send_response(206 if header else 200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(size - start))
+        if header:
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        self.end_headers()
+        try:
+            for offset in range(start, size, 64 * 1024):
+                if stall and offset >= self.stall_after:
+                    time.sleep(HOLD_SECONDS)
+                    return
+                self.wfile.write(self.data[offset:offset + 64 * 1024])
+        except OSError:
+            pass  # клиент ушёл
+
+
+async def run(bot, origin, engine, runs):
+    """runs скачиваний: (времена, ошибки, число докачек с Range)"""
+    timings, failures, resumed = [], [], 0
+    for i in range(runs):
+        path = f"/clip/{engine}{i}.mp4"
+        job = bot.Job(user_id=0, chat_id=0, message_id=None, url=f"{origin}{path}", quality="best")
+        started = time.perf_counter()
+        try:
+            file_path, _ = await bot.download(job, allow_stream=False)
+            size = await bot.in_thread(os.path.getsize, file_path)
+            if size != len(StallingHandler.data):
+                failures.append(f"{path}: {size} байт вместо {len(StallingHandler.data)}")
+            else:
+                timings.append(time.perf_counter() - started)
+        except bot.DownloadFailed as e:
+            failures.append(f"{path}: {e.kind}")
+        if any(StallingHandler.requests.get(path, [])[1:]):
+            resumed += 1
+        await bot.disk.release(job.job_id)
+        await bot.remove_job_files(job.job_id)
+    return timings, failures, resumed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--stall-after", type=float, default=1, help="MB до зависания")
+    parser.add_argument("--stall-timeout", type=int, default=3, help="STALL_TIMEOUT бота, s")
+    args = parser.parse_args()
+
+    StallingHandler.data = os.urandom(int(args.size_mb * 1024 ** 2))
+    StallingHandler.stall_after = int(args.stall_after * 1024 ** 2)
+    work_dir = tempfile.mkdtemp(prefix="bench-stall-")
+    origin = serve(work_dir, StallingHandler)
+    bot = import_bot(work_dir, STALL_TIMEOUT=str(args.stall_timeout), STALL_RETRIES="2")
+
+    print(f"Файл {args.size_mb:.0f} MB, зависание после {args.stall_after:.0f} MB, STALL_TIMEOUT={bot.STALL_TIMEOUT}s")
+    ok = True
+    for engine in ("cli", "pool"):
+        if engine == "pool":
+            bot.start_engine()
+
+        async def bench():
+            if engine == "pool":
+                bot.start_engine_pump(asyncio.get_running_loop())
+            return await run(bot, origin, engine, args.runs)
+
+        timings, failures, resumed = asyncio.run(bench())
+        report(engine, timings, f"докачано с Range: {resumed} из {args.runs}")
+        for failure in failures:
+            print(f"  ❌ {failure}")
+        ok = ok and not failures and resumed == args.runs
+    if bot.engine_pool:
+        bot.engine_progress.put(None)
+        bot.engine_pool.shutdown(wait=False, cancel_futures=True)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
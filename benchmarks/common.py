@@ -0,0 +1,81 @@
+"""Общее для бенчмарков: тестовые клипы ffmpeg, локальный HTTP-источник,
+сводка замеров и импорт bot.py в рабочей папке.
+
+Скрипты запускаются как python benchmarks/bench_*.py — папка benchmarks/
+уже в sys.path, поэтому импорт просто from common import ...
+"""
+import functools
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+H264_AAC = ("-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac")
+
+
+def make_clip(path, duration, size="640x360", args=H264_AAC, noise=False):
+    """Тестовый клип: картинка testsrc2 и тон. noise — шумная картинка, чтобы видео
+    весило как настоящее. Без ffmpeg — файл со случайными байтами (~512 KB на секунду)"""
+    if not shutil.which("ffmpeg"):
+        with open(path, "wb") as f:
+            f.write(os.urandom(int(duration * 512 * 1024)))
+        return path
+    subprocess.run(
+        ["ffmpeg", "-v", "error", "-y",
+         "-f", "lavfi", "-i", f"testsrc2=size={size}:rate=30:duration={duration}",
+         "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+         *(["-vf", "noise=alls=8:allf=t"] if noise else []),
+         *args, "-shortest", path],
+        check=True
+    )
+    return path
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class CountingHandler(QuietHandler):
+    """Раздаёт файлы и считает отданные байты (общий счётчик на процесс)"""
+    sent = 0
+
+    def copyfile(self, source, outputfile):
+        while chunk := source.read(64 * 1024):
+            outputfile.write(chunk)
+            CountingHandler.sent += len(chunk)
+
+
+def serve(directory, handler=QuietHandler):
+    """Локальный HTTP-сервер с фикстурами, возвращает базовый URL"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return "—"
+    pick = lambda q: values[min(len(values) - 1, int(len(values) * q))]
+    return f"n={len(values):<4} p50={pick(0.5):7.3f}s p90={pick(0.9):7.3f}s p99={pick(0.99):7.3f}s max={values[-1]:7.3f}s"
+
+
+def report(name, timings, extra=""):
+    """Строка итогов: перцентили времени и, если есть, дополнительные поля"""
+    print(f"  {name:<22} {percentiles(timings)}" + (f"  {extra}" if extra else ""))
+
+
+def import_bot(work_dir, **env):
+    """Импортирует bot.py: настройки читаются из окружения при импорте,
+    downloads/ и data/ создаются в текущей папке — поэтому сначала work_dir"""
+    os.chdir(work_dir)
+    os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+    os.environ.update(env)
+    sys.path.insert(0, REPO_DIR)
+    import bot
+    return bot
@@ -1,554 +1,4492 @@
 import os
+import shutil
 import json
+import html
 import asyncio
-import glob
+import functools
+import hashlib
+import re
+import time
+import signal
+import socket
+import sys
+import traceback
+import sqlite3
+import threading
+import multiprocessing
+import uuid
 import aiohttp
-from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from aiogram import Bot, Dispatcher, types
 from aiogram.utils import executor
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.utils.exceptions import RetryAfter
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
 
 # =========================
 # НАСТРОЙКИ
 # =========================
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 GDRIVE_JSON = os.getenv("GDRIVE_JSON")
+# Telegram id администраторов через запятую: им доступна /stats (выходы, облака, диск)
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").replace(",", " ").split()}
 
-TELEGRAM_VIDEO_LIMIT = 2000  # 2 GB
 DOWNLOAD_DIR = "downloads"
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
+# Bot API: публичный сервер или свой telegram-bot-api (режим --local)
+BOT_API_URL = os.getenv("BOT_API_URL")  # например http://telegram-bot-api:8081
+BOT_API_LOCAL = os.getenv("BOT_API_LOCAL", "1" if BOT_API_URL else "0") == "1"
+# Папка загрузок глазами сервера Bot API (общий том); по умолчанию — тот же путь
+BOT_API_FILES_DIR = os.getenv("BOT_API_FILES_DIR", os.path.abspath(DOWNLOAD_DIR))
+# Лимит отправки: 50 MB у публичного Bot API, 2 GB у локального
+TELEGRAM_VIDEO_LIMIT = 2000 if BOT_API_LOCAL else 50
+
+# Кэш готовых результатов (file_id Telegram / ссылки на облако)
+CACHE_DB = os.getenv("CACHE_DB", os.path.join(DATA_DIR, "cache.sqlite3"))
+CACHE_TTL = int(os.getenv("CACHE_TTL", 7 * 24 * 3600))  # секунды
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 50000))
+
+# Планировщик заданий
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 8))        # заданий одновременно
+MAX_QUEUE = int(os.getenv("MAX_QUEUE", 200))          # заданий в очереди
+DOWNLOAD_SLOTS = int(os.getenv("DOWNLOAD_SLOTS", 4))  # одновременных yt-dlp
+MERGE_SLOTS = int(os.getenv("MERGE_SLOTS", 2))        # одновременных слияний ffmpeg
+UPLOAD_SLOTS = int(os.getenv("UPLOAD_SLOTS", 4))      # одновременных отправок
+# Потоковая загрузка больших файлов в облако (форматы без слияния)
+STREAM_UPLOADS = os.getenv("STREAM_UPLOADS", "1") == "1"
+STREAM_CHUNK_SIZE = 1024 * 1024                # чтение из yt-dlp, байт
+STREAM_QUEUE_CHUNKS = 16                       # буфер между скачиванием и загрузкой
+# Загрузка в облако
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 100))   # соединений в общей сессии
+GOFILE_PARALLEL = int(os.getenv("GOFILE_PARALLEL", 2))   # одновременных загрузок
+DRIVE_PARALLEL = int(os.getenv("DRIVE_PARALLEL", 2))
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES", 5))
+LOCAL_UPLOAD_DIR = os.getenv("LOCAL_UPLOAD_DIR")       # папка, раздаваемая по HTTP
+LOCAL_UPLOAD_URL = os.getenv("LOCAL_UPLOAD_URL", "")   # её публичный адрес
+LOCAL_UPLOAD_PARALLEL = int(os.getenv("LOCAL_UPLOAD_PARALLEL", 4))
+UPLOAD_EXPECTED_RATE = 10 * 1024 * 1024        # байт/с, пока скорость сервиса неизвестна
+UPLOAD_HEDGE_AFTER = int(os.getenv("UPLOAD_HEDGE_AFTER", 60))  # s, минимум до запуска запасного
+UPLOAD_HEDGE_FACTOR = 2                        # запасной — если дольше 2× ожидаемого
+UPLOAD_HEALTH_ALPHA = 0.3                      # вес последней загрузки в оценках
+GOFILE_SERVER_TTL = 600                        # s, кэш выбора сервера GoFile
+DRIVE_CHUNK_SIZE = 8 * 1024 * 1024             # кратно 256 KB (требование Drive)
+# Платформы (профили — в реестре PLATFORMS)
+DEFAULT_VIDEO_FORMAT = "bestvideo[ext=mp4]+bestaudio[ext=m4a]/bestvideo+bestaudio/best"
+COOKIES_DIR = os.getenv("COOKIES_DIR", os.path.join(DATA_DIR, "cookies"))  # <платформа>.txt
+# Сторож скачивания: вместо фиксированного таймаута — зависание и бюджет по размеру
+STALL_TIMEOUT = int(os.getenv("STALL_TIMEOUT", 60))  # s без новых байт — процесс завис
+STALL_START_TIMEOUT = 120                      # s до первого байта (извлечение, ответ площадки)
+STALL_RETRIES = int(os.getenv("STALL_RETRIES", 2))   # докачек с --continue после зависания
+WATCH_INTERVAL = 1.0                           # s между проверками
+DOWNLOAD_RATE_DEFAULT = 1024 * 1024            # байт/с, пока скорость площадки не измерена
+DOWNLOAD_RATE_ALPHA = 0.3                      # вес последнего скачивания в оценке скорости
+DOWNLOAD_SLOWDOWN = 4                          # бюджет — ожидаемое время при скорости в 4 раза ниже
+DOWNLOAD_MAX_TIMEOUT = 6 * 3600                # s, потолок бюджета
+# Выходы в интернет для yt-dlp: прокси (http://, socks5://), IP-адреса сервера или direct
+PROXIES = [spec.strip() for spec in os.getenv("PROXIES", "").split(",") if spec.strip()]
+EGRESS_RETRIES = int(os.getenv("EGRESS_RETRIES", 3))  # попыток через разные выходы
+EGRESS_BENCH_AFTER = 3        # подряд 429/403 от платформы — выход снимается для неё
+EGRESS_BENCH_SECONDS = 600    # на сколько (удваивается при повторе, не больше часа)
+# Движок yt-dlp: "cli" — процесс на каждое скачивание, "pool" — пул процессов с YoutubeDL
+YTDLP_ENGINE = os.getenv("YTDLP_ENGINE", "cli")
+ENGINE_WORKERS = int(os.getenv("ENGINE_WORKERS", 4))
+YTDLP_CACHE_DIR = os.path.join(DATA_DIR, "yt-dlp-cache")  # player JS / подписи
+# Метаданные (извлекаются при отправке ссылки)
+INFO_TIMEOUT = float(os.getenv("INFO_TIMEOUT", 15))   # s ожидания перед показом клавиатуры
+INFO_TTL = int(os.getenv("INFO_TTL", 1800))           # ссылки на форматы со временем истекают
+INFO_CACHE_SIZE = 1000
+EXTRACT_SLOTS = int(os.getenv("EXTRACT_SLOTS", 4))    # одновременных извлечений
+FORMAT_CHOICES = 4                                    # кнопок с разрешениями
+# Прогресс скачивания
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", 3))  # s между правками в чате
+GLOBAL_EDIT_RATE = float(os.getenv("GLOBAL_EDIT_RATE", 20))  # правок в секунду на бота
+PROGRESS_TEMPLATE = (
+    "download:[progress] %(progress.downloaded_bytes)s %(progress.total_bytes)s "
+    "%(progress.total_bytes_estimate)s %(progress.speed)s %(progress.eta)s"
+)
+# Пакеты: несколько ссылок в сообщении или плейлист/канал
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 50))    # элементов в одном пакете
+BATCH_PARALLEL = int(os.getenv("BATCH_PARALLEL", 3))       # одновременных скачиваний пакета
+MEDIA_GROUP_SIZE = 10                                      # максимум Telegram для альбома
+FRAGMENT_CONCURRENCY = int(os.getenv("FRAGMENT_CONCURRENCY", 4))  # фрагментов HLS/DASH параллельно
+# Поля выбранного формата, которые yt-dlp отдаёт вместе со скачиванием (вместо ffprobe)
+MEDIA_FIELDS = ("ext", "vcodec", "acodec", "width", "height", "duration", "title")
+MEDIA_TEMPLATE = "%(.{" + ",".join(MEDIA_FIELDS) + "})j"
+# Строки вывода yt-dlp, после которых начинается постобработка ffmpeg
+MERGE_MARKERS = ("[Merger]", "[ExtractAudio]", "[VideoConvertor]", "[VideoRemuxer]", "[Fixup")
+# Постобработка: перепаковка в mp4 без перекодирования и режим «сжать под лимит»
+FFMPEG = shutil.which("ffmpeg")
+MP4_VIDEO_CODECS = ("avc1", "h264", "hevc", "hev1", "hvc1", "av01")  # кодеки, которые mp4 берёт как есть
+MP4_AUDIO_CODECS = ("mp4a", "aac", "mp3", "opus", "ac-3", "ec-3")
+FIT_SLOTS = int(os.getenv("FIT_SLOTS", 1))           # одновременных перекодирований
+FIT_THREADS = int(os.getenv("FIT_THREADS", 2))       # потоков ffmpeg на перекодирование
+FIT_SOURCE_HEIGHT = 720                              # исходник для сжатия — не выше
+FIT_HEADROOM = 0.92                                  # запас на контейнер и неточность битрейта
+FIT_AUDIO_KBPS = 96
+FIT_MIN_VIDEO_KBPS = 150                             # меньше — смотреть невозможно, лучше облако
+FIT_HEIGHTS = ((1500, 720), (800, 480), (400, 360), (0, 240))  # (от kbit/s видео, высота кадра)
+# Режим «Аудио»: только аудиодорожка в AUDIO_FORMAT — копированием потока, если кодек подходит
+AUDIO_FORMAT = os.getenv("AUDIO_FORMAT", "m4a")      # m4a | mp3 | opus
+AUDIO_BITRATE = int(os.getenv("AUDIO_BITRATE", 128)) # kbit/s при перекодировании
+AUDIO_SLOTS = int(os.getenv("AUDIO_SLOTS", 2))       # одновременных перекодирований аудио
+AUDIO_MUXED_HEIGHT = 480                             # без отдельного аудио — видео не выше (звук тот же)
+# Формат → (расширение файла, кодеки для копирования, кодировщик ffmpeg, формат yt-dlp)
+AUDIO_TARGETS = {
+    "m4a": ("m4a", ("mp4a", "aac"), "aac", "bestaudio[acodec^=mp4a]"),
+    "mp3": ("mp3", ("mp3",), "libmp3lame", "bestaudio[acodec=mp3]"),
+    "opus": ("ogg", ("opus",), "libopus", "bestaudio[acodec=opus]"),
+}
+# Обложки и теги: превью из метаданных (или кадр из файла) готовятся параллельно со скачиванием
+THUMB_DIR = os.path.join(DATA_DIR, "thumbs")         # кэш обложек по id медиа
+THUMB_SIZE = 320                                     # px по большей стороне (требование Telegram)
+THUMB_MAX_BYTES = 200 * 1024
+THUMB_CACHE_SIZE = 2000
+THUMB_MAX_AGE = 7 * 24 * 3600                         # s, обложки старше удаляются при сборке мусора
+THUMB_SOURCE_MAX_BYTES = 10 * 1024 * 1024             # превью площадки больше — не качаем
+ENRICH_SLOTS = int(os.getenv("ENRICH_SLOTS", 2))     # одновременных ffmpeg для обложек
+ENRICH_TIMEOUT = 20                                  # s на одну обложку
+ENRICH_WAIT = float(os.getenv("ENRICH_WAIT", 1))     # s, сколько отправка ждёт неготовую обложку
+# Роли процесса: all — всё в одном, front — приём апдейтов и постановка в очередь,
+# worker — выполнение заданий из общей очереди
+ROLE = os.getenv("ROLE", "all")
+STATE_STORE = os.getenv("STATE_STORE", "sqlite")  # memory | sqlite | sqlite:///путь | redis://...
+USER_STATE_TTL = 24 * 3600                       # s, выбранная ссылка пользователя
+LOCK_TTL = 2 * 3600                              # s, блокировка пользователя / ведущее задание
+WORKER_POLL_INTERVAL = 0.5                       # s, опрос общей очереди воркером
+# Журнал заданий: незавершённые задания продолжаются после перезапуска или падения
+JOURNAL_DB = os.path.join(DATA_DIR, "journal.db")
+WORKER_ID = os.getenv("WORKER_ID") or socket.gethostname()  # владелец заданий в журнале
+JOURNAL_HEARTBEAT = 15                           # s между отметками «процесс жив»
+JOURNAL_STALE = 60                               # s без отметки — задания подбирают другие
+JOURNAL_KEEP = 24 * 3600                         # s хранения завершённых записей
+SHUTDOWN_GRACE = int(os.getenv("SHUTDOWN_GRACE", 50))  # s ожидания отправок при остановке
+DRAIN_STAGES = ("merge", "transcode", "upload")  # при остановке дожидаемся, остальное прерываем
+# Webhook (если WEBHOOK_URL не задан — long polling)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")           # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", 8080))
+# Место на диске под DOWNLOAD_DIR
+DISK_BUDGET_MB = int(os.getenv("DISK_BUDGET_MB", 0))        # 0 — свободное место тома
+DISK_KEEP_FREE_MB = int(os.getenv("DISK_KEEP_FREE_MB", 1024))  # запас, если бюджет не задан
+DISK_DEFAULT_JOB_MB = 500           # оценка, если размер заранее неизвестен
+DISK_WAIT_TIMEOUT = 600             # s ожидания места, потом отказ
+DISK_GC_INTERVAL = 300              # s между сборками мусора
+DISK_FILE_MAX_AGE = 6 * 3600        # s, файлы без владельца старше — удаляются
+# Метрики Prometheus (0 — выключены)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+METRICS_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+# Монитор event loop: задержки дольше порога — в лог со стеком блокирующего вызова (0 — выключен)
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", 0.1))  # s
+LOOP_LAG_INTERVAL = 0.25                       # s, как часто loop отмечается
+LOOP_LAG_FRAMES = 4                            # кадров стека в записи лога
+# Потоки для файловых операций, обновления токена Drive и копирования в LOCAL_UPLOAD_DIR
+FILE_THREADS = int(os.getenv("FILE_THREADS", 8))
 
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+os.makedirs(DATA_DIR, exist_ok=True)
+os.makedirs(THUMB_DIR, exist_ok=True)
+if LOCAL_UPLOAD_DIR:
+    os.makedirs(LOCAL_UPLOAD_DIR, exist_ok=True)
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не установлен!")
+if ROLE not in ("all", "front", "worker"):
+    raise ValueError(f"Неизвестная роль: {ROLE}")
+if AUDIO_FORMAT not in AUDIO_TARGETS:
+    raise ValueError(f"Неизвестный AUDIO_FORMAT: {AUDIO_FORMAT}")
 
-bot = Bot(token=BOT_TOKEN)
+if BOT_API_URL:
+    bot = Bot(token=BOT_TOKEN, server=TelegramAPIServer.from_base(BOT_API_URL))
+else:
+    bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher(bot)
-executor_pool = ThreadPoolExecutor(max_workers=3)
+executor_pool = ThreadPoolExecutor(max_workers=FILE_THREADS)
+
+# =========================
+# ОБЩЕЕ СОСТОЯНИЕ
+# =========================
+class MemoryStore:
+    """Состояние в памяти процесса (один процесс: ROLE=all)"""
+
+    def __init__(self):
+        self.values = {}  # {ключ: (значение, истекает в или None)}
+        self.queues = {}  # {имя: deque}
+
+    async def get(self, key):
+        entry = self.values.get(key)
+        if not entry:
+            return None
+        value, expires_at = entry
+        if expires_at and expires_at < time.time():
+            del self.values[key]
+            return None
+        return value
+
+    async def set(self, key, value, ttl=None):
+        self.values[key] = (value, time.time() + ttl if ttl else None)
+
+    async def add(self, key, value, ttl=None):
+        """Записывает, только если ключа нет. True — если записали"""
+        if await self.get(key) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete(self, key):
+        self.values.pop(key, None)
+
+    async def push(self, queue, value):
+        self.queues.setdefault(queue, deque()).append(value)
+
+    async def push_if(self, key, expected, queue, value):
+        """Кладёт value в очередь, только если key == expected. True — если положили"""
+        if await self.get(key) != expected:
+            return False
+        await self.push(queue, value)
+        return True
+
+    async def pop(self, queue):
+        items = self.queues.get(queue)
+        if not items:
+            return None
+        value = items.popleft()
+        if not items:
+            del self.queues[queue]
+        return value
+
+    async def size(self, queue):
+        return len(self.queues.get(queue, ()))
+
+class SQLiteStore:
+    """Состояние в файле SQLite — общее для процессов на одном хосте (общий том).
+    Запросы — в пуле потоков: пока файл занят другим процессом, запрос ждёт
+    до 30 s, и event loop не должен стоять всё это время"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "name TEXT, value TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS queue_name ON queue (name, id)")
+
+    def _fetchone(self, sql, params):
+        return self.conn.execute(sql, params).fetchone()
+
+    def _rowcount(self, sql, params):
+        return self.conn.execute(sql, params).rowcount
+
+    async def get(self, key):
+        row = await in_thread(
+            self._fetchone,
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)",
+            (key, time.time())
+        )
+        return json.loads(row[0]) if row else None
+
+    async def set(self, key, value, ttl=None):
+        await in_thread(
+            self._rowcount, "INSERT OR REPLACE INTO kv VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time() + ttl if ttl else None)
+        )
+
+    async def add(self, key, value, ttl=None):
+        """Записывает, только если ключа нет (или он истёк). True — если записали"""
+        now = time.time()
+        return await in_thread(
+            self._rowcount,
+            "INSERT INTO kv VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+            "value = excluded.value, expires_at = excluded.expires_at "
+            "WHERE kv.expires_at IS NOT NULL AND kv.expires_at < ?",
+            (key, json.dumps(value), now + ttl if ttl else None, now)
+        ) == 1
+
+    async def delete(self, key):
+        await in_thread(self._rowcount, "DELETE FROM kv WHERE key = ?", (key,))
+
+    async def push(self, queue, value):
+        await in_thread(
+            self._rowcount, "INSERT INTO queue (name, value) VALUES (?, ?)", (queue, json.dumps(value))
+        )
+
+    async def push_if(self, key, expected, queue, value):
+        """Кладёт value в очередь, только если key == expected. True — если положили.
+        Один оператор: проверка и вставка атомарны относительно delete(key)"""
+        return await in_thread(
+            self._rowcount,
+            "INSERT INTO queue (name, value) SELECT ?, ? WHERE EXISTS ("
+            "SELECT 1 FROM kv WHERE key = ? AND value = ? AND (expires_at IS NULL OR expires_at >= ?))",
+            (queue, json.dumps(value), key, json.dumps(expected), time.time())
+        ) == 1
+
+    async def pop(self, queue):
+        # Один оператор — атомарно даже при нескольких процессах
+        row = await in_thread(
+            self._fetchone,
+            "DELETE FROM queue WHERE id = (SELECT MIN(id) FROM queue WHERE name = ?) RETURNING value",
+            (queue,)
+        )
+        return json.loads(row[0]) if row else None
+
+    async def size(self, queue):
+        row = await in_thread(self._fetchone, "SELECT COUNT(*) FROM queue WHERE name = ?", (queue,))
+        return row[0]
+
+class RedisStore:
+    """Состояние в Redis — общее для процессов на разных хостах (асинхронный клиент)"""
+
+    def __init__(self, url):
+        import redis.asyncio  # нужен только для этого хранилища
+        self.client = redis.asyncio.Redis.from_url(url)
+        self.prefix = "vbot:"
+        # Проверка ключа и RPUSH одним скриптом — атомарно для Redis
+        self._push_if = self.client.register_script(
+            "if redis.call('GET', KEYS[1]) == ARGV[1] then "
+            "return redis.call('RPUSH', KEYS[2], ARGV[2]) end return 0"
+        )
+
+    async def get(self, key):
+        value = await self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key, value, ttl=None):
+        await self.client.set(self.prefix + key, json.dumps(value), ex=ttl and int(ttl))
+
+    async def add(self, key, value, ttl=None):
+        return bool(await self.client.set(self.prefix + key, json.dumps(value), ex=ttl and int(ttl), nx=True))
+
+    async def delete(self, key):
+        await self.client.delete(self.prefix + key)
+
+    async def push(self, queue, value):
+        await self.client.rpush(self.prefix + queue, json.dumps(value))
+
+    async def push_if(self, key, expected, queue, value):
+        """Кладёт value в очередь, только если key == expected. True — если положили"""
+        return bool(await self._push_if(
+            keys=[self.prefix + key, self.prefix + queue], args=[json.dumps(expected), json.dumps(value)]
+        ))
+
+    async def pop(self, queue):
+        value = await self.client.lpop(self.prefix + queue)
+        return json.loads(value) if value is not None else None
+
+    async def size(self, queue):
+        return await self.client.llen(self.prefix + queue)
+
+def open_store(spec):
+    """memory | sqlite | sqlite:///путь | redis://хост:порт/база"""
+    if spec == "memory":
+        return MemoryStore()
+    if spec == "sqlite":
+        return SQLiteStore(os.path.join(DATA_DIR, "state.db"))
+    if spec.startswith("sqlite:///"):
+        return SQLiteStore(spec[len("sqlite:///"):])
+    if spec.startswith(("redis://", "rediss://")):
+        return RedisStore(spec)
+    raise ValueError(f"Неизвестное хранилище состояния: {spec}")
+
+class StoreDict:
+    """Словарь {user_id: значение} поверх общего хранилища"""
+
+    def __init__(self, store, prefix, ttl=None):
+        self.store = store
+        self.prefix = prefix
+        self.ttl = ttl
+
+    async def get(self, user_id, default=None):
+        value = await self.store.get(f"{self.prefix}:{user_id}")
+        return default if value is None else value
+
+    async def set(self, user_id, value):
+        await self.store.set(f"{self.prefix}:{user_id}", value, self.ttl)
+
+    async def delete(self, user_id):
+        await self.store.delete(f"{self.prefix}:{user_id}")
+
+state = open_store(STATE_STORE)
 
 # Храним выбор пользователей {user_id: url}
-user_urls = {}
-# Блокировка для предотвращения одновременных скачиваний
-user_locks = {}
+user_urls = StoreDict(state, "url", ttl=USER_STATE_TTL)
+# Блокировка для предотвращения одновременных скачиваний (с TTL — на случай падения воркера)
+user_locks = StoreDict(state, "lock", ttl=LOCK_TTL)
+
+# =========================
+# МЕТРИКИ И ЛОГИ
+# =========================
+def log(event, job=None, **fields):
+    """Структурированная запись лога (одна JSON-строка)"""
+    record = {"ts": round(time.time(), 3), "event": event}
+    if job is not None:
+        record["job_id"] = job.job_id
+        record["user_id"] = job.user_id
+    record.update(fields)
+    print(json.dumps(record, ensure_ascii=False, default=str), flush=True)
+
+class Metrics:
+    """Счётчики, гистограммы и вычисляемые значения в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self.kinds = {}       # имя: (тип, описание)
+        self.values = {}      # (имя, метки): значение счётчика
+        self.histograms = {}  # (имя, метки): [счётчики корзин..., сумма, количество]
+        self.collectors = []  # (имя, функция) — значение считается при запросе
+
+    def describe(self, name, kind, help_text):
+        self.kinds[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.histograms.setdefault(key, [0] * (len(METRICS_BUCKETS) + 2))
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                buckets[i] += 1
+        buckets[-2] += value
+        buckets[-1] += 1
+
+    def collect(self, name, kind, help_text, fn):
+        self.describe(name, kind, help_text)
+        self.collectors.append((name, fn))
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = [*labels, *extra]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self):
+        lines = []
+        samples = {}
+        for (name, labels), value in self.values.items():
+            samples.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), buckets in self.histograms.items():
+            out = samples.setdefault(name, [])
+            for bound, count in zip(METRICS_BUCKETS, buckets):
+                out.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+            out.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {buckets[-1]}")
+            out.append(f"{name}_sum{self._labels(labels)} {buckets[-2]}")
+            out.append(f"{name}_count{self._labels(labels)} {buckets[-1]}")
+        for name, fn in self.collectors:
+            samples.setdefault(name, []).append(f"{name} {fn()}")
+        for name, out in samples.items():
+            kind, help_text = self.kinds.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(out)
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("bot_requests_total", "counter", "Ссылки по платформам")
+metrics.describe("bot_jobs_total", "counter", "Завершённые задания по результату")
+metrics.describe("bot_errors_total", "counter", "Ошибки по классам")
+metrics.describe("bot_stage_seconds", "histogram", "Длительность стадий конвейера")
+metrics.describe("bot_queue_wait_seconds", "histogram", "Ожидание в очереди")
+metrics.describe("bot_job_seconds", "histogram", "Полное время задания")
+metrics.describe("bot_cloud_upload_seconds", "histogram", "Загрузка в облако по сервисам")
+metrics.describe("bot_bytes_total", "counter", "Переданные байты по направлениям")
+metrics.describe("bot_platform_throttled_total", "counter", "Запросы, ждавшие лимита платформы")
+metrics.describe("bot_egress_limited_total", "counter", "Ответы 429/403 по выходам и платформам")
+metrics.describe("bot_egress_benched_total", "counter", "Снятия выхода с платформы")
+
+def active_downloads(key):
+    """Сумма поля прогресса по заданиям на стадии скачивания"""
+    return sum(progress[key] for progress in scheduler.progress_snapshot() if progress["stage"] == "download")
+
+metrics.collect("bot_queue_depth", "gauge", "Заданий в очереди", lambda: scheduler.queued)
+metrics.collect("bot_active_jobs", "gauge", "Выполняемых заданий", lambda: len(scheduler.active))
+metrics.collect("bot_active_subprocesses", "gauge", "Запущенных yt-dlp/ffprobe",
+                lambda: count_processes())
+metrics.collect("bot_engine_downloads", "gauge", "Скачиваний в пуле yt-dlp", lambda: len(engine_jobs))
+metrics.collect("bot_active_download_bytes", "gauge", "Скачано активными заданиями",
+                lambda: active_downloads("downloaded_bytes"))
+metrics.collect("bot_active_download_speed_bytes", "gauge", "Суммарная скорость скачивания, байт/с",
+                lambda: active_downloads("speed"))
+metrics.collect("bot_disk_usage_bytes", "gauge", "Занято в папке загрузок", lambda: disk.usage)
+metrics.collect("bot_disk_reserved_bytes", "gauge", "Зарезервировано заданиями",
+                lambda: sum(disk.reservations.values()))
+metrics.collect("bot_disk_limit_bytes", "gauge", "Бюджет места", lambda: disk.limit)
+metrics.collect("bot_disk_waiting_jobs", "gauge", "Заданий ждут места", lambda: disk.waiting)
+metrics.describe("bot_disk_gc_files_total", "counter", "Удалено файлов сборкой мусора")
+metrics.describe("bot_disk_gc_bytes_total", "counter", "Освобождено сборкой мусора")
+metrics.collect("bot_cache_hits_total", "counter", "Попадания в кэш результатов",
+                lambda: result_cache.hits)
+metrics.collect("bot_cache_misses_total", "counter", "Промахи кэша результатов",
+                lambda: result_cache.misses)
+
+# Запущенные процессы (yt-dlp, ffprobe) — для метрики активных подпроцессов
+active_processes = set()
+
+async def spawn(*cmd, **kwargs):
+    """asyncio.create_subprocess_exec с учётом процесса в метриках"""
+    process = await asyncio.create_subprocess_exec(*cmd, **kwargs)
+    active_processes.add(process)
+    return process
+
+def count_processes():
+    for process in [p for p in active_processes if p.returncode is not None]:
+        active_processes.discard(process)
+    return len(active_processes)
+
+class LoopMonitor:
+    """Задержки event loop. Корутина отмечается каждые LOOP_LAG_INTERVAL s; поток-сторож,
+    заметив, что отметки нет дольше порога, снимает стек потока loop — там и стоит
+    блокирующий вызов. Проснувшаяся корутина пишет в лог задержку и этот стек"""
+
+    def __init__(self, interval, threshold):
+        self.interval = interval
+        self.threshold = threshold
+        self.beat = time.monotonic()
+        self.thread_id = None
+        self.where = None  # стек, снятый сторожем во время текущей задержки
+        self.lag = 0.0
+        self._task = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self._task = asyncio.create_task(self._tick())
+        threading.Thread(target=self._watch, name="loop-monitor", daemon=True).start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _tick(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, time.monotonic() - expected)
+            self.beat = time.monotonic()
+            where, self.where = self.where, None
+            if self.lag >= self.threshold:
+                metrics.inc("bot_loop_stalls_total")
+                log("loop_lag", lag=round(self.lag, 3), where=where)
+
+    def _watch(self):
+        while not self._stop.wait(self.threshold / 2):
+            if self.where is None and time.monotonic() - self.beat > self.interval + self.threshold:
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    self.where = [
+                        f"{os.path.basename(f.filename)}:{f.lineno} {f.name}"
+                        for f in traceback.extract_stack(frame)[-LOOP_LAG_FRAMES:]
+                    ]
+                del frame
+
+loop_monitor = LoopMonitor(LOOP_LAG_INTERVAL, LOOP_LAG_THRESHOLD)
+metrics.describe("bot_loop_stalls_total", "counter", "Задержки event loop дольше LOOP_LAG_THRESHOLD")
+metrics.collect("bot_loop_lag_seconds", "gauge", "Последняя измеренная задержка event loop",
+                lambda: round(loop_monitor.lag, 4))
+
+metrics_runner = None
+
+async def start_metrics_server():
+    """HTTP /metrics на event loop бота"""
+    global metrics_runner
+    
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain")
+    
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"✅ Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+# =========================
+# HTTP
+# =========================
+http_session = None
+
+async def get_http_session():
+    """Общая сессия aiohttp с пулом соединений (создаётся при первом использовании)"""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300)
+        )
+    return http_session
+
+async def retry_delay(attempt):
+    """Экспоненциальная пауза перед повтором"""
+    await asyncio.sleep(min(2 ** attempt, 30))
 
 # =========================
 # GOOGLE DRIVE
 # =========================
-drive = None
+# google.auth (с cryptography и requests) импортируется ~0.2 s — только при первой
+# загрузке в Drive. При запуске ключ лишь разбирается как JSON
+drive_info = None
+drive_creds = None
 if GDRIVE_JSON:
     try:
-        creds = service_account.Credentials.from_service_account_info(
-            json.loads(GDRIVE_JSON),
-            scopes=["https://www.googleapis.com/auth/drive"]
-        )
-        drive = build("drive", "v3", credentials=creds)
+        drive_info = json.loads(GDRIVE_JSON)
+        if not {"client_email", "private_key", "token_uri"} <= drive_info.keys():
+            raise ValueError("в ключе нет client_email / private_key / token_uri")
         print("✅ Google Drive включен")
     except Exception as e:
+        drive_info = None
         print(f"⚠️ Google Drive отключен: {e}")
 
-def upload_to_drive_sync(file_path):
-    """Синхронная загрузка в Google Drive"""
-    if not drive:
+class DriveRetryable(Exception):
+    """Временная ошибка Drive — кусок можно отправить ещё раз"""
+
+def drive_credentials():
+    """Учётные данные сервисного аккаунта (создаются при первом обращении)"""
+    global drive_creds
+    if drive_creds is None:
+        from google.oauth2 import service_account
+        drive_creds = service_account.Credentials.from_service_account_info(
+            drive_info,
+            scopes=["https://www.googleapis.com/auth/drive"]
+        )
+    return drive_creds
+
+def refresh_drive_token():
+    from google.auth.transport.requests import Request as GoogleAuthRequest
+    creds = drive_credentials()
+    creds.refresh(GoogleAuthRequest())
+    return creds
+
+async def drive_auth_headers():
+    """Заголовок авторизации Google Drive (импорт, ключ и токен — в пуле потоков)"""
+    creds = drive_creds
+    if creds is None or not creds.valid:
+        creds = await in_thread(refresh_drive_token)
+    return {"Authorization": f"Bearer {creds.token}"}
+
+class DriveResumable:
+    """Resumable-сессия Google Drive: данные уходят кусками по DRIVE_CHUNK_SIZE,
+    при сбое повторяется только упавший кусок с того места, которое Drive уже принял"""
+
+    def __init__(self, session, filename, mimetype="video/mp4", total=None):
+        self.session = session
+        self.filename = filename
+        self.mimetype = mimetype
+        self.total = total  # None — размер станет известен в конце (поток)
+        self.url = None
+        self.offset = 0
+        self.result = None
+
+    async def start(self):
+        headers = await drive_auth_headers()
+        async with self.session.post(
+            "https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable",
+            json={"name": self.filename},
+            headers={**headers, "X-Upload-Content-Type": self.mimetype}
+        ) as response:
+            if response.status != 200:
+                raise Exception(f"Google Drive: не удалось начать загрузку ({response.status})")
+            self.url = response.headers["Location"]
+
+    async def _put(self, data, total, content_range):
+        """Один PUT в сессию. Возвращает (принято байт всего, метаданные файла или None)"""
+        headers = await drive_auth_headers()
+        async with self.session.put(
+            self.url, data=data, headers={**headers, "Content-Range": content_range}
+        ) as response:
+            if response.status in (200, 201):
+                return total, await response.json()
+            if response.status == 308:
+                # Без Range Drive ещё ничего не сохранил
+                committed = response.headers.get("Range")
+                return (int(committed.split("-")[1]) + 1 if committed else 0), None
+            if response.status in (401, 429) or response.status >= 500:
+                raise DriveRetryable(f"HTTP {response.status}")
+            raise Exception(f"Google Drive: ошибка загрузки ({response.status})")
+
+    async def flush(self, buffer, final=False):
+        """Отправляет буфер кусками, удаляя из него принятые байты. Хвост меньше куска
+        остаётся в буфере до следующего вызова, если это не конец данных.
+        Возвращает метаданные файла, когда загрузка завершена"""
+        attempt = 0
+        probe = False
+        while self.result is None:
+            if final and len(buffer) <= DRIVE_CHUNK_SIZE:
+                size, total = len(buffer), self.offset + len(buffer)
+            elif len(buffer) >= DRIVE_CHUNK_SIZE:
+                size, total = DRIVE_CHUNK_SIZE, self.total
+            else:
+                return None
+            
+            total_label = total if total is not None else "*"
+            try:
+                if probe or not size:
+                    # Узнаём, сколько Drive уже принял (или завершаем пустым куском)
+                    committed, self.result = await self._put(b"", total, f"bytes */{total_label}")
+                else:
+                    committed, self.result = await self._put(
+                        bytes(buffer[:size]), total,
+                        f"bytes {self.offset}-{self.offset + size - 1}/{total_label}"
+                    )
+            except (aiohttp.ClientError, asyncio.TimeoutError, DriveRetryable) as e:
+                attempt += 1
+                if attempt > UPLOAD_RETRIES:
+                    raise
+                print(f"⚠️ Google Drive: сбой куска ({e}), повтор {attempt}/{UPLOAD_RETRIES}")
+                await retry_delay(attempt)
+                probe = True
+                continue
+            
+            if probe:
+                probe = False
+            else:
+                attempt = 0
+            del buffer[:committed - self.offset]
+            self.offset = committed
+        return self.result
+
+    async def share(self):
+        """Открывает доступ по ссылке и возвращает её"""
+        file_id = self.result["id"]
+        headers = await drive_auth_headers()
+        async with self.session.post(
+            f"https://www.googleapis.com/drive/v3/files/{file_id}/permissions",
+            json={"type": "anyone", "role": "reader"},
+            headers=headers
+        ) as response:
+            if response.status != 200:
+                raise Exception("Google Drive: не удалось открыть доступ")
+        return f"https://drive.google.com/file/d/{file_id}/view"
+
+async def upload_to_drive(file_path):
+    """Загрузка файла в Google Drive (resumable, с повтором отдельных кусков)"""
+    if not drive_info:
         raise Exception("Google Drive не настроен")
     
-    file_metadata = {"name": os.path.basename(file_path)}
-    media = MediaFileUpload(file_path, mimetype="video/mp4", resumable=True)
-    
-    file = drive.files().create(
-        body=file_metadata,
-        media_body=media,
-        fields="id"
-    ).execute()
+    upload = DriveResumable(
+        await get_http_session(), os.path.basename(file_path),
+        total=await in_thread(os.path.getsize, file_path)
+    )
+    await upload.start()
+    buffer = bytearray()
+    f = await in_thread(open, file_path, "rb")
+    with f:
+        while chunk := await in_thread(f.read, DRIVE_CHUNK_SIZE):
+            buffer += chunk
+            await upload.flush(buffer)
+    await upload.flush(buffer, final=True)
+    return await upload.share()
+
+async def drive_open_stream(filename, mimetype="video/mp4"):
+    """Открывает resumable-сессию Drive для потока байтов неизвестной длины.
+    Возвращает корутинную функцию send(chunks) -> ссылка"""
+    upload = DriveResumable(await get_http_session(), filename, mimetype)
+    await upload.start()
     
-    drive.permissions().create(
-        fileId=file['id'],
-        body={'type': 'anyone', 'role': 'reader'}
-    ).execute()
+    async def send(chunks):
+        buffer = bytearray()
+        async for chunk in chunks:
+            buffer += chunk
+            await upload.flush(buffer)
+        await upload.flush(buffer, final=True)
+        return await upload.share()
     
-    return f"https://drive.google.com/file/d/{file['id']}/view"
-
-async def upload_to_drive(file_path):
-    """Асинхронная обёртка для загрузки в Google Drive"""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(executor_pool, upload_to_drive_sync, file_path)
+    return send
 
 # =========================
 # GOFILE
 # =========================
+gofile_server = {"name": None, "expires_at": 0.0}
+
+async def gofile_get_server(session):
+    """Выбирает сервер GoFile для загрузки (ответ кэшируется)"""
+    if gofile_server["name"] and gofile_server["expires_at"] > time.monotonic():
+        return gofile_server["name"]
+    
+    async with session.get("https://api.gofile.io/getServer") as response:
+        if response.status != 200:
+            raise Exception("Не удалось получить сервер GoFile")
+        
+        server_data = await response.json()
+        if server_data['status'] != 'ok':
+            raise Exception("Ошибка API GoFile")
+        
+        gofile_server["name"] = server_data['data']['server']
+        gofile_server["expires_at"] = time.monotonic() + GOFILE_SERVER_TTL
+        return gofile_server["name"]
+
+async def gofile_post(session, server, body, filename):
+    """Отправляет файл (файловый объект или асинхронный поток байтов) на сервер GoFile"""
+    data = aiohttp.FormData()
+    data.add_field('file', body, filename=filename)
+    
+    async with session.post(
+        f"https://{server}.gofile.io/uploadFile",
+        data=data
+    ) as response:
+        if response.status != 200:
+            raise Exception("Ошибка загрузки на GoFile")
+        
+        result = await response.json()
+        if result['status'] != 'ok':
+            raise Exception("Ошибка ответа GoFile")
+        
+        return result['data']['downloadPage']
+
 async def upload_to_gofile(file_path):
-    """Загрузка файла на GoFile"""
-    try:
-        async with aiohttp.ClientSession() as session:
+    """Загрузка файла на GoFile. Докачку GoFile не поддерживает,
+    поэтому при сбое файл отправляется заново (на другой сервер)"""
+    for attempt in range(1, UPLOAD_RETRIES + 1):
+        try:
+            session = await get_http_session()
             # Получаем сервер
-            async with session.get("https://api.gofile.io/getServer") as response:
-                if response.status != 200:
-                    raise Exception("Не удалось получить сервер GoFile")
-                
-                server_data = await response.json()
-                if server_data['status'] != 'ok':
-                    raise Exception("Ошибка API GoFile")
-                
-                server = server_data['data']['server']
+            server = await gofile_get_server(session)
             
             # Загружаем файл
-            with open(file_path, 'rb') as f:
-                data = aiohttp.FormData()
-                data.add_field('file', f, filename=os.path.basename(file_path))
-                
-                async with session.post(
-                    f"https://{server}.gofile.io/uploadFile",
-                    data=data
-                ) as response:
-                    if response.status != 200:
-                        raise Exception("Ошибка загрузки на GoFile")
-                    
-                    result = await response.json()
-                    if result['status'] != 'ok':
-                        raise Exception("Ошибка ответа GoFile")
-                    
-                    return result['data']['downloadPage']
+            f = await in_thread(open, file_path, "rb")
+            with f:
+                return await gofile_post(session, server, f, os.path.basename(file_path))
+        
+        except Exception as e:
+            gofile_server["expires_at"] = 0.0  # сервер мог выйти из строя
+            if attempt == UPLOAD_RETRIES:
+                raise Exception(f"GoFile ошибка: {str(e)}")
+            print(f"⚠️ GoFile: {e}, повтор {attempt}/{UPLOAD_RETRIES}")
+            await retry_delay(attempt)
+
+# =========================
+# ОБЛАЧНЫЕ СЕРВИСЫ
+# =========================
+class UploadBackend:
+    """Облачный сервис для файлов больше лимита Telegram.
+    Хранит скользящие оценки надёжности и скорости, по которым выбирается сервис"""
+    key = ""
+    name = ""
     
-    except Exception as e:
-        raise Exception(f"GoFile ошибка: {str(e)}")
+    def __init__(self, parallel):
+        self.limit = asyncio.Semaphore(parallel)
+        self.health = 1.0        # скользящая доля успешных загрузок
+        self.throughput = None   # скользящая скорость, байт/с
+        self.ok = 0
+        self.failed = 0
+    
+    @property
+    def enabled(self):
+        return True
+    
+    async def upload(self, file_path):
+        """Загружает файл, возвращает ссылку"""
+        raise NotImplementedError
+    
+    async def open_stream(self, filename):
+        """Готовит потоковую загрузку и возвращает корутинную функцию send(chunks) -> ссылка.
+        Ошибки подготовки возникают до чтения данных, так что можно перейти к другому сервису"""
+        raise NotImplementedError
+    
+    async def run(self, factory, size):
+        """Выполняет загрузку с ограничением параллельности и учётом результата.
+        size — функция, возвращающая число отправленных байт"""
+        async with self.limit:
+            started = time.monotonic()
+            try:
+                link = await factory()
+            except Exception:
+                # Отмена (проигрыш в гонке) сюда не попадает и здоровье не портит
+                self.observe(False)
+                metrics.inc("bot_errors_total", kind=f"upload_{self.key}")
+                raise
+            seconds = time.monotonic() - started
+            self.observe(True, size(), seconds)
+            metrics.observe("bot_cloud_upload_seconds", seconds, backend=self.key)
+            metrics.inc("bot_bytes_total", size(), direction=f"cloud_{self.key}")
+            return link
+    
+    def observe(self, ok, size=0, seconds=0.0):
+        self.health += UPLOAD_HEALTH_ALPHA * ((1.0 if ok else 0.0) - self.health)
+        if not ok:
+            self.failed += 1
+            return
+        self.ok += 1
+        if size and seconds > 0:
+            speed = size / seconds
+            if self.throughput is None:
+                self.throughput = speed
+            else:
+                self.throughput += UPLOAD_HEALTH_ALPHA * (speed - self.throughput)
+    
+    def score(self):
+        """Ожидаемая полезная скорость; неизвестную считаем типичной, чтобы сервис попробовали"""
+        return self.health * (self.throughput or UPLOAD_EXPECTED_RATE)
+    
+    def hedge_after(self, size):
+        """Сколько ждать этот сервис, прежде чем параллельно запустить следующий"""
+        expected = size / (self.throughput or UPLOAD_EXPECTED_RATE)
+        return max(UPLOAD_HEDGE_AFTER, expected * UPLOAD_HEDGE_FACTOR)
+
+class GoFileBackend(UploadBackend):
+    key = "gofile"
+    name = "GoFile"
+    
+    async def upload(self, file_path):
+        return await upload_to_gofile(file_path)
+    
+    async def open_stream(self, filename):
+        session = await get_http_session()
+        server = await gofile_get_server(session)
+        return lambda chunks: gofile_post(session, server, chunks, filename)
+
+class DriveBackend(UploadBackend):
+    key = "drive"
+    name = "Google Drive"
+    
+    @property
+    def enabled(self):
+        return drive_info is not None
+    
+    async def upload(self, file_path):
+        return await upload_to_drive(file_path)
+    
+    async def open_stream(self, filename):
+        return await drive_open_stream(filename)
+
+class LocalBackend(UploadBackend):
+    """Папка, которую раздаёт свой HTTP-сервер. Подходит для тестов и как замена облаку"""
+    key = "local"
+    name = "локальное хранилище"
+    
+    @property
+    def enabled(self):
+        return bool(LOCAL_UPLOAD_DIR)
+    
+    def target(self, filename):
+        name = f"{uuid.uuid4().hex[:8]}_{filename}"
+        return os.path.join(LOCAL_UPLOAD_DIR, name), f"{LOCAL_UPLOAD_URL.rstrip('/')}/{name}"
+    
+    async def upload(self, file_path):
+        path, link = self.target(os.path.basename(file_path))
+        loop = asyncio.get_event_loop()
+        copy = loop.run_in_executor(executor_pool, shutil.copyfile, file_path, path)
+        try:
+            await asyncio.shield(copy)
+        except BaseException:
+            # Поток копирования не прервать — убираем файл, когда он закончит
+            copy.add_done_callback(lambda _: remove_quietly(path))
+            raise
+        return link
+    
+    async def open_stream(self, filename):
+        path, link = self.target(filename)
+        
+        async def send(chunks):
+            try:
+                f = await in_thread(open, path, "wb")
+                with f:
+                    async for chunk in chunks:
+                        await in_thread(f.write, chunk)
+            except BaseException:
+                await asyncio.shield(remove_file(path))
+                raise
+            return link
+        
+        return send
+
+upload_backends = [
+    GoFileBackend(GOFILE_PARALLEL),
+    DriveBackend(DRIVE_PARALLEL),
+    LocalBackend(LOCAL_UPLOAD_PARALLEL),
+]
+
+def ranked_backends():
+    """Включённые сервисы, лучшие первыми (при равных оценках — в порядке списка)"""
+    enabled = [backend for backend in upload_backends if backend.enabled]
+    return sorted(enabled, key=lambda backend: backend.score(), reverse=True)
+
+async def race_upload(file_path, on_start=None):
+    """Загружает файл в лучший сервис. Если тот не уложился в ожидаемое время,
+    параллельно запускается следующий; первая ссылка побеждает, остальные отменяются.
+    on_start(backend, hedged) вызывается при запуске каждого сервиса.
+    Возвращает (название сервиса, ссылка)"""
+    size = await in_thread(os.path.getsize, file_path)
+    candidates = ranked_backends()
+    if not candidates:
+        raise Exception("Нет доступных облачных сервисов")
+    
+    running = {}
+    errors = []
+    hedge_due = False
+    try:
+        while candidates or running:
+            if candidates and (not running or hedge_due):
+                backend = candidates.pop(0)
+                task = asyncio.create_task(
+                    backend.run(lambda backend=backend: backend.upload(file_path), lambda: size)
+                )
+                running[task] = backend
+                log("cloud_upload_start", backend=backend.key, hedged=hedge_due)
+                if on_start:
+                    await on_start(backend, hedge_due)
+            
+            timeout = backend.hedge_after(size) if candidates else None
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            hedge_due = not done
+            for task in done:
+                finished = running.pop(task)
+                try:
+                    return finished.name, task.result()
+                except Exception as e:
+                    log("cloud_upload_failed", backend=finished.key, error=str(e))
+                    errors.append(f"{finished.name}: {e}")
+    finally:
+        # Проигравшие загрузки больше не нужны
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+    
+    raise Exception("; ".join(errors))
+
+# =========================
+# ПОТОКОВАЯ ЗАГРУЗКА В ОБЛАКО
+# =========================
+class StreamUploadError(Exception):
+    """Потоковая загрузка не удалась — задание можно повторить в файловом режиме"""
+
+async def stream_to_cloud(chunks, filename):
+    """Потоковая загрузка в лучший доступный сервис. Переключение возможно только
+    до первого прочитанного байта, поэтому гонки здесь нет.
+    Возвращает (название сервиса, ссылка)"""
+    sent = 0
+    
+    async def counted():
+        nonlocal sent
+        async for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+    
+    candidates = ranked_backends()
+    for index, backend in enumerate(candidates):
+        try:
+            send = await backend.open_stream(filename)
+        except Exception as e:
+            backend.observe(False)
+            if index == len(candidates) - 1:
+                raise
+            log("cloud_stream_unavailable", backend=backend.key, error=str(e))
+            continue
+        return backend.name, await backend.run(lambda: send(counted()), lambda: sent)
+    raise Exception("Нет доступных облачных сервисов")
+
+class StreamSpool:
+    """Приёмник потока yt-dlp: пока файл помещается в лимит Telegram — пишет на диск,
+    после превышения — отдаёт уже записанное и дальнейшие куски в облако
+    по мере скачивания, не дожидаясь конца файла"""
+
+    def __init__(self, path, limit_bytes, start_upload):
+        self.path = path
+        self.limit_bytes = limit_bytes
+        self.start_upload = start_upload
+        self.size = 0
+        self.file = None
+        self.queue = asyncio.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+        self.upload_task = None
+
+    async def open(self):
+        self.file = await in_thread(open, self.path, "wb")
+
+    async def write(self, chunk):
+        self.size += len(chunk)
+        if self.upload_task is None:
+            if self.size <= self.limit_bytes:
+                await in_thread(self.file.write, chunk)
+                return
+            # Файл не влезет в Telegram — начинаем загрузку в облако
+            await in_thread(self.file.close)
+            self.upload_task = asyncio.create_task(self.start_upload(self._chunks()))
+        
+        # Ждём место в очереди; если загрузка упала — прерываем скачивание
+        put = asyncio.ensure_future(self.queue.put(chunk))
+        await asyncio.wait({put, self.upload_task}, return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            await self._upload_result()
+            raise StreamUploadError("Загрузка завершилась раньше скачивания")
+
+    async def _chunks(self):
+        # Сначала то, что успели записать на диск, затем живой поток
+        f = await in_thread(open, self.path, "rb")
+        with f:
+            while data := await in_thread(f.read, STREAM_CHUNK_SIZE):
+                yield data
+        await in_thread(os.remove, self.path)
+        while (chunk := await self.queue.get()) is not None:
+            yield chunk
+
+    async def _upload_result(self):
+        try:
+            return await self.upload_task
+        except Exception as e:
+            raise StreamUploadError(str(e)) from e
+
+    async def finish(self):
+        """Завершает приём. Возвращает результат облачной загрузки или None, если файл на диске"""
+        if self.upload_task is None:
+            await in_thread(self.file.close)
+            return None
+        await self.queue.put(None)
+        return await self._upload_result()
+
+    async def abort(self):
+        """Прерывает загрузку (файлы удалит release_files)"""
+        if self.upload_task:
+            self.upload_task.cancel()
+        if self.file:
+            await in_thread(self.file.close)
+
+# =========================
+# КЭШ РЕЗУЛЬТАТОВ
+# =========================
+class ResultCache:
+    """Постоянный кэш: (ключ медиа, качество) -> file_id Telegram или ссылка на облако.
+    Методы вызываются из пула потоков: соединение и счётчики общие, поэтому каждый
+    метод работает под self.lock"""
+
+    def __init__(self, path, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " media_key TEXT NOT NULL,"
+            " quality TEXT NOT NULL,"
+            " kind TEXT NOT NULL,"          # video / audio / link
+            " file_id TEXT,"
+            " link TEXT,"
+            " size_mb REAL,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (media_key, quality))"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)"
+        )
+        self.conn.commit()
+
+    def get(self, media_key, quality):
+        """Возвращает запись из кэша или None (просроченные записи удаляются)"""
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT kind, file_id, link, size_mb, created_at FROM results"
+                " WHERE media_key = ? AND quality = ?",
+                (media_key, quality)
+            ).fetchone()
+
+            if row and now - row[4] > self.ttl:
+                self._delete(media_key, quality)
+                row = None
+
+            if not row:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.conn.execute(
+                "UPDATE results SET last_used = ? WHERE media_key = ? AND quality = ?",
+                (now, media_key, quality)
+            )
+            self.conn.commit()
+        return {"kind": row[0], "file_id": row[1], "link": row[2], "size_mb": row[3]}
+
+    def put(self, media_key, quality, kind, file_id=None, link=None, size_mb=0.0):
+        """Сохраняет результат и вытесняет старые записи"""
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results"
+                " (media_key, quality, kind, file_id, link, size_mb, created_at, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (media_key, quality, kind, file_id, link, size_mb, now, now)
+            )
+            self._evict(now)
+            self.conn.commit()
+
+    def invalidate(self, media_key, quality):
+        """Удаляет запись (например, если file_id перестал работать)"""
+        with self.lock:
+            self._delete(media_key, quality)
+
+    def _delete(self, media_key, quality):
+        self.conn.execute(
+            "DELETE FROM results WHERE media_key = ? AND quality = ?",
+            (media_key, quality)
+        )
+        self.conn.commit()
+
+    def _evict(self, now):
+        """Удаляет просроченные записи и самые давно использованные сверх лимита"""
+        self.conn.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl,))
+        count = self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM results WHERE rowid IN ("
+                " SELECT rowid FROM results ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def stats(self):
+        """Счётчики попаданий/промахов и размер кэша"""
+        with self.lock:
+            hits, misses = self.hits, self.misses
+            size = self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / total if total else 0.0,
+            "entries": size,
+        }
+
+result_cache = ResultCache(CACHE_DB, CACHE_TTL, CACHE_MAX_ENTRIES)
 
 # =========================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # =========================
 def extract_url_from_message(message: types.Message) -> str:
-    """Извлекает URL из сообщения (текст или entity)"""
-    # Вариант 1: Прямой текст
-    if message.text:
-        text = message.text.strip()
-        # Проверяем что это не команда
-        if not text.startswith('/'):
-            # Проверяем что это похоже на URL
-            if any(domain in text.lower() for domain in ['http://', 'https://', '.com', '.ru', '.org']):
-                return text
-    
-    # Вариант 2: URL в entities
-    if message.entities:
-        for entity in message.entities:
-            if entity.type == 'url':
-                # Извлекаем URL из текста
-                url = message.text[entity.offset:entity.offset + entity.length]
-                return url
-            elif entity.type == 'text_link':
-                # URL в text_link
-                return entity.url
+    """Извлекает URL из сообщения (первая ссылка)"""
+    urls = extract_urls_from_message(message)
+    return urls[0] if urls else None
+
+def extract_urls_from_message(message: types.Message) -> list:
+    """Все ссылки сообщения по порядку, без повторов (для пакетной загрузки)"""
+    text = message.text or ""
+    if text.startswith('/'):
+        return []
+    urls = []
+    for entity in message.entities or []:
+        if entity.type == 'url':
+            urls.append(text[entity.offset:entity.offset + entity.length])
+        elif entity.type == 'text_link':
+            urls.append(entity.url)
+    if not urls:
+        # Без entities (пересланный текст): слова со схемой или с известным доменом
+        urls = [
+            word for word in text.split()
+            if word.startswith(('http://', 'https://')) or platform_of(word)
+        ]
+    # Telegram распознаёт и ссылки без схемы ("youtu.be/...")
+    urls = [url if "://" in url else f"https://{url}" for url in urls]
+    return list(dict.fromkeys(urls))
+
+@dataclass(frozen=True)
+class Platform:
+    """Профиль платформы: как распознать ссылку, как её нормализовать и как скачивать"""
+    name: str
+    hosts: tuple                       # домены; поддомены подходят автоматически
+    ids: tuple = ()                    # регулярки: первая группа — id медиа на платформе
+    path: str = None                   # регулярка пути, если профиль — часть платформы
+    video_format: str = DEFAULT_VIDEO_FORMAT
+    user_agent: str = None
+    rate: float = 1.0                  # запусков yt-dlp в секунду (на процесс)
+    burst: int = 4
+    timeout: int = 600                 # s, минимальный бюджет скачивания (см. download_budget)
+
+    @property
+    def cookies(self):
+        """cookies.txt платформы (COOKIES_DIR/<name>.txt), если он есть"""
+        path = os.path.join(COOKIES_DIR, f"{self.name.split('-')[0]}.txt")
+        return path if os.path.exists(path) else None
+
+BROWSER_UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+
+# Порядок важен внутри хоста: более узкий профиль (по path) — раньше
+PLATFORMS = {profile.name: profile for profile in (
+    Platform(
+        "youtube-shorts", ("youtube.com",), path=r"^/shorts/",
+        ids=(r"/shorts/([\w-]{11})",), video_format="best", rate=2.0
+    ),
+    Platform(
+        "youtube", ("youtube.com", "youtu.be", "youtube-nocookie.com"),
+        ids=(r"[?&]v=([\w-]{11})", r"youtu\.be/([\w-]{11})", r"/(?:live|embed|v)/([\w-]{11})"),
+        rate=2.0, timeout=900
+    ),
+    Platform(
+        "instagram", ("instagram.com", "instagr.am"),
+        ids=(r"/(?:p|reels?|tv)/([\w-]+)",), video_format="best", user_agent=BROWSER_UA,
+        rate=0.3, burst=2  # банит IP за частые запросы
+    ),
+    Platform("tiktok", ("tiktok.com",), ids=(r"/video/(\d+)",), rate=0.5, burst=2),
+    Platform(
+        "facebook", ("facebook.com", "fb.watch", "fb.com"),
+        ids=(r"[?&]v=(\d+)", r"/(?:videos|reel)/(\d+)"), rate=0.5, burst=2
+    ),
+    Platform("vk", ("vk.com", "vkvideo.ru"), ids=(r"video(-?\d+_\d+)",)),
+    Platform("twitter", ("twitter.com", "x.com"), ids=(r"/status/(\d+)",), rate=0.5, burst=2),
+    Platform("reddit", ("reddit.com", "redd.it"), ids=(r"/comments/(\w+)",)),
+    Platform(
+        "twitch", ("twitch.tv",),
+        ids=(r"/videos/(\d+)", r"clips\.twitch\.tv/([\w-]+)", r"/clip/([\w-]+)"), timeout=1800
+    ),
+)}
+# Ссылки вне реестра (элементы плейлистов и т.п.) — общий профиль yt-dlp
+GENERIC_PLATFORM = Platform("generic", ())
+
+# Хост → профили; регулярки компилируются один раз
+PLATFORM_HOSTS = {}
+for _profile in PLATFORMS.values():
+    for _host in _profile.hosts:
+        PLATFORM_HOSTS.setdefault(_host, []).append(_profile)
+PLATFORM_PATHS = {name: re.compile(profile.path) for name, profile in PLATFORMS.items() if profile.path}
+PLATFORM_IDS = {name: [re.compile(pattern) for pattern in profile.ids] for name, profile in PLATFORMS.items()}
+YOUTUBE_PLAYLIST = re.compile(r"[?&]list=([\w-]+)")
+
+def url_host(url: str) -> str:
+    """Хост ссылки без www./m. и порта ("" — если это не ссылка)"""
+    parts = urlsplit(url.strip() if "://" in url else f"https://{url.strip()}")
+    host = parts.netloc.lower().split(":")[0]
+    for prefix in ("www.", "m.", "mobile."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    return host
+
+def platform_of(url: str):
+    """Профиль платформы по URL или None, если не поддерживается"""
+    if not url:
+        return None
     
+    # a.b.youtube.com → a.b.youtube.com, b.youtube.com, youtube.com
+    labels = url_host(url).split(".")
+    for i in range(len(labels) - 1):
+        profiles = PLATFORM_HOSTS.get(".".join(labels[i:]))
+        if profiles:
+            path = urlsplit(url if "://" in url else f"https://{url}").path
+            for profile in profiles:
+                if profile.path is None or PLATFORM_PATHS[profile.name].search(path):
+                    return profile
     return None
 
-def is_supported_url(url: str) -> bool:
-    """Проверяет поддерживается ли URL"""
-    if not url:
-        return False
-    
-    supported_domains = [
-        'youtube.', 'youtu.be', 
-        'instagram.', 'insta',
-        'tiktok.', 
-        'facebook.', 'fb.watch', 'fb.com',
-        'vk.com',
-        'twitter.', 'x.com',
-        'reddit.com',
-        'twitch.tv'
-    ]
-    
-    url_lower = url.lower()
-    return any(domain in url_lower for domain in supported_domains)
+def is_supported_url(url: str) -> bool:
+    """Проверяет поддерживается ли URL"""
+    return platform_of(url) is not None
+
+def canonical_media_key(url: str) -> str:
+    """Нормализует URL в стабильный ключ медиа (для кэша и дедупликации):
+    "<платформа>:<id>", иначе — хост + путь"""
+    profile = platform_of(url)
+    if profile:
+        platform = profile.name.split("-")[0]  # youtube-shorts — то же видео, что youtube
+        for pattern in PLATFORM_IDS[profile.name]:
+            match = pattern.search(url)
+            if match:
+                return f"{platform}:{match.group(1)}"
+        if platform == "youtube":
+            match = YOUTUBE_PLAYLIST.search(url)
+            if match:
+                return f"youtube-playlist:{match.group(1)}"
+    
+    # Остальное: хост + путь без query/fragment (трекинговые параметры)
+    return f"{url_host(url)}{urlsplit(url.strip()).path.rstrip('/')}"
+
+# =========================
+# ФАЙЛЫ
+# =========================
+# Всё, что трогает диск (поиск, удаление, открытие, запись), выполняется в пуле
+# потоков: на медленном или занятом томе даже unlink большого файла блокирует
+# event loop на десятки миллисекунд
+async def in_thread(func, *args):
+    """Блокирующий вызов в пуле потоков"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor_pool, func, *args)
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+async def remove_file(path):
+    """remove_quietly в пуле потоков"""
+    await in_thread(remove_quietly, path)
+
+def job_dir(job_id: str):
+    """Папка задания: все его файлы лежат в DOWNLOAD_DIR/{job_id}/"""
+    return os.path.join(DOWNLOAD_DIR, job_id)
+
+def job_prefix(job_id: str):
+    """Префикс файлов задания: {job_id}_* (скачанное) и {job_id}.* (служебные)"""
+    return os.path.join(job_dir(job_id), job_id)
+
+def make_job_dir(job_id: str):
+    os.makedirs(job_dir(job_id), exist_ok=True)
+
+def job_files(job_id: str):
+    """Скачанные файлы задания ({job_id}_*) — листинг одной папки, без glob по всему тому"""
+    try:
+        with os.scandir(job_dir(job_id)) as entries:
+            return sorted(
+                entry.path for entry in entries
+                if entry.name.startswith(f"{job_id}_") and entry.is_file()
+            )
+    except FileNotFoundError:
+        return []
+
+def remove_job_parts(job_id: str):
+    """Удаляет недокачанные части задания (служебные {job_id}.* остаются)"""
+    for path in job_files(job_id):
+        remove_quietly(path)
+
+def tree_usage(path):
+    """(файлов, байт, последнее изменение) в папке задания"""
+    files = size = 0
+    mtime = os.stat(path).st_mtime
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            files += 1
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime)
+    return files, size, mtime
+
+# Файлы задания (папка DOWNLOAD_DIR/{job_id}/) нужны всем, кто ждёт его результат.
+# {job_id: {user_id}} — файлы удаляются, когда последний пользователь их отпустил
+file_refs = {}
+
+def hold_files(job_id: str, user_id: int):
+    """Пользователь ждёт файлы задания"""
+    file_refs.setdefault(job_id, set()).add(user_id)
+
+async def release_files(job_id: str, user_id: int):
+    """Пользователю файлы задания больше не нужны; удаляет их, если никому не нужны"""
+    users = file_refs.get(job_id)
+    if users is not None:
+        users.discard(user_id)
+        if users:
+            return
+        del file_refs[job_id]
+    await remove_job_files(job_id)
+
+async def remove_job_files(job_id: str):
+    """Удаляет папку задания (в пуле потоков — не блокируя event loop)"""
+    await in_thread(remove_job_files_sync, job_id)
+
+def remove_job_files_sync(job_id: str):
+    path = job_dir(job_id)
+    if not os.path.isdir(path):
+        return
+    try:
+        shutil.rmtree(path)
+        print(f"🗑️ Удалены файлы задания: {path}")
+    except Exception as e:
+        print(f"⚠️ Не удалось удалить {path}: {e}")
+
+async def cleanup_user_files(user_id: int):
+    """Отпускает все файлы пользователя (общие с другими пользователями остаются)"""
+    for job_id in [job_id for job_id, users in file_refs.items() if user_id in users]:
+        await release_files(job_id, user_id)
+
+async def cancel_user_jobs(user_id: int):
+    """Отменяет задания пользователя в этом процессе (ожидающих передаёт другим)"""
+    for job in await scheduler.cancel_user(user_id):
+        await promote_followers(job)
+    await detach_follower(user_id)
+
+async def clear_user_state(user_id: int):
+    """Очищает состояние пользователя"""
+    await user_urls.delete(user_id)
+    await user_locks.delete(user_id)
+
+@asynccontextmanager
+async def upload_source(file_path):
+    """Файл для send_video/send_audio. Локальному Bot API передаём путь file://
+    (сервер читает файл с общего тома сам), публичному — содержимое файла
+    (открывается в пуле потоков, читает его aiohttp тоже не на event loop)"""
+    if BOT_API_LOCAL:
+        relative = os.path.relpath(os.path.abspath(file_path), os.path.abspath(DOWNLOAD_DIR))
+        yield "file://" + os.path.join(BOT_API_FILES_DIR, relative)
+    else:
+        f = await in_thread(open, file_path, "rb")
+        try:
+            yield f
+        finally:
+            await in_thread(f.close)
+
+def quality_label(quality):
+    """Подпись качества по ключу кэша: высоты файла в кэше нет, есть выбранное качество"""
+    if quality.isdigit():
+        return f"{quality}p"
+    if quality == "fit":
+        return f"Сжато до {TELEGRAM_VIDEO_LIMIT} MB"
+    return "Лучшее качество"
+
+async def send_cached_result(job, cached: dict) -> bool:
+    """Отправляет результат из кэша по file_id / ссылке. False — если не удалось"""
+    size_mb = cached["size_mb"] or 0
+    label = quality_label(job.quality)
+    try:
+        if cached["kind"] == "video":
+            await bot.send_video(
+                job.chat_id,
+                cached["file_id"],
+                caption=f"🎬 {label} | {size_mb:.1f} MB",
+                supports_streaming=True
+            )
+        elif cached["kind"] == "audio":
+            await bot.send_audio(
+                job.chat_id,
+                cached["file_id"],
+                caption=f"🎵 Аудио | {size_mb:.1f} MB"
+            )
+        elif cached["kind"] == "document":
+            await bot.send_document(
+                job.chat_id,
+                cached["file_id"],
+                caption=f"🎬 {label} | {size_mb:.1f} MB"
+            )
+        else:
+            await bot.edit_message_text(
+                f"✅ <b>Файл уже загружен!</b>\n\n"
+                f"📦 Размер: {size_mb:.1f} MB\n"
+                f"🔗 Ссылка:\n<code>{cached['link']}</code>",
+                chat_id=job.chat_id,
+                message_id=job.message_id,
+                parse_mode="HTML"
+            )
+            return True
+    except Exception as e:
+        print(f"⚠️ Кэш не сработал: {e}")
+        return False
+    
+    await delete_status(job)
+    return True
+
+# =========================
+# ИСХОДЯЩИЕ ЗАПРОСЫ
+# =========================
+class Egress:
+    """Выход в интернет для yt-dlp: напрямую, через прокси или с другого IP сервера.
+    Здоровье считается по платформам: 429 от Instagram не мешает YouTube"""
+
+    def __init__(self, name, proxy=None, source_address=None):
+        self.name = name
+        self.proxy = proxy
+        self.source_address = source_address
+        self.strikes = {}  # {платформа: 429/403 подряд}
+        self.benched = {}  # {платформа: monotonic, до которого выход снят}
+        self.penalty = {}  # {платформа: длительность следующего снятия}
+        self.ok = 0
+        self.failed = 0
+        self.last_used = 0.0
+
+    def options(self):
+        """Параметры YoutubeDL для этого выхода"""
+        options = {}
+        if self.proxy:
+            options["proxy"] = self.proxy
+        if self.source_address:
+            options["source_address"] = self.source_address
+        return options
+
+    def available(self, platform):
+        return self.benched.get(platform, 0) <= time.monotonic()
+
+    def succeeded(self, platform):
+        self.ok += 1
+        self.strikes.pop(platform, None)
+        self.penalty.pop(platform, None)
+
+    def limited(self, platform):
+        """Платформа ответила 429/403; после EGRESS_BENCH_AFTER подряд — снимаем выход"""
+        self.failed += 1
+        metrics.inc("bot_egress_limited_total", egress=self.name, platform=platform)
+        self.strikes[platform] = self.strikes.get(platform, 0) + 1
+        if self.strikes[platform] >= EGRESS_BENCH_AFTER:
+            penalty = self.penalty.get(platform, EGRESS_BENCH_SECONDS)
+            self.benched[platform] = time.monotonic() + penalty
+            self.penalty[platform] = min(penalty * 2, 3600)
+            self.strikes[platform] = 0
+            metrics.inc("bot_egress_benched_total", egress=self.name, platform=platform)
+            log("egress_benched", egress=self.name, platform=platform, seconds=penalty)
+
+def make_egress(number, spec):
+    """Выход из строки PROXIES: direct, URL прокси или IP-адрес сервера"""
+    if spec == "direct":
+        return Egress("direct")
+    if "://" in spec:
+        return Egress(f"proxy{number}", proxy=spec)  # в имени (метки метрик) — без пароля
+    return Egress(spec, source_address=spec)
+
+egress_pool = [make_egress(number, spec) for number, spec in enumerate(PROXIES, 1)] or [Egress("direct")]
+
+def egress_named(name):
+    """Выход по имени (им извлекались метаданные) или None"""
+    return next((egress for egress in egress_pool if egress.name == name), None)
+
+def pick_egress(platform, prefer=None, exclude=()):
+    """Выход для запроса к платформе: prefer (им извлекались метаданные — ссылки на
+    форматы бывают привязаны к IP), иначе дольше всех не использованный из доступных.
+    Если сняты все — тот, что вернётся раньше"""
+    candidates = [egress for egress in egress_pool if egress.name not in exclude] or egress_pool
+    available = [egress for egress in candidates if egress.available(platform)]
+    preferred = [egress for egress in available if egress.name == prefer]
+    if preferred:
+        egress = preferred[0]
+    elif available:
+        egress = min(available, key=lambda egress: egress.last_used)
+    else:
+        egress = min(candidates, key=lambda egress: egress.benched.get(platform, 0))
+    egress.last_used = time.monotonic()
+    return egress
+
+# {(платформа, выход): TokenBucket} — лимит платформы считается на каждый IP
+platform_buckets = {}
+
+async def platform_turn(profile, egress):
+    """Ждёт очереди на запрос к платформе с этого выхода (под нагрузкой иначе банят IP)"""
+    name = profile.name.split("-")[0]
+    bucket = platform_buckets.get((name, egress.name))
+    if bucket is None:
+        bucket = platform_buckets[(name, egress.name)] = TokenBucket(profile.rate, profile.burst)
+    if not bucket.take():
+        metrics.inc("bot_platform_throttled_total", platform=name)
+        while not bucket.take():
+            await asyncio.sleep(bucket.delay())
+
+# =========================
+# МЕСТО НА ДИСКЕ
+# =========================
+class DiskFull(Exception):
+    """Места под задание нет и за отведённое время не освободилось"""
+
+class DiskManager:
+    """Бюджет места в DOWNLOAD_DIR: задание резервирует оценку размера до скачивания
+    и ждёт, пока бюджет позволит. Файлы без владельца периодически удаляются.
+    shares() — сколько процессов делят том (воркеры): каждому достаётся своя доля
+    бюджета и в занятое засчитываются только файлы его заданий"""
+
+    def __init__(self, path, budget, keep_free, shares=None):
+        self.path = path
+        self.budget = budget
+        self.keep_free = keep_free
+        self.shares = shares
+        self.share_count = 1
+        self.limit = budget or float("inf")  # до start() без ограничений
+        self.reservations = {}  # {job_id: байт}
+        self.usage = 0          # байт в папке по последнему сканированию
+        self.untracked = 0      # из них — файлы заданий без резерва
+        self.waiting = 0
+        self._cond = asyncio.Condition()
+        self._gc_task = None
+
+    @property
+    def committed(self):
+        return sum(self.reservations.values()) + self.untracked
+
+    def fits(self, size):
+        return self.committed + size <= self.limit
+
+    async def start(self, max_age):
+        """Первая сборка мусора, расчёт бюджета и фоновая сборка по таймеру"""
+        await self.collect(max_age)
+        self._gc_task = asyncio.create_task(self._gc_loop())
+
+    async def stop(self):
+        if self._gc_task:
+            self._gc_task.cancel()
+
+    async def reserve(self, job_id, size, timeout, on_wait=None):
+        """Резервирует size байт; ждёт до timeout. DiskFull — если не дождались.
+        on_wait() вызывается, если места сразу нет"""
+        if size > self.limit:
+            raise DiskFull(f"Нужно {size} байт при бюджете {self.limit}")
+        if not self.fits(size):
+            if on_wait:
+                await on_wait()
+            self.waiting += 1
+            try:
+                async with self._cond:
+                    await asyncio.wait_for(self._cond.wait_for(lambda: self.fits(size)), timeout)
+            except asyncio.TimeoutError:
+                raise DiskFull(f"Нет {size} байт за {timeout} s")
+            finally:
+                self.waiting -= 1
+        # Между проверкой и записью нет await — резерв атомарен для event loop
+        self.reservations[job_id] = size
+
+    async def release(self, job_id):
+        if self.reservations.pop(job_id, None) is not None:
+            async with self._cond:
+                self._cond.notify_all()
+
+    async def collect(self, max_age):
+        """Удаляет файлы заданий, которые никто не ждёт и которые старше max_age s.
+        Сканирование и удаление — в пуле потоков"""
+        live = set(file_refs) | set(self.reservations)
+        loop = asyncio.get_event_loop()
+        usage, untracked, removed, freed, total, shares = await loop.run_in_executor(
+            executor_pool, self._scan, live, max_age
+        )
+        self.usage, self.untracked = usage, untracked
+        # Кэш обложек лежит вне DOWNLOAD_DIR, но чистится той же сборкой
+        thumbs = await loop.run_in_executor(executor_pool, prune_thumbs, THUMB_CACHE_SIZE, THUMB_MAX_AGE)
+        if thumbs:
+            log("thumbs_gc", files=thumbs)
+        # Бюджет пересчитывается при каждой сборке: число воркеров меняется
+        self.share_count = shares
+        self.limit = total / shares
+        if removed:
+            metrics.inc("bot_disk_gc_files_total", removed)
+            metrics.inc("bot_disk_gc_bytes_total", freed)
+            log("disk_gc", files=removed, bytes=freed)
+        async with self._cond:
+            self._cond.notify_all()
+
+    def _scan(self, live, max_age):
+        usage = untracked = removed = freed = 0
+        now = time.time()
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                try:
+                    # Папки заданий {job_id}/ (и файлы {job_id}_* прежней плоской раскладки)
+                    job_id = entry.name[:12]
+                    if entry.is_dir(follow_symlinks=False):
+                        files, size, mtime = tree_usage(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        files, size, mtime = 1, stat.st_size, stat.st_mtime
+                    else:
+                        continue
+                    if job_id not in live and now - mtime >= max_age:
+                        if entry.is_dir(follow_symlinks=False):
+                            shutil.rmtree(entry.path)
+                        else:
+                            os.remove(entry.path)
+                        removed += files
+                        freed += size
+                        continue
+                except OSError:
+                    continue
+                usage += size
+                # Файлы чужих заданий (другие воркеры) — в их долях бюджета
+                if job_id not in self.reservations and (self.shares is None or job_id in live):
+                    untracked += size
+        if self.budget:
+            total = self.budget
+        else:
+            # Без явного бюджета — всё, что есть на томе, минус запас
+            total = max(0, shutil.disk_usage(self.path).free + usage - self.keep_free)
+        shares = max(1, self.shares()) if self.shares else 1
+        return usage, untracked, removed, freed, total, shares
+
+    async def _gc_loop(self):
+        while True:
+            await asyncio.sleep(DISK_GC_INTERVAL)
+            try:
+                await self.collect(DISK_FILE_MAX_AGE)
+            except Exception as e:
+                log("disk_gc_failed", error=str(e))
+
+# Воркеры на общем томе делят бюджет по числу живых процессов в журнале
+disk = DiskManager(
+    DOWNLOAD_DIR, DISK_BUDGET_MB * 1024 * 1024, DISK_KEEP_FREE_MB * 1024 * 1024,
+    shares=(lambda: journal.live_owners()) if ROLE == "worker" else None
+)
+
+def disk_estimate(job, merge, streaming):
+    """Сколько места займёт задание (байт)"""
+    limit_bytes = TELEGRAM_VIDEO_LIMIT * 1024 * 1024
+    if streaming and job.expected_bytes > limit_bytes:
+        return 0  # сразу уходит в облако, минуя диск
+    size = job.expected_bytes or DISK_DEFAULT_JOB_MB * 1024 * 1024
+    if merge:
+        size *= 2  # видео и аудио по отдельности плюс объединённый файл
+    return size
+
+# =========================
+# КОМАНДЫ
+# =========================
+@dp.message_handler(commands=["start", "help"])
+async def start(message: types.Message):
+    """Команда /start и /help"""
+    user_id = message.from_user.id
+    # Очищаем старое состояние при /start
+    await clear_user_state(user_id)
+    await cleanup_user_files(user_id)
+    
+    await message.answer(
+        "👋 <b>Привет! Я скачиваю видео из соцсетей</b>\n\n"
+        "📱 <b>Поддерживаю:</b>\n"
+        "• YouTube / YouTube Shorts\n"
+        "• Instagram / Reels\n"
+        "• TikTok\n"
+        "• Facebook\n"
+        "• VK, Twitter/X, Reddit, Twitch\n\n"
+        "🎯 <b>Как пользоваться:</b>\n"
+        "1. Отправь мне ссылку на видео\n"
+        "2. Выбери формат (видео или аудио)\n"
+        "3. Получи файл!\n\n"
+        "💡 <b>Возможности:</b>\n"
+        "🎬 Видео в лучшем качестве\n"
+        "🎵 Только аудио\n"
+        "☁️ Большие файлы → GoFile/Drive\n\n"
+        "⚡ Быстро и просто!\n\n"
+        "🔧 Команды:\n"
+        "/cancel - отменить текущее скачивание"
+        + ("\n/stats - статистика" if user_id in ADMIN_IDS else ""),
+        parse_mode="HTML"
+    )
+
+@dp.message_handler(commands=["cancel"])
+async def cancel(message: types.Message):
+    """Команда /cancel - отмена скачивания"""
+    user_id = message.from_user.id
+    if ROLE == "front":
+        # Задания выполняют воркеры — они увидят отметку и отменят сами
+        await state.set(f"cancel:{user_id}", time.time(), ttl=LOCK_TTL)
+    await cancel_user_jobs(user_id)
+    await clear_user_state(user_id)
+    await cleanup_user_files(user_id)
+    await message.answer(
+        "✅ Скачивание отменено\n\n"
+        "Можешь отправить новую ссылку"
+    )
+
+@dp.message_handler(commands=["stats"])
+async def stats(message: types.Message):
+    """Команда /stats - статистика кэша и очереди (только для ADMIN_IDS:
+    в ней адреса выходов и состояние облаков)"""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔ Команда доступна только администраторам")
+        return
+    cache_stats = await in_thread(result_cache.stats)
+    await message.answer(
+        f"📊 <b>Кэш</b>\n\n"
+        f"Попаданий: {cache_stats['hits']}\n"
+        f"Промахов: {cache_stats['misses']}\n"
+        f"Hit ratio: {cache_stats['hit_ratio']:.0%}\n"
+        f"Записей: {cache_stats['entries']}\n\n"
+        f"🕒 <b>Очередь</b>\n\n"
+        f"В очереди: {await state.size('jobs') if ROLE == 'front' else scheduler.queued}/{scheduler.max_queue}\n"
+        f"Выполняется: {len(scheduler.active)}\n"
+        f"Скорость: {sum(p['speed'] for p in scheduler.progress_snapshot()) / (1024 * 1024):.1f} MB/s\n"
+        f"Среднее время задания: {scheduler.avg_job_time:.0f} s\n\n"
+        f"💾 <b>Диск</b>: {disk.usage / 1024**3:.1f} GB занято, "
+        f"{sum(disk.reservations.values()) / 1024**3:.1f} GB в резерве, "
+        f"ждут места: {disk.waiting}"
+        + "".join(
+            f"\n\n☁️ <b>{backend.name}</b>: {backend.ok} ок, {backend.failed} ошибок, "
+            f"здоровье {backend.health:.0%}, {(backend.throughput or 0) / (1024 * 1024):.1f} MB/s"
+            for backend in upload_backends if backend.enabled
+        )
+        + "".join(
+            f"\n\n🌐 <b>{egress.name}</b>: {egress.ok} ок, {egress.failed} лимитов"
+            + "".join(
+                f", снят для {platform} ещё {(until - time.monotonic()) / 60:.0f} мин"
+                for platform, until in egress.benched.items() if until > time.monotonic()
+            )
+            for egress in egress_pool if len(egress_pool) > 1
+        ),
+        parse_mode="HTML"
+    )
+
+# =========================
+# ОБРАБОТКА ССЫЛКИ
+# =========================
+@dp.message_handler(content_types=['text'])
+async def handle_url(message: types.Message):
+    """Обработка текстовых сообщений с URL"""
+    # Игнорируем команды
+    if message.text and message.text.startswith('/'):
+        return
+    
+    # Несколько ссылок — пакет
+    urls = [url for url in extract_urls_from_message(message) if platform_of(url)]
+    if len(urls) > 1:
+        log("message", user_id=message.from_user.id, username=message.from_user.username,
+            urls=len(urls), platform="batch")
+        metrics.inc("bot_requests_total", platform="batch")
+        await offer_batch(message, urls[:BATCH_MAX_ITEMS])
+        return
+    
+    # Извлекаем URL
+    url = urls[0] if urls else extract_url_from_message(message)
+    profile = platform_of(url)
+    platform = profile.name if profile else None
+    log("message", user_id=message.from_user.id, username=message.from_user.username,
+        url=url, platform=platform)
+    metrics.inc("bot_requests_total", platform=platform or ("unsupported" if url else "no_url"))
+    
+    if not url:
+        await message.answer(
+            "❌ Не могу найти ссылку в сообщении\n\n"
+            "Отправь мне прямую ссылку на видео"
+        )
+        return
+    
+    # Проверяем поддержку
+    if not profile:
+        await message.answer(
+            "❌ Эта платформа не поддерживается\n\n"
+            "📱 Поддерживаю:\n"
+            "• YouTube\n"
+            "• Instagram\n"
+            "• TikTok\n"
+            "• Facebook\n"
+            "• VK, Twitter, Reddit, Twitch"
+        )
+        return
+    
+    user_id = message.from_user.id
+    
+    # Очищаем старые файлы и блокировку при новой ссылке
+    await cleanup_user_files(user_id)
+    await user_locks.delete(user_id)
+    
+    # Сохраняем новый URL
+    await user_urls.set(user_id, url)
+    
+    # Метаданные запрашиваются сразу; скачивание потом их переиспользует
+    status = await message.answer("🔍 Получаю информацию о видео...")
+    info = await get_info(url, timeout=INFO_TIMEOUT)
+    
+    # Плейлист или канал — пакет из его записей
+    if info and info.get("_type") == "playlist":
+        entries = [
+            entry.get("url") or entry.get("webpage_url")
+            for entry in info.get("entries") or [] if entry
+        ]
+        await offer_batch(message, [url for url in entries if url][:BATCH_MAX_ITEMS],
+                          title=info.get("title"), status=status)
+        return
+    
+    # Создаём меню выбора
+    keyboard, text = format_keyboard(info)
+    await status.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+
+async def offer_batch(message: types.Message, urls: list, title=None, status=None):
+    """Запоминает ссылки пакета и предлагает выбрать формат для всех сразу"""
+    user_id = message.from_user.id
+    if not urls:
+        text = "❌ В плейлисте не найдено видео"
+        await (status.edit_text(text) if status else message.answer(text))
+        return
+    
+    await cleanup_user_files(user_id)
+    await user_locks.delete(user_id)
+    await user_urls.set(user_id, urls)
+    
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        InlineKeyboardButton("🎬 Видео (лучшее)", callback_data="quality_best"),
+        InlineKeyboardButton("🎵 Аудио", callback_data="quality_audio")
+    )
+    text = "📚 <b>Пакетная загрузка</b>\n\n"
+    if title:
+        text += f"📋 {html.escape(title[:200])}\n"
+    text += (
+        f"🔢 Видео: {len(urls)}"
+        + (f" (первые {BATCH_MAX_ITEMS})" if len(urls) == BATCH_MAX_ITEMS else "")
+        + "\n\nПришлю альбомами, большие файлы — ссылками на облако.\n"
+        "🎯 <b>Выбери формат:</b>"
+    )
+    if status:
+        await status.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+    else:
+        await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
+
+# =========================
+# ОБНОВЛЕНИЕ СТАТУСОВ
+# =========================
+class TokenBucket:
+    """Токен-бакет: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """Забирает токен, если он есть"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self):
+        """Через сколько секунд появится токен"""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    @property
+    def full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+class StatusUpdater:
+    """Редактирование статусов с учётом лимитов Telegram: токен-бакет на чат
+    и общий, из нескольких обновлений одного сообщения отправляется последнее"""
+
+    def __init__(self, chat_interval, global_rate):
+        self.chat_interval = chat_interval
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.buckets = {}  # {chat_id: TokenBucket}
+        self.pending = OrderedDict()  # {(chat_id, message_id): text}
+        self.inflight = {}  # {(chat_id, message_id): Task}
+        self.blocked_until = 0.0  # флуд-контроль Telegram (RetryAfter)
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def offer(self, chat_id, message_id, text):
+        """Ставит текст на отправку; предыдущий неотправленный текст заменяется"""
+        self.pending[(chat_id, message_id)] = text
+        self._wakeup.set()
+
+    async def settle(self, chat_id, message_id):
+        """Отменяет ожидающие обновления сообщения и дожидается отправляемого —
+        чтобы финальный статус не был перезаписан прогрессом"""
+        key = (chat_id, message_id)
+        self.pending.pop(key, None)
+        task = self.inflight.get(key)
+        if task:
+            await asyncio.wait([task])
+        self._bucket(chat_id).take()
+
+    def _bucket(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.buckets[chat_id] = TokenBucket(1 / self.chat_interval, 1)
+        return bucket
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.pending:
+                wait = self.blocked_until - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                wait = 1.0
+                for key in list(self.pending):
+                    if key in self.inflight:
+                        continue
+                    bucket = self._bucket(key[0])
+                    if bucket.delay() > 0:
+                        wait = min(wait, bucket.delay())
+                        continue
+                    if not self.global_bucket.take():
+                        wait = min(wait, self.global_bucket.delay())
+                        break
+                    bucket.take()
+                    text = self.pending.pop(key)
+                    self.inflight[key] = asyncio.create_task(self._edit(key, text))
+                if self.pending:
+                    await asyncio.sleep(max(wait, 0.05))
+            # Полные бакеты ничем не отличаются от новых — не храним их
+            if len(self.buckets) > 10000:
+                self.buckets = {k: b for k, b in self.buckets.items() if not b.full}
+
+    async def _edit(self, key, text):
+        try:
+            await bot.edit_message_text(text, chat_id=key[0], message_id=key[1])
+        except RetryAfter as e:
+            print(f"⚠️ Флуд-контроль Telegram: пауза {e.timeout} s")
+            self.blocked_until = time.monotonic() + e.timeout
+        except Exception:
+            pass  # MessageNotModified, сообщение удалено и т.п.
+        finally:
+            self.inflight.pop(key, None)
+
+status_updater = StatusUpdater(PROGRESS_EDIT_INTERVAL, GLOBAL_EDIT_RATE)
+
+def parse_progress(line):
+    """Разбирает строку PROGRESS_TEMPLATE -> (скачано, всего, скорость, eta) или None"""
+    if not line.startswith("[progress] "):
+        return None
+    
+    def number(value):
+        try:
+            return float(value)
+        except ValueError:  # "NA"
+            return 0.0
+    
+    values = [number(v) for v in line.split()[1:6]]
+    if len(values) != 5:
+        return None
+    downloaded, total, estimate, speed, eta = values
+    return int(downloaded), int(total or estimate), speed, int(eta)
+
+def track_progress(job, line):
+    """Обновляет прогресс задания по строке вывода yt-dlp. True — если это строка прогресса"""
+    progress = parse_progress(line)
+    if progress is None:
+        return False
+    apply_progress(job, progress)
+    return True
+
+def apply_progress(job, progress):
+    """Сохраняет прогресс (скачано, всего, скорость, eta) и обновляет статус.
+    bot_bytes_total растёт по мере скачивания, а не в конце задания"""
+    if progress[0] < job.downloaded_bytes:
+        job.part += 1  # начался следующий формат
+        job.metered_bytes = 0
+    if progress[0] > job.metered_bytes:
+        metrics.inc("bot_bytes_total", progress[0] - job.metered_bytes, direction="download")
+        job.metered_bytes = progress[0]
+    job.downloaded_bytes, job.total_bytes, job.speed, job.eta = progress
+    offer_status(job, progress_text(job))
+
+def progress_text(job):
+    """Текст статуса со строкой прогресса"""
+    mb = 1024 * 1024
+    lines = [job.status_line]
+    if job.total_bytes:
+        percent = job.downloaded_bytes / job.total_bytes * 100
+        lines.append(
+            f"⬇️ {percent:.0f}% ({job.downloaded_bytes / mb:.1f}/{job.total_bytes / mb:.1f} MB)"
+        )
+    else:
+        lines.append(f"⬇️ {job.downloaded_bytes / mb:.1f} MB")
+    if job.part > 1:
+        lines[-1] += f" · часть {job.part}"
+    if job.speed:
+        minutes, seconds = divmod(job.eta, 60)
+        lines.append(f"🚀 {job.speed / mb:.1f} MB/s · ⏱ {minutes}:{seconds:02d}")
+    return "\n".join(lines)
+
+async def read_stderr(job, stream):
+    """Читает stderr yt-dlp: прогресс — в задание, остальное (хвост) — для разбора ошибок"""
+    tail = deque(maxlen=200)
+    async for raw_line in stream:
+        line = raw_line.decode("utf-8", errors="ignore")
+        if not track_progress(job, line):
+            tail.append(line)
+    return "".join(tail).encode()
+
+# =========================
+# ПЛАНИРОВЩИК ЗАДАНИЙ
+# =========================
+@dataclass
+class Job:
+    """Задание на скачивание и отправку одного файла"""
+    user_id: int
+    chat_id: int
+    message_id: int  # статусное сообщение, которое редактируем
+    url: str
+    quality: str
+    job_id: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    created_at: float = field(default_factory=time.time)
+    started_at: float = 0.0
+    stage: str = "queued"
+    position: int = -1
+    task: asyncio.Task = None
+    # Прогресс скачивания (из вывода yt-dlp)
+    status_line: str = "⏳ Скачиваю..."
+    downloaded_bytes: int = 0
+    total_bytes: int = 0
+    speed: float = 0.0
+    eta: int = 0
+    part: int = 1  # номер скачиваемого формата (видео, затем аудио)
+    metered_bytes: int = 0  # байты текущего формата, уже учтённые в bot_bytes_total
+    expected_bytes: int = 0  # оценка размера по метаданным
+    transfer_seconds: float = 0.0  # время работы yt-dlp — для оценки скорости площадки
+    merging: bool = False  # yt-dlp сливает дорожки: байтов больше не будет, сторож не ждёт их
+    media: dict = None  # поля MEDIA_FIELDS выбранного формата (от yt-dlp или ffprobe)
+    # Дедупликация: задания других пользователей, ждущие этот же файл
+    followers: list = field(default_factory=list)
+    result: dict = None  # {"kind", "file_id", "link", "size_mb"} после отправки
+    error: str = None  # класс ошибки, если задание не удалось
+    stage_started: dict = field(default_factory=dict)  # {стадия: начало} для метрик
+    items: list = None  # ссылки пакета; у одиночного задания None
+    platform: str = None  # имя профиля в PLATFORMS (определяется при создании)
+    interrupted: bool = False  # прервано остановкой бота — продолжится после запуска
+
+    @property
+    def profile(self):
+        return PLATFORMS.get(self.platform) or platform_of(self.url) or GENERIC_PLATFORM
+
+class QueueFull(Exception):
+    """Очередь переполнена — задание не принято"""
+
+    def __init__(self, eta):
+        super().__init__(f"Очередь переполнена, ожидание ~{eta:.0f} s")
+        self.eta = eta
+
+class DownloadScheduler:
+    """Ограниченная очередь заданий: пул воркеров, round-robin между пользователями
+    и отдельные лимиты на стадии download / merge / upload"""
+
+    def __init__(self, workers, max_queue, download_slots, merge_slots, upload_slots):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.stages = {
+            "extract": asyncio.Semaphore(EXTRACT_SLOTS),
+            "download": asyncio.Semaphore(download_slots),
+            "merge": asyncio.Semaphore(merge_slots),
+            "transcode": asyncio.Semaphore(FIT_SLOTS),
+            "audio": asyncio.Semaphore(AUDIO_SLOTS),
+            "upload": asyncio.Semaphore(upload_slots),
+        }
+        self.pending = OrderedDict()  # {user_id: deque[Job]} в порядке очереди
+        self.active = {}  # {job_id: Job}
+        self.runner = None
+        self.avg_job_time = 60.0  # скользящее среднее длительности задания, s
+        self.stopping = False
+        self.submitting = 0  # задания, которые пишутся в журнал перед постановкой
+        self._cond = asyncio.Condition()
+        self._tasks = []
+
+    @property
+    def queued(self):
+        return sum(len(jobs) for jobs in self.pending.values())
+
+    def start(self, runner):
+        """Запускает воркеры; runner(job) — корутина, выполняющая задание"""
+        self.runner = runner
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Останавливает воркеры и отменяет активные задания"""
+        self.stopping = True
+        for job in list(self.active.values()):
+            if job.task:
+                job.task.cancel()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def drain(self, timeout):
+        """Плавная остановка: новые задания не запускаются; задания на стадиях после
+        скачивания (DRAIN_STAGES) дожидаемся не дольше timeout, остальные прерываем.
+        Прерванные и ждущие остаются в журнале — yt-dlp докачает их после запуска"""
+        self.stopping = True
+        await asyncio.gather(*(
+            in_thread(journal.record, job, "queued", False)
+            for jobs in self.pending.values() for job in jobs
+        ))
+        deadline = time.monotonic() + timeout
+        while self.active and time.monotonic() < deadline:
+            for job in list(self.active.values()):
+                if job.stage not in DRAIN_STAGES:
+                    self.interrupt(job)
+            await asyncio.sleep(0.2)
+        for job in list(self.active.values()):
+            self.interrupt(job)
+        # Воркеры дописывают итог в журнал
+        deadline = time.monotonic() + 10
+        while self.active and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    def interrupt(self, job):
+        if job.task and not job.interrupted:
+            job.interrupted = True
+            job.task.cancel()
+
+    def eta(self, position):
+        """Оценка ожидания (s) для задания на позиции position (0 — следующее)"""
+        return (position // self.workers + 1) * self.avg_job_time
+
+    async def submit(self, job):
+        """Ставит задание в очередь и возвращает его позицию. QueueFull — если мест нет.
+        В журнал пишем до того, как задание увидят воркеры: записи идут из разных потоков,
+        и поздний «queued» иначе мог бы лечь поверх «running»"""
+        if self.queued + self.submitting >= self.max_queue:
+            raise QueueFull(self.eta(self.queued))
+        self.submitting += 1
+        try:
+            await in_thread(journal.record, job, "queued")
+        finally:
+            self.submitting -= 1
+        self.pending.setdefault(job.user_id, deque()).append(job)
+        job.position = self.position(job)
+        await self._notify()
+        return job.position
+
+    async def cancel_user(self, user_id):
+        """Отменяет все задания пользователя; возвращает убранные из очереди"""
+        removed = self.pending.pop(user_id, deque())
+        for job in self.active.values():
+            if job.user_id == user_id and job.task:
+                job.task.cancel()
+        if removed:
+            self._update_positions()
+        await asyncio.gather(*(in_thread(journal.record, job, "cancelled") for job in removed))
+        return list(removed)
+
+    def position(self, job):
+        """Сколько заданий будет запущено раньше (с учётом round-robin)"""
+        jobs = self.pending.get(job.user_id)
+        if not jobs or job not in jobs:
+            return -1
+        index = jobs.index(job)
+        ahead = index
+        before = True
+        for user_id, other in self.pending.items():
+            if user_id == job.user_id:
+                before = False
+                continue
+            ahead += min(len(other), index + 1 if before else index)
+        return ahead
+
+    async def _notify(self):
+        async with self._cond:
+            self._cond.notify_all()
+
+    async def _next_job(self):
+        """Берёт следующее задание: по одному от каждого пользователя по кругу"""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.pending and not self.stopping)
+            user_id, jobs = next(iter(self.pending.items()))
+            job = jobs.popleft()
+            if jobs:
+                self.pending.move_to_end(user_id)
+            else:
+                del self.pending[user_id]
+            return job
+
+    async def _worker(self):
+        while True:
+            job = await self._next_job()
+            self.active[job.job_id] = job
+            job.started_at = time.time()
+            metrics.observe("bot_queue_wait_seconds", job.started_at - job.created_at)
+            self._update_positions()
+            await in_thread(journal.record, job, "running")
+            job.task = asyncio.create_task(self.runner(job))
+            await asyncio.wait([job.task])
+            duration = time.time() - job.started_at
+            self.avg_job_time = 0.8 * self.avg_job_time + 0.2 * duration
+            if job.interrupted:
+                outcome = "interrupted"
+                await in_thread(journal.record, job, "interrupted", False)  # продолжит любой процесс
+            elif job.result:
+                outcome = "ok"
+                await in_thread(journal.record, job, "done")
+            else:
+                outcome = "cancelled" if job.task.cancelled() else job.error or "failed"
+                await in_thread(journal.record, job, "cancelled" if outcome == "cancelled" else "failed")
+            self.active.pop(job.job_id, None)
+            metrics.inc("bot_jobs_total", outcome=outcome)
+            metrics.observe("bot_job_seconds", duration)
+            log("job_finished", job, outcome=outcome, seconds=round(duration, 2))
+
+    def _update_positions(self):
+        """Пересчитывает позиции и обновляет статус у тех, чья позиция изменилась"""
+        for jobs in self.pending.values():
+            for job in jobs:
+                position = self.position(job)
+                if position != job.position:
+                    job.position = position
+                    offer_status(job, queue_text(job))
+
+    def progress_snapshot(self):
+        """Прогресс активных заданий (для статистики и метрик)"""
+        return [
+            {
+                "job_id": job.job_id,
+                "stage": job.stage,
+                "downloaded_bytes": job.downloaded_bytes,
+                "total_bytes": job.total_bytes,
+                "speed": job.speed,
+                "eta": job.eta,
+            }
+            for job in self.active.values()
+        ]
+
+    async def enter(self, job, stage):
+        """Занимает слот стадии"""
+        await self.stages[stage].acquire()
+        job.stage = stage
+        job.stage_started[stage] = time.monotonic()
+
+    def leave(self, job, stage):
+        """Освобождает слот стадии"""
+        self.stages[stage].release()
+        started = job.stage_started.pop(stage, None)
+        if started is not None:
+            metrics.observe("bot_stage_seconds", time.monotonic() - started, stage=stage)
+
+    @asynccontextmanager
+    async def stage(self, job, stage):
+        await self.enter(job, stage)
+        try:
+            yield
+        finally:
+            self.leave(job, stage)
+
+scheduler = DownloadScheduler(
+    JOB_WORKERS, MAX_QUEUE, DOWNLOAD_SLOTS, MERGE_SLOTS, UPLOAD_SLOTS
+)
+
+def queue_text(job):
+    """Текст статуса для задания в очереди"""
+    minutes = max(1, round(scheduler.eta(job.position) / 60))
+    return (
+        f"🕒 В очереди: {job.position + 1}\n"
+        f"⏱ Примерное ожидание: ~{minutes} мин"
+    )
+
+async def job_status(job, text, **kwargs):
+    """Редактирует статусное сообщение задания и присоединившихся к нему
+    (сразу, минуя очередь прогресса)"""
+    for target in [job, *job.followers]:
+        if target.message_id is None:
+            continue
+        await status_updater.settle(target.chat_id, target.message_id)
+        try:
+            await bot.edit_message_text(
+                text, chat_id=target.chat_id, message_id=target.message_id, **kwargs
+            )
+        except Exception as e:
+            log("status_failed", target, error=str(e))
+
+def offer_status(job, text):
+    """Обновление статуса через троттлинг — задание и присоединившиеся к нему"""
+    for target in [job, *job.followers]:
+        if target.message_id is not None:
+            status_updater.offer(target.chat_id, target.message_id, text)
+
+async def delete_status(job):
+    """Удаляет статусное сообщение задания"""
+    await status_updater.settle(job.chat_id, job.message_id)
+    try:
+        await bot.delete_message(job.chat_id, job.message_id)
+    except:
+        pass
+
+def job_error(job, kind, detail=None):
+    """Учитывает ошибку задания в метриках и логе"""
+    job.error = kind
+    metrics.inc("bot_errors_total", kind=kind)
+    log("job_error", job, kind=kind, detail=str(detail) if detail else None)
+
+class DownloadStalled(Exception):
+    """yt-dlp не получает новых байт дольше STALL_TIMEOUT"""
+
+# {платформа: байт/с} — скользящая оценка скорости скачивания
+download_rates = {}
+
+def observe_download_rate(job, size_bytes):
+    """Учитывает скорость завершённого скачивания в оценке платформы"""
+    if job.transfer_seconds < 1 or size_bytes <= 0:
+        return
+    rate = size_bytes / job.transfer_seconds
+    previous = download_rates.get(job.profile.name)
+    download_rates[job.profile.name] = rate if previous is None else (
+        DOWNLOAD_RATE_ALPHA * rate + (1 - DOWNLOAD_RATE_ALPHA) * previous
+    )
+
+def download_budget(job):
+    """Сколько может длиться скачивание: ожидаемое время по размеру и измеренной
+    скорости площадки с запасом DOWNLOAD_SLOWDOWN, не меньше timeout профиля"""
+    profile = job.profile
+    size = max(job.expected_bytes, job.total_bytes)
+    rate = download_rates.get(profile.name, DOWNLOAD_RATE_DEFAULT)
+    return min(DOWNLOAD_MAX_TIMEOUT, max(profile.timeout, size / rate * DOWNLOAD_SLOWDOWN))
+
+async def watch_download(job, work):
+    """Ждёт корутину скачивания, пока есть прогресс. DownloadStalled — байты не идут
+    STALL_TIMEOUT s (на слиянии не проверяется), asyncio.TimeoutError — вышел
+    download_budget. При выходе с ошибкой work отменяется (процесс убивается)"""
+    task = asyncio.ensure_future(work)
+    started = progress_at = time.monotonic()
+    seen = None
+    # Простой считается по флагу merging, а не по job.stage: при потоковой загрузке
+    # стадия становится "upload", пока yt-dlp ещё качает
+    job.merging = False
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=WATCH_INTERVAL)
+            if done:
+                return task.result()
+            now = time.monotonic()
+            position = (job.part, job.downloaded_bytes)
+            if position != seen or job.merging:
+                seen, progress_at = position, now
+            limit = STALL_TIMEOUT if job.downloaded_bytes or job.part > 1 else STALL_START_TIMEOUT
+            if now - progress_at > limit:
+                raise DownloadStalled(f"нет данных {now - progress_at:.0f} s")
+            if now - started > download_budget(job):
+                raise asyncio.TimeoutError()
+    finally:
+        job.transfer_seconds += time.monotonic() - started
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+async def run_ytdlp(job, cmd):
+    """Запускает yt-dlp. Пока идёт скачивание — занят слот download,
+    во время слияния ffmpeg — слот merge. Возвращает (returncode, stderr).
+    Сторож (watch_download) считает время с момента запуска процесса, а не с ожидания слота"""
+    await scheduler.enter(job, "download")
+    stage = "download"
+    process = await spawn(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True  # своя группа процессов, чтобы управлять и ffmpeg
+    )
+    stderr_task = asyncio.create_task(read_stderr(job, process.stderr))
+    
+    async def follow():
+        nonlocal stage
+        async for raw_line in process.stdout:
+            line = raw_line.decode("utf-8", errors="ignore")
+            if track_progress(job, line):
+                continue
+            if stage == "download" and line.startswith(MERGE_MARKERS):
+                # Слияние: освобождаем слот download, ждём слот merge.
+                # Если слотов нет — приостанавливаем yt-dlp вместе с ffmpeg
+                scheduler.leave(job, "download")
+                stage = None
+                job.stage = "merge"
+                job.merging = True  # байтов больше не будет — сторож не считает это зависанием
+                paused = scheduler.stages["merge"].locked()
+                if paused:
+                    os.killpg(process.pid, signal.SIGSTOP)
+                    log("merge_wait", job)
+                try:
+                    await scheduler.enter(job, "merge")
+                    stage = "merge"
+                    job.status_line = "🔧 Объединяю дорожки..."
+                    offer_status(job, progress_text(job))
+                finally:
+                    if paused:
+                        os.killpg(process.pid, signal.SIGCONT)
+        await process.wait()
+        return process.returncode, await stderr_task
+    
+    try:
+        return await watch_download(job, follow())
+    
+    except BaseException:
+        # Зависание, таймаут или отмена: убиваем всю группу (yt-dlp + ffmpeg)
+        kill_process_group(process)
+        stderr_task.cancel()
+        raise
+    
+    finally:
+        if stage:
+            scheduler.leave(job, stage)
+
+def kill_process_group(process):
+    """Убивает процесс вместе с дочерними (ffmpeg)"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+async def run_ytdlp_stream(job, cmd, sink):
+    """Запускает yt-dlp с выводом в stdout и передаёт данные в sink по мере поступления.
+    Возвращает (returncode, stderr)"""
+    async with scheduler.stage(job, "download"):
+        process = await spawn(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True
+        )
+        # С "-o -" прогресс yt-dlp идёт в stderr
+        stderr_task = asyncio.create_task(read_stderr(job, process.stderr))
+        
+        async def pump():
+            while chunk := await process.stdout.read(STREAM_CHUNK_SIZE):
+                await sink.write(chunk)
+            await process.wait()
+            return process.returncode, await stderr_task
+        
+        try:
+            return await watch_download(job, pump())
+        except BaseException:
+            kill_process_group(process)
+            stderr_task.cancel()
+            raise
+
+async def stream_download(job, cmd, source):
+    """Скачивание в потоковом режиме (только для форматов без слияния).
+    source — URL или --load-info-json с заранее полученными метаданными.
+    Если по оценке файл больше лимита Telegram — сразу в облако, без диска.
+    Возвращает (returncode, stderr, путь к файлу или None, (сервис, ссылка, байт) или None)"""
+    base = job_prefix(job.job_id)
+    media_path = f"{base}.media.json"
+    cmd = cmd + ["--print-to-file", MEDIA_TEMPLATE, media_path, "-o", "-", *source]
+    log("download_start", job, engine="stream", cmd=loggable_cmd(cmd))
+    
+    def media_ext():
+        # Поля формата записываются до начала скачивания
+        job.media = job.media or load_media(media_path)
+        return (job.media or {}).get("ext") or "mp4"
+    
+    async def upload(chunks):
+        async with scheduler.stage(job, "upload"):
+            job.status_line = (
+                f"⚠️ Файл больше {TELEGRAM_VIDEO_LIMIT} MB\n"
+                f"☁️ Загружаю в облако по мере скачивания..."
+            )
+            offer_status(job, progress_text(job))
+            return await stream_to_cloud(chunks, f"{job.job_id}.{media_ext()}")
+    
+    limit_bytes = TELEGRAM_VIDEO_LIMIT * 1024 * 1024
+    if job.expected_bytes > limit_bytes:
+        limit_bytes = 0
+    sink = StreamSpool(f"{base}.part", limit_bytes, upload)
+    await sink.open()
+    try:
+        returncode, stderr = await run_ytdlp_stream(job, cmd, sink)
+        if returncode != 0:
+            await sink.abort()
+            return returncode, stderr, None, None
+        uploaded = await sink.finish()
+    except BaseException:
+        await sink.abort()
+        raise
+    
+    if uploaded:
+        service, link = uploaded
+        return 0, stderr, None, (service, link, sink.size)
+    
+    file_path = f"{base}.{media_ext()}"
+    await in_thread(os.replace, sink.path, file_path)
+    return 0, stderr, file_path, None
+
+# =========================
+# ДЕДУПЛИКАЦИЯ ЗАДАНИЙ
+# =========================
+# {(ключ медиа, качество): ведущее задание} — одинаковые запросы скачиваются один раз
+inflight = {}
+
+def inflight_key(job):
+    return canonical_media_key(job.url), job.quality
+
+def inflight_store_key(job):
+    """Ключ ведущего задания в общем хранилище (видно всем процессам)"""
+    media_key, quality = inflight_key(job)
+    return f"inflight:{media_key}|{quality}"
+
+async def release_inflight(job):
+    """Снимает задание с роли ведущего и забирает присоединившихся с других процессов"""
+    if inflight.get(inflight_key(job)) is job:
+        del inflight[inflight_key(job)]
+    if await state.get(inflight_store_key(job)) == job.job_id:
+        await state.delete(inflight_store_key(job))
+    # После удаления ключа новые запросы к ведущему уже не присоединятся
+    await claim_followers(job)
+
+def attach_follower(leader, job):
+    """Присоединяет задание к уже идущему скачиванию того же файла"""
+    leader.followers.append(job)
+    hold_files(leader.job_id, job.user_id)
+
+async def detach_follower(user_id):
+    """Убирает ожидающие задания пользователя (например, по /cancel), снимает его
+    блокировку и отпускает файлы ведущего — иначе на воркере, куда /cancel пришёл
+    через общее состояние, папка задания осталась бы занятой навсегда"""
+    for leader in inflight.values():
+        if not any(f.user_id == user_id for f in leader.followers):
+            continue
+        leader.followers = [f for f in leader.followers if f.user_id != user_id]
+        await user_locks.delete(user_id)
+        await release_files(leader.job_id, user_id)
+
+async def record_result(job, kind, file_id=None, link=None, size_mb=0.0):
+    """Запоминает результат задания — для присоединившихся и в кэш"""
+    job.result = {"kind": kind, "file_id": file_id, "link": link, "size_mb": size_mb}
+    if kind != "link":
+        metrics.inc("bot_bytes_total", int(size_mb * 1024 * 1024), direction="telegram")
+    if kind != "document":
+        await in_thread(functools.partial(
+            result_cache.put, canonical_media_key(job.url), job.quality, kind,
+            file_id=file_id, link=link, size_mb=size_mb
+        ))
+
+async def deliver_followers(job):
+    """Отправляет результат всем присоединившимся по file_id (без повторной загрузки).
+    Ссылки на облако и ошибки они уже получили через job_status"""
+    followers, job.followers = job.followers, []
+    for follower in followers:
+        try:
+            if job.result and job.result["kind"] != "link":
+                if not await send_cached_result(follower, job.result):
+                    await job_status(follower, "❌ Не удалось отправить файл, попробуй ещё раз")
+        finally:
+            await release_files(job.job_id, follower.user_id)
+            await user_locks.delete(follower.user_id)
+
+async def reject_job(job, text):
+    """Сообщает об отказе заданию и присоединившимся, снимает их блокировки"""
+    await job_status(job, text)
+    await deliver_followers(job)
+    await release_files(job.job_id, job.user_id)
+    await user_locks.delete(job.user_id)
+
+async def promote_followers(job):
+    """Ведущее задание отменено — первый из ожидающих становится ведущим"""
+    key = inflight_key(job)
+    await release_inflight(job)
+    if not job.followers or scheduler.stopping:
+        return
+    
+    leader, *rest = job.followers
+    job.followers = []
+    leader.followers = rest
+    for follower in [leader, *rest]:
+        file_refs.get(job.job_id, set()).discard(follower.user_id)
+        hold_files(leader.job_id, follower.user_id)
+    
+    try:
+        await scheduler.submit(leader)
+    except QueueFull:
+        asyncio.create_task(reject_job(leader, "🚦 Сейчас слишком много запросов, попробуй позже"))
+        return
+    inflight[key] = leader
+    await state.set(inflight_store_key(leader), leader.job_id, ttl=LOCK_TTL)
+    offer_status(leader, queue_text(leader))
+    log("job_promoted", leader, replaced=job.job_id)
+
+# =========================
+# ДВИЖОК YT-DLP
+# =========================
+def ytdlp_options(url, quality, profile=None):
+    """Параметры скачивания в терминах YoutubeDL (общие для CLI и пула).
+    profile — профиль платформы задания; без него определяется по URL"""
+    profile = profile or platform_of(url) or GENERIC_PLATFORM
+    options = {
+        "noplaylist": True, "cachedir": YTDLP_CACHE_DIR, "continuedl": True,
+        "concurrent_fragment_downloads": FRAGMENT_CONCURRENCY,
+    }
+    
+    # Формат для yt-dlp
+    if quality == "audio":
+        # Аудио, которое копируется в AUDIO_FORMAT без перекодирования, затем любое;
+        # если отдельного аудио нет — видео поменьше: звуковая дорожка у них одна
+        options["format"] = (
+            f"{AUDIO_TARGETS[AUDIO_FORMAT][3]}/bestaudio/"
+            f"best[height<={AUDIO_MUXED_HEIGHT}]/best"
+        )
+    else:  # best
+        options["format"] = profile.video_format
+        # Слияние — только копированием потоков: mkv, если кодеки не помещаются в mp4
+        options["merge_output_format"] = "mp4/mkv"
+    
+    # Сжатие под лимит: исходник выше FIT_SOURCE_HEIGHT всё равно будет уменьшен
+    if quality == "fit":
+        height = f"[height<={FIT_SOURCE_HEIGHT}]"
+        options["format"] = f"bestvideo{height}+bestaudio/best{height}/best"
+    
+    # Конкретная высота из клавиатуры выбора формата
+    if quality.isdigit():
+        height = f"[height<={quality}]"
+        options["format"] = (
+            f"bestvideo{height}[ext=mp4]+bestaudio[ext=m4a]/"
+            f"bestvideo{height}+bestaudio/best{height}/best"
+        )
+    
+    if profile.user_agent:
+        options["http_headers"] = {"User-Agent": profile.user_agent}
+    if profile.cookies:
+        options["cookiefile"] = profile.cookies
+    return options
+
+def ytdlp_args(options):
+    """Те же параметры в виде аргументов командной строки yt-dlp"""
+    args = []
+    if options.get("noplaylist"):
+        args.append("--no-playlist")
+    if options.get("continuedl"):
+        args.append("--continue")  # докачивает .part после перезапуска
+    if options.get("extract_flat"):
+        args.append("--flat-playlist")
+    if options.get("playlistend"):
+        args.extend(["--playlist-end", str(options["playlistend"])])
+    if options.get("cachedir"):
+        args.extend(["--cache-dir", options["cachedir"]])
+    if options.get("concurrent_fragment_downloads", 1) > 1:
+        args.extend(["-N", str(options["concurrent_fragment_downloads"])])
+    user_agent = options.get("http_headers", {}).get("User-Agent")
+    if user_agent:
+        args.extend(["--user-agent", user_agent])
+    if options.get("cookiefile"):
+        args.extend(["--cookies", options["cookiefile"]])
+    if options.get("proxy"):
+        args.extend(["--proxy", options["proxy"]])
+    if options.get("source_address"):
+        args.extend(["--source-address", options["source_address"]])
+    if options.get("format"):
+        args.extend(["-f", options["format"]])
+    if options.get("merge_output_format"):
+        args.extend(["--merge-output-format", options["merge_output_format"]])
+    return args
+
+def loggable_cmd(cmd):
+    """Команда для лога: у --proxy остаются схема, хост и порт — логин и пароль не пишутся"""
+    args = list(cmd)
+    for i, arg in enumerate(args[:-1]):
+        if arg == "--proxy":
+            proxy = urlsplit(args[i + 1])
+            args[i + 1] = f"{proxy.scheme}://{proxy.hostname}" + (f":{proxy.port}" if proxy.port else "")
+    return " ".join(args)
+
+# Пул долгоживущих процессов с уже импортированным yt_dlp.
+# Процессы создаются через fork до запуска event loop (start_engine в main),
+# поэтому функции воркера могут жить в этом же файле.
+engine_pool = None
+engine_progress = None     # очередь (job_id, событие, данные) от воркеров
+engine_cancelled = None    # {ключ запуска: True} — общий словарь отмен
+engine_jobs = {}  # {job_id: Job} — задания, выполняющиеся в пуле
+ENGINE_MERGE_PP = ("Merger", "FFmpegMerger", "ExtractAudio", "FFmpegExtractAudio", "VideoConvertor")
+_engine = {}  # состояние внутри процесса-воркера
+
+class EngineTimeout(BaseException):
+    """Таймер воркера сработал: извлечение метаданных не уложилось в срок.
+    BaseException — чтобы yt-dlp не перехватил его как ошибку экстрактора"""
+
+def engine_alarm(signum, frame):
+    raise EngineTimeout()
+
+def engine_init(cache_dir, progress, cancelled, merge_slots):
+    """Инициализация воркера: импорт yt_dlp и всех экстракторов один раз"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGALRM, engine_alarm)
+    import yt_dlp
+    # Прогрев: создание YoutubeDL загружает экстракторы, а suitable() заранее
+    # компилирует их _VALID_URL (иначе первое скачивание тратит на это секунды)
+    with yt_dlp.YoutubeDL({"quiet": True, "cachedir": cache_dir}) as ydl:
+        for extractor in ydl._ies.values():
+            extractor.suitable("https://warmup.invalid/")
+    _engine.update(
+        yt_dlp=yt_dlp,
+        cache_dir=cache_dir,
+        progress=progress,
+        cancelled=cancelled,
+        merge_slots=merge_slots,
+    )
+
+def engine_warmup():
+    """Пустая задача — заставляет пул поднять процесс"""
+    return os.getpid()
+
+def engine_extract(url, options, timeout):
+    """Метаданные без скачивания (внутри воркера). Не дольше timeout s: по таймеру
+    извлечение прерывается и процесс возвращается в пул (убить один процесс
+    ProcessPoolExecutor нельзя — сломается весь пул вместе с чужими скачиваниями)"""
+    yt_dlp = _engine["yt_dlp"]
+    params = {**options, "cachedir": _engine["cache_dir"], "quiet": True, "no_warnings": True}
+    try:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            with yt_dlp.YoutubeDL(params) as ydl:
+                return ydl.sanitize_info(ydl.extract_info(url, download=False))
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except EngineTimeout:
+        raise TimeoutError(f"Метаданные не получены за {timeout:.0f} s")
+
+def engine_download(job_id, url, options, info=None, run_key=None):
+    """Скачивание через YoutubeDL внутри воркера. Если есть заранее полученные
+    метаданные — без повторного извлечения (как --load-info-json). Отмена — по
+    run_key (свой у каждой попытки задания), иначе по job_id.
+    Возвращает {"returncode", "error", "filepath", "media"} — как у CLI"""
+    run_key = run_key or job_id
+    yt_dlp = _engine["yt_dlp"]
+    progress = _engine["progress"]
+    merge_slots = _engine["merge_slots"]
+    state = {"sent_at": 0.0, "merging": False}
+    
+    def progress_hook(d):
+        if _engine["cancelled"].get(run_key):
+            raise yt_dlp.utils.DownloadCancelled("Задание отменено")
+        now = time.monotonic()
+        # Последнее событие ("finished") отправляется всегда — байты учитываются полностью
+        if d["status"] == "finished" or d["status"] == "downloading" and now - state["sent_at"] >= 0.5:
+            state["sent_at"] = now
+            progress.put((job_id, "progress", (
+                int(d.get("downloaded_bytes") or 0),
+                int(d.get("total_bytes") or d.get("total_bytes_estimate") or 0),
+                float(d.get("speed") or 0.0),
+                int(d.get("eta") or 0),
+            )))
+    
+    def postprocessor_hook(d):
+        if d["postprocessor"] not in ENGINE_MERGE_PP:
+            return
+        if d["status"] == "started" and not state["merging"]:
+            progress.put((job_id, "merge", None))
+            merge_slots.acquire()
+            state["merging"] = True
+        elif d["status"] == "finished" and state["merging"]:
+            merge_slots.release()
+            state["merging"] = False
+    
+    params = {
+        **options,
+        "cachedir": _engine["cache_dir"],
+        "quiet": True,
+        "noprogress": True,
+        "progress_hooks": [progress_hook],
+        "postprocessor_hooks": [postprocessor_hook],
+    }
+    try:
+        with yt_dlp.YoutubeDL(params) as ydl:
+            if info:
+                try:
+                    info = ydl.process_ie_result(ydl.sanitize_info(info, True), download=True)
+                except yt_dlp.utils.DownloadError as e:
+                    if _engine["cancelled"].get(run_key):
+                        raise
+                    # Ссылки на форматы устарели — извлекаем заново
+                    print(f"⚠️ Метаданные устарели ({e}), повторное извлечение")
+                    info = ydl.extract_info(url, download=True)
+            else:
+                info = ydl.extract_info(url, download=True)
+        return {
+            "returncode": 0,
+            "error": "",
+            "filepath": info["requested_downloads"][0]["filepath"],
+            "media": {key: info.get(key) for key in MEDIA_FIELDS},
+        }
+    except Exception as e:
+        return {"returncode": 1, "error": str(e), "filepath": None, "media": None}
+    finally:
+        if state["merging"]:
+            merge_slots.release()
+
+def start_engine():
+    """Поднимает и прогревает пул воркеров (вызывать до запуска event loop)"""
+    global engine_pool, engine_progress, engine_cancelled
+    context = multiprocessing.get_context("fork")
+    engine_progress = context.Queue()
+    engine_cancelled = context.Manager().dict()
+    engine_pool = ProcessPoolExecutor(
+        max_workers=ENGINE_WORKERS,
+        mp_context=context,
+        initializer=engine_init,
+        initargs=(YTDLP_CACHE_DIR, engine_progress, engine_cancelled, context.BoundedSemaphore(MERGE_SLOTS))
+    )
+    # Все процессы поднимаются сразу, пока в программе нет других потоков
+    for future in [engine_pool.submit(engine_warmup) for _ in range(ENGINE_WORKERS)]:
+        future.result()
+    print(f"✅ Движок yt-dlp: пул из {ENGINE_WORKERS} процессов")
+
+def start_engine_pump(loop):
+    """Поток, пересылающий прогресс от воркеров в event loop"""
+    def pump():
+        while True:
+            message = engine_progress.get()
+            if message is None:
+                return
+            loop.call_soon_threadsafe(engine_event, *message)
+    threading.Thread(target=pump, name="engine-progress", daemon=True).start()
+
+def engine_event(job_id, event, data):
+    """Событие от воркера пула (выполняется в event loop)"""
+    job = engine_jobs.get(job_id)
+    if not job:
+        return
+    if event == "progress":
+        apply_progress(job, data)
+    elif event == "merge":
+        job.stage = "merge"
+        job.merging = True
+        job.status_line = "🔧 Объединяю дорожки..."
+        offer_status(job, progress_text(job))
+
+async def run_engine(job, options, info=None):
+    """Скачивание в пуле воркеров. Возвращает (returncode, stderr, путь к файлу)"""
+    await scheduler.enter(job, "download")
+    engine_jobs[job.job_id] = job
+    loop = asyncio.get_event_loop()
+    # Отмена по ключу попытки: флаг прерванного запуска не должен остановить повтор
+    run_key = f"{job.job_id}:{uuid.uuid4().hex[:8]}"
+    # Чтение без данных дольше STALL_TIMEOUT прерывается — зависший воркер доходит
+    # до хука прогресса примерно тогда же, когда сторож замечает зависание
+    options = {"socket_timeout": STALL_TIMEOUT, **options}
+    future = loop.run_in_executor(
+        engine_pool, engine_download, job.job_id, job.url, options, info, run_key
+    )
+    future.add_done_callback(lambda _: engine_cancelled.pop(run_key, None))
+    try:
+        result = await watch_download(job, asyncio.shield(future))
+    except DownloadStalled:
+        # Повтор докачивает тот же .part — сначала дожидаемся выхода старого воркера
+        engine_cancelled[run_key] = True
+        done, _ = await asyncio.wait({future}, timeout=STALL_TIMEOUT * 2)
+        if not done:
+            log("engine_stall_orphan", job, run=run_key)
+        raise
+    except BaseException:
+        # Процесс пула не убить — воркер прервёт скачивание на ближайшем хуке прогресса
+        engine_cancelled[run_key] = True
+        raise
+    finally:
+        engine_jobs.pop(job.job_id, None)
+        scheduler.leave(job, "download")
+    job.media = result["media"]
+    return result["returncode"], result["error"].encode(), result["filepath"]
+
+# =========================
+# МЕТАДАННЫЕ И ВЫБОР ФОРМАТА
+# =========================
+# {ключ медиа: (истекает в, Task)} — метаданные запрашиваются один раз на ссылку
+info_cache = OrderedDict()
+
+def prefetch_info(url):
+    """Запускает (или переиспользует) извлечение метаданных, возвращает Task"""
+    key = canonical_media_key(url)
+    entry = info_cache.get(key)
+    if entry:
+        expires_at, task = entry
+        failed = task.done() and (task.cancelled() or task.exception())
+        if expires_at > time.time() and not failed:
+            info_cache.move_to_end(key)
+            return task
+    
+    task = asyncio.create_task(extract_info(url))
+    info_cache[key] = (time.time() + INFO_TTL, task)
+    while len(info_cache) > INFO_CACHE_SIZE:
+        info_cache.popitem(last=False)
+    return task
+
+async def get_info(url, timeout):
+    """Метаданные ссылки или None (ошибка или не успели за timeout)"""
+    task = prefetch_info(url)
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), timeout=timeout)
+    except asyncio.TimeoutError:
+        print(f"⚠️ Метаданные не готовы за {timeout} s: {url}")
+    except Exception as e:
+        print(f"⚠️ Не удалось получить метаданные: {e}")
+    return None
+
+async def extract_info(url):
+    """Извлекает метаданные без скачивания (пул воркеров или yt-dlp -J).
+    У плейлиста — только список записей, не больше BATCH_MAX_ITEMS"""
+    options = {
+        k: v for k, v in ytdlp_options(url, "best").items()
+        if k not in ("format", "merge_output_format")
+    }
+    options.update(extract_flat="in_playlist", playlistend=BATCH_MAX_ITEMS)
+    profile = platform_of(url) or GENERIC_PLATFORM
+    platform = profile.name.split("-")[0]
+    tried = []
+    for attempt in range(EGRESS_RETRIES):
+        egress = pick_egress(platform, exclude=tried)
+        await platform_turn(profile, egress)
+        started = time.monotonic()
+        try:
+            async with scheduler.stages["extract"]:
+                info = await extract_info_locked(url, {**options, **egress.options()})
+        except Exception as e:
+            # Лимит или бан выхода — повторяем через другой
+            if download_error(str(e).encode()).kind not in EGRESS_ERRORS:
+                raise
+            egress.limited(platform)
+            if attempt + 1 == EGRESS_RETRIES:
+                raise
+            tried.append(egress.name)
+            log("egress_retry", egress=egress.name, platform=platform, stage="extract")
+            await retry_delay(attempt)
+            continue
+        finally:
+            metrics.observe("bot_stage_seconds", time.monotonic() - started, stage="extract")
+        egress.succeeded(platform)
+        info["_egress"] = egress.name  # скачивание пойдёт через тот же выход
+        return info
+
+async def extract_info_locked(url, options):
+    """Извлечение метаданных (слот extract уже занят)"""
+    if engine_pool:
+        loop = asyncio.get_event_loop()
+        return await asyncio.wait_for(
+            loop.run_in_executor(engine_pool, engine_extract, url, options, INFO_TIMEOUT * 4),
+            timeout=INFO_TIMEOUT * 4
+        )
+    
+    process = await spawn(
+        "yt-dlp", "-J", *ytdlp_args(options), url,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=INFO_TIMEOUT * 4)
+    except asyncio.TimeoutError:
+        process.kill()
+        raise
+    if process.returncode != 0:
+        raise Exception(stderr.decode("utf-8", errors="ignore").strip()[-300:])
+    return json.loads(stdout)
+
+def format_size(f, duration):
+    """Размер формата в байтах: точный, примерный или по битрейту"""
+    size = f.get("filesize") or f.get("filesize_approx")
+    if not size and f.get("tbr") and duration:
+        size = f["tbr"] * 1000 / 8 * duration
+    return int(size or 0)
+
+def audio_only_formats(info):
+    """Форматы без видео (отдельные аудиодорожки)"""
+    return [
+        f for f in (info or {}).get("formats") or []
+        if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none")
+    ]
+
+def needs_merge(info, quality, options):
+    """Будет ли yt-dlp сливать дорожки. Селектор высоты всегда вида bestvideo+bestaudio/best,
+    но слияние только если у медиа есть отдельное видео (в пределах высоты) и отдельное
+    аудио — как фильтры bestvideo/bestaudio в yt-dlp. Без метаданных — по селектору"""
+    if "+" not in options["format"]:
+        return False
+    formats = (info or {}).get("formats")
+    if not formats:
+        return True
+    cap = int(quality) if quality.isdigit() else FIT_SOURCE_HEIGHT if quality == "fit" else None
+    video_only = [
+        f for f in formats
+        if f.get("vcodec") != "none" and f.get("acodec") == "none"
+        and (cap is None or (f.get("height") or 0) <= cap)
+    ]
+    return bool(video_only and audio_only_formats(info))
+
+def format_choices(info):
+    """Варианты для клавиатуры: [(качество, подпись, размер в байтах)]"""
+    duration = info.get("duration") or 0
+    formats = [f for f in info.get("formats") or [] if f.get("ext") != "mhtml"]
+    audio = audio_only_formats(info)
+    best_audio = max(audio, key=lambda f: f.get("abr") or f.get("tbr") or 0, default=None)
+    audio_size = format_size(best_audio, duration) if best_audio else 0
+    
+    # Лучший видеоформат для каждой высоты (mp4 в приоритете, как в ytdlp_options)
+    by_height = {}
+    for f in formats:
+        height = f.get("height")
+        if not height or f.get("vcodec") == "none":
+            continue
+        size = format_size(f, duration)
+        if f.get("acodec") == "none":
+            size += audio_size  # будет слияние с лучшим аудио
+        rank = (f.get("ext") == "mp4", f.get("tbr") or 0)
+        if height not in by_height or rank > by_height[height][0]:
+            by_height[height] = (rank, size)
+    
+    choices = []
+    for height in sorted(by_height, reverse=True)[:FORMAT_CHOICES]:
+        choices.append((str(height), f"🎬 {height}p", by_height[height][1]))
+    if not choices:
+        choices.append(("best", "🎬 Видео (лучшее)", format_size(info, duration)))
+    choices.append(("audio", "🎵 Аудио", audio_size or format_size(info, duration)))
+    return choices
+
+def size_label(size):
+    if not size:
+        return "? MB"
+    if size >= 1024 ** 3:
+        return f"{size / 1024 ** 3:.1f} GB"
+    return f"{size / 1024 ** 2:.0f} MB"
+
+def format_keyboard(info):
+    """Клавиатура выбора формата и текст сообщения"""
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    
+    if not info:
+        keyboard.add(
+            InlineKeyboardButton("🎬 Видео (лучшее)", callback_data="quality_best"),
+            InlineKeyboardButton("🎵 Аудио", callback_data="quality_audio")
+        )
+        return keyboard, (
+            "🎯 <b>Выбери формат:</b>\n\n"
+            "🎬 <b>Видео</b> — максимальное качество\n"
+            "🎵 <b>Аудио</b> — только звук"
+        )
+    
+    limit = TELEGRAM_VIDEO_LIMIT * 1024 * 1024
+    buttons = []
+    choices = format_choices(info)
+    for quality, label, size in choices:
+        cloud = " ☁️" if size > limit else ""
+        buttons.append(InlineKeyboardButton(
+            f"{label} · {size_label(size)}{cloud}", callback_data=f"quality_{quality}"
+        ))
+    # Лучшее качество не влезает в Telegram — предлагаем сжать под лимит
+    if FFMPEG and info.get("duration") and choices[0][2] > limit:
+        if fit_plan(info["duration"], limit):
+            buttons.append(InlineKeyboardButton(
+                f"🗜 Сжать до {TELEGRAM_VIDEO_LIMIT} MB", callback_data="quality_fit"
+            ))
+    keyboard.add(*buttons)
+    
+    text = "🎯 <b>Выбери формат:</b>\n\n"
+    if info.get("title"):
+        text += f"📹 {html.escape(info['title'][:200])}\n"
+    if info.get("duration"):
+        minutes, seconds = divmod(int(info["duration"]), 60)
+        text += f"⏱ {minutes}:{seconds:02d}\n"
+    text += f"\n☁️ — больше {TELEGRAM_VIDEO_LIMIT} MB, будет загружено в облако"
+    return keyboard, text
+
+def expected_size(info, quality):
+    """Оценка размера выбранного формата в байтах (0 — неизвестно)"""
+    if not info:
+        return 0
+    for choice, _, size in format_choices(info):
+        if choice == quality:
+            return size
+    return 0
+
+
+def write_json(path, value):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(value, f)
+
+def load_media(path):
+    """Поля формата, записанные yt-dlp через --print-to-file (или None)"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            lines = f.read().split("\n")
+        return json.loads(lines[0])
+    except (OSError, ValueError):
+        return None
+
+# {(путь, размер, mtime): поля} — файл проверяется ffprobe не больше одного раза
+probe_cache = OrderedDict()
+
+async def probe_media(job, file_path):
+    """Запасной вариант: кодеки, размеры и длительность файла через один вызов ffprobe"""
+    stat = await in_thread(os.stat, file_path)
+    key = (file_path, stat.st_size, stat.st_mtime)
+    if key in probe_cache:
+        return probe_cache[key]
+    
+    started = time.monotonic()
+    media = {}
+    try:
+        probe = await spawn(
+            "ffprobe", "-v", "error",
+            "-show_entries", "stream=codec_type,codec_name,width,height:format=duration",
+            "-of", "json",
+            file_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, _ = await probe.communicate()
+        data = json.loads(stdout or b"{}")
+        streams = data.get("streams", [])
+        video = next((st for st in streams if st.get("codec_type") == "video"), None)
+        audio = next((st for st in streams if st.get("codec_type") == "audio"), None)
+        media = {
+            "vcodec": video["codec_name"] if video else "none",
+            "acodec": audio["codec_name"] if audio else "none",
+            "width": video and video.get("width"),
+            "height": video and video.get("height"),
+            "duration": float(data.get("format", {}).get("duration") or 0) or None,
+        }
+    except Exception as e:
+        log("probe_failed", job, error=str(e))
+    metrics.observe("bot_stage_seconds", time.monotonic() - started, stage="probe")
+    
+    probe_cache[key] = media
+    while len(probe_cache) > 256:
+        probe_cache.popitem(last=False)
+    return media
+
+def video_attributes(media):
+    """width/height/duration для send_video — Telegram покажет правильное превью"""
+    return {
+        key: int(media[key])
+        for key in ("width", "height", "duration")
+        if media.get(key)
+    }
+
+def audio_attributes(media):
+    """duration/title для send_audio"""
+    attributes = {}
+    if media.get("duration"):
+        attributes["duration"] = int(media["duration"])
+    if media.get("title"):
+        attributes["title"] = media["title"]
+    return attributes
+
+# =========================
+# ПОСТОБРАБОТКА
+# =========================
+def mp4_compatible(media):
+    """Потоки помещаются в mp4 без перекодирования"""
+    vcodec = (media.get("vcodec") or "").lower()
+    acodec = (media.get("acodec") or "none").lower()
+    return vcodec.startswith(MP4_VIDEO_CODECS) and (
+        acodec == "none" or acodec.startswith(MP4_AUDIO_CODECS)
+    )
+
+def fit_plan(duration, limit_bytes):
+    """(kbit/s видео, kbit/s аудио, высота кадра), чтобы файл длительностью duration
+    уложился в limit_bytes. None — даже при минимальном качестве не уложится"""
+    total = limit_bytes * 8 * FIT_HEADROOM / duration / 1000
+    audio = min(FIT_AUDIO_KBPS, total / 4)
+    video = total - audio
+    if video < FIT_MIN_VIDEO_KBPS:
+        return None
+    height = next(height for kbps, height in FIT_HEIGHTS if video >= kbps)
+    return int(video), int(audio), height
+
+async def run_ffmpeg(job, args, duration=None):
+    """Запускает ffmpeg в своей группе процессов. С duration — процент готовности в статус"""
+    process = await spawn(
+        FFMPEG, "-nostdin", "-v", "error", "-y", *args, "-progress", "pipe:1",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True
+    )
+    stderr_task = asyncio.create_task(process.stderr.read())
+    try:
+        async for raw_line in process.stdout:
+            key, _, value = raw_line.decode("utf-8", errors="ignore").strip().partition("=")
+            if duration and key == "out_time_us" and value.isdigit():
+                percent = min(99, int(value) / 10_000 / duration)
+                offer_status(job, f"🗜 Сжимаю до {TELEGRAM_VIDEO_LIMIT} MB... {percent:.0f}%")
+        await process.wait()
+    except BaseException:
+        kill_process_group(process)
+        stderr_task.cancel()
+        raise
+    stderr = await stderr_task
+    if process.returncode != 0:
+        raise Exception(stderr.decode("utf-8", errors="ignore").strip()[-300:])
+
+async def remux(job, file_path, media):
+    """Перепаковка в mp4 копированием потоков (секунды, без потери качества).
+    Возвращает (путь, поля медиа); при ошибке — исходный файл"""
+    base, ext = os.path.splitext(file_path)
+    if ext == ".mp4" or not FFMPEG or not mp4_compatible(media):
+        return file_path, media
+    target = base + ".mp4"
+    started = time.monotonic()
+    try:
+        async with scheduler.stage(job, "merge"):
+            await run_ffmpeg(job, [
+                "-i", file_path, "-map", "0:v:0", "-map", "0:a:0?",
+                "-c", "copy", "-movflags", "+faststart", target
+            ])
+    except Exception as e:
+        log("remux_failed", job, error=str(e))
+        await remove_file(target)
+        return file_path, media
+    await remove_file(file_path)
+    log("remuxed", job, source=ext.lstrip("."), seconds=round(time.monotonic() - started, 2))
+    return target, {**media, "ext": "mp4"}
+
+async def fit_to_limit(job, file_path, media):
+    """Режим «сжать под лимит»: перекодирование с битрейтом из длительности и лимита.
+    Не больше FIT_SLOTS одновременно, по FIT_THREADS потоков. None — не получилось"""
+    limit_bytes = TELEGRAM_VIDEO_LIMIT * 1024 * 1024
+    plan = fit_plan(media["duration"], limit_bytes) if FFMPEG and media.get("duration") else None
+    if not plan:
+        return None
+    video_kbps, audio_kbps, height = plan
+    target = os.path.splitext(file_path)[0] + ".fit.mp4"
+    started = time.monotonic()
+    try:
+        async with scheduler.stage(job, "transcode"):
+            await run_ffmpeg(job, [
+                "-i", file_path, "-map", "0:v:0", "-map", "0:a:0?",
+                "-vf", f"scale=-2:min(ih\\,{height})",
+                "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+                "-b:v", f"{video_kbps}k", "-maxrate", f"{video_kbps * 3 // 2}k",
+                "-bufsize", f"{video_kbps * 2}k",
+                "-c:a", "aac", "-b:a", f"{audio_kbps}k", "-ac", "2",
+                "-threads", str(FIT_THREADS), "-movflags", "+faststart", target
+            ], duration=media["duration"])
+    except Exception as e:
+        job_error(job, "transcode", e)
+        await remove_file(target)
+        return None
+    size = await in_thread(os.path.getsize, target)
+    log("transcoded", job, video_kbps=video_kbps, height=height, bytes=size,
+        seconds=round(time.monotonic() - started, 2))
+    if size > limit_bytes:
+        await remove_file(target)
+        return None
+    await remove_file(file_path)
+    if media.get("height") and media.get("width") and media["height"] > height:
+        media = {**media, "width": round(media["width"] * height / media["height"] / 2) * 2,
+                 "height": height}
+    return target, {**media, "ext": "mp4", "vcodec": "avc1", "acodec": "mp4a"}
+
+async def extract_audio(job, file_path, media):
+    """Режим «Аудио»: звуковая дорожка в AUDIO_FORMAT. Копирование потока, если кодек
+    подходит (или неизвестен), иначе перекодирование — не больше AUDIO_SLOTS одновременно.
+    Возвращает (путь, поля медиа); при ошибке — исходный файл"""
+    ext, codecs, encoder, _ = AUDIO_TARGETS[AUDIO_FORMAT]
+    acodec = (media.get("acodec") or "").split(".")[0]
+    copy = not acodec or acodec in codecs
+    if copy and file_path.endswith(f".{ext}") and media.get("vcodec") in (None, "none"):
+        return file_path, media
+    if not FFMPEG:
+        return file_path, media
+    target = f"{os.path.splitext(file_path)[0]}.audio.{ext}"
+    started = time.monotonic()
+    for mode in ("copy", "encode") if copy else ("encode",):
+        if mode == "copy":
+            codec, stage = ["-c:a", "copy"], "merge"
+        else:
+            codec, stage = ["-c:a", encoder, "-b:a", f"{AUDIO_BITRATE}k"], "audio"
+            offer_status(job, "🎵 Конвертирую аудио...")
+        try:
+            async with scheduler.stage(job, stage):
+                await run_ffmpeg(job, [
+                    "-i", file_path, "-map", "0:a:0", "-vn", *codec,
+                    *(["-movflags", "+faststart"] if ext == "m4a" else []), target
+                ])
+            break
+        except Exception as e:
+            log("audio_failed", job, mode=mode, error=str(e))
+            await remove_file(target)
+    else:
+        return file_path, media
+    await remove_file(file_path)
+    log("audio_extracted", job, mode=mode, source=os.path.splitext(file_path)[1].lstrip("."),
+        bytes=await in_thread(os.path.getsize, target), seconds=round(time.monotonic() - started, 2))
+    return target, {**media, "ext": ext, "vcodec": "none",
+                    "acodec": acodec if mode == "copy" and acodec else codecs[0]}
+
+async def postprocess(job, file_path, media):
+    """Перед отправкой: mp4 без перекодирования; в режиме fit — сжатие, если не влезает;
+    в режиме «Аудио» — только звук в AUDIO_FORMAT. Возвращает (путь, поля медиа)"""
+    if job.quality == "audio":
+        return await extract_audio(job, file_path, media)
+    if media.get("vcodec") == "none":
+        return file_path, media
+    file_path, media = await remux(job, file_path, media)
+    if job.quality == "fit" and await in_thread(os.path.getsize, file_path) > TELEGRAM_VIDEO_LIMIT * 1024 * 1024:
+        await job_status(job, f"🗜 Сжимаю до {TELEGRAM_VIDEO_LIMIT} MB...")
+        fitted = await fit_to_limit(job, file_path, media)
+        if fitted:
+            file_path, media = fitted
+    return file_path, media
+
+# =========================
+# ОБЛОЖКИ И ТЕГИ
+# =========================
+# {ключ медиа: Task → {"thumb", "title", "performer"}}; обложки лежат в THUMB_DIR
+enrich_cache = OrderedDict()
+enrich_slots = asyncio.Semaphore(ENRICH_SLOTS)
+
+def thumb_path(key):
+    return os.path.join(THUMB_DIR, hashlib.sha1(key.encode()).hexdigest() + ".jpg")
+
+def touch_file(path):
+    """Обновляет mtime (обложка снова нужна — сборка мусора её не тронет). False — файла нет"""
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+def write_bytes(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def prune_thumbs(max_files, max_age):
+    """Удаляет обложки старше max_age s и самые давние сверх max_files. Число удалённых"""
+    files = []
+    with os.scandir(THUMB_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file():
+                    files.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                continue
+    files.sort(reverse=True)
+    now = time.time()
+    removed = 0
+    for index, (mtime, path) in enumerate(files):
+        if index >= max_files or now - mtime >= max_age:
+            remove_quietly(path)
+            removed += 1
+    return removed
+
+def media_tags(info):
+    """Теги для send_audio из метаданных yt-dlp"""
+    tags = {
+        "title": info.get("track") or info.get("title"),
+        "performer": info.get("artist") or info.get("creator") or info.get("uploader") or info.get("channel"),
+    }
+    return {key: str(value)[:200] for key, value in tags.items() if value}
+
+async def make_thumbnail(job, source, target, seek=None):
+    """Обложка для Telegram (JPEG до THUMB_SIZE px и THUMB_MAX_BYTES) одним вызовом
+    ffmpeg: из скачанного превью площадки или кадр видео. Путь или None"""
+    if not FFMPEG:
+        return None
+    started = time.monotonic()
+    try:
+        async with enrich_slots:
+            await asyncio.wait_for(run_ffmpeg(job, [
+                *(["-ss", f"{seek:.2f}"] if seek else []), "-i", source, "-frames:v", "1",
+                "-vf", f"scale={THUMB_SIZE}:{THUMB_SIZE}:force_original_aspect_ratio=decrease",
+                "-q:v", "5", "-f", "mjpeg", target
+            ]), timeout=ENRICH_TIMEOUT)
+    except Exception as e:
+        log("thumbnail_failed", job, error=str(e) or type(e).__name__)
+        await remove_file(target)
+        return None
+    finally:
+        metrics.observe("bot_stage_seconds", time.monotonic() - started, stage="thumbnail")
+    if not 0 < await in_thread(os.path.getsize, target) <= THUMB_MAX_BYTES:
+        await remove_file(target)
+        return None
+    return target
+
+async def fetch_thumbnail(egress, url, path):
+    """Превью площадки через тот же выход, что и метаданные (прокси или IP сервера)"""
+    if egress and egress.source_address:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(local_addr=(egress.source_address, 0))
+        )
+    else:
+        session = await get_http_session()
+    try:
+        async with session.get(url, proxy=egress and egress.proxy) as response:
+            response.raise_for_status()
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                data += chunk
+                if len(data) > THUMB_SOURCE_MAX_BYTES:
+                    raise Exception(f"Превью больше {THUMB_SOURCE_MAX_BYTES} байт")
+    finally:
+        if egress and egress.source_address:
+            await session.close()
+    await in_thread(write_bytes, path, bytes(data))
 
-async def cleanup_user_files(user_id: int):
-    """Удаляет все файлы пользователя"""
-    for f in glob.glob(f"{DOWNLOAD_DIR}/{user_id}_*"):
+async def enrich(job, key):
+    """Теги и обложка из метаданных: превью площадки скачивается, пока идёт скачивание видео"""
+    info = await get_info(job.url, timeout=INFO_TIMEOUT) or {}
+    extra = media_tags(info)
+    target = thumb_path(key)
+    if await in_thread(touch_file, target):
+        extra["thumb"] = target
+    elif info.get("thumbnail"):
+        source = target + ".src"
         try:
-            os.remove(f)
-            print(f"🗑️ Удалён файл: {f}")
+            await asyncio.wait_for(
+                fetch_thumbnail(egress_named(info.get("_egress")), info["thumbnail"], source),
+                timeout=ENRICH_TIMEOUT
+            )
+            thumb = await make_thumbnail(job, source, target)
         except Exception as e:
-            print(f"⚠️ Не удалось удалить {f}: {e}")
+            log("thumbnail_failed", job, error=str(e) or type(e).__name__)
+            thumb = None
+        finally:
+            await remove_file(source)
+        if thumb:
+            extra["thumb"] = thumb
+    return extra
 
-def clear_user_state(user_id: int):
-    """Очищает состояние пользователя"""
-    if user_id in user_urls:
-        del user_urls[user_id]
-    if user_id in user_locks:
-        del user_locks[user_id]
+async def start_enrichment(job):
+    """Запускает (или переиспользует) подготовку обложки и тегов, возвращает Task"""
+    key = canonical_media_key(job.url)
+    task = enrich_cache.get(key)
+    if task and not (task.done() and (task.cancelled() or task.exception())):
+        enrich_cache.move_to_end(key)
+        return task
+    task = asyncio.create_task(enrich(job, key))
+    enrich_cache[key] = task
+    evicted = []
+    while len(enrich_cache) > THUMB_CACHE_SIZE:
+        _, old = enrich_cache.popitem(last=False)
+        if old.done() and not old.cancelled() and not old.exception() and old.result().get("thumb"):
+            evicted.append(old.result()["thumb"])
+    for path in evicted:
+        await remove_file(path)
+    return task
 
-# =========================
-# КОМАНДЫ
-# =========================
-@dp.message_handler(commands=["start", "help"])
-async def start(message: types.Message):
-    """Команда /start и /help"""
-    user_id = message.from_user.id
-    # Очищаем старое состояние при /start
-    clear_user_state(user_id)
-    await cleanup_user_files(user_id)
-    
-    await message.answer(
-        "👋 <b>Привет! Я скачиваю видео из соцсетей</b>\n\n"
-        "📱 <b>Поддерживаю:</b>\n"
-        "• YouTube / YouTube Shorts\n"
-        "• Instagram / Reels\n"
-        "• TikTok\n"
-        "• Facebook\n"
-        "• VK, Twitter/X, Reddit, Twitch\n\n"
-        "🎯 <b>Как пользоваться:</b>\n"
-        "1. Отправь мне ссылку на видео\n"
-        "2. Выбери формат (видео или аудио)\n"
-        "3. Получи файл!\n\n"
-        "💡 <b>Возможности:</b>\n"
-        "🎬 Видео в лучшем качестве\n"
-        "🎵 Только аудио\n"
-        "☁️ Большие файлы → GoFile/Drive\n\n"
-        "⚡ Быстро и просто!\n\n"
-        "🔧 Команды:\n"
-        "/cancel - отменить текущее скачивание",
-        parse_mode="HTML"
-    )
+async def enrich_from_file(job, task, file_path, media):
+    """Площадка не дала превью — кадр из скачанного файла (один seek ffmpeg) параллельно
+    с постобработкой. Постобработка удаляет исходник, поэтому кадр читается из жёсткой
+    ссылки на него, созданной до возврата. Возвращает Task"""
+    if media.get("vcodec") == "none" or job.quality == "audio":
+        return task
+    source = file_path + ".frame"
+    try:
+        await in_thread(os.link, file_path, source)
+    except OSError as e:
+        log("thumbnail_failed", job, error=str(e))
+        return task
+    return asyncio.create_task(frame_thumbnail(job, task, source, media))
 
-@dp.message_handler(commands=["cancel"])
-async def cancel(message: types.Message):
-    """Команда /cancel - отмена скачивания"""
-    user_id = message.from_user.id
-    clear_user_state(user_id)
-    await cleanup_user_files(user_id)
-    await message.answer(
-        "✅ Скачивание отменено\n\n"
-        "Можешь отправить новую ссылку"
-    )
+async def frame_thumbnail(job, task, source, media):
+    """Кадр из source, если площадка не дала превью; source удаляется в любом случае"""
+    try:
+        extra = await asyncio.shield(task)
+        if extra.get("thumb"):
+            return extra
+        duration = media.get("duration") or 0
+        thumb = await make_thumbnail(
+            job, source, thumb_path(canonical_media_key(job.url)),
+            seek=min(duration / 10, 5) if duration else None
+        )
+        if thumb:
+            extra["thumb"] = thumb
+        return extra
+    finally:
+        await remove_file(source)
+
+async def enrichment_attributes(task, kind):
+    """thumb (и title/performer для аудио) для отправки. Ждёт не дольше ENRICH_WAIT:
+    обложка не должна задерживать отправку"""
+    if task is None:
+        return {}
+    try:
+        extra = await asyncio.wait_for(asyncio.shield(task), timeout=ENRICH_WAIT)
+    except Exception:
+        return {}
+    attributes = {}
+    if extra.get("thumb") and await in_thread(os.path.exists, extra["thumb"]):
+        attributes["thumb"] = types.InputFile(extra["thumb"])
+    if kind == "audio":
+        attributes.update((key, extra[key]) for key in ("title", "performer") if extra.get(key))
+    return attributes
 
 # =========================
-# ОБРАБОТКА ССЫЛКИ
+# ОБРАБОТКА ВЫБОРА КАЧЕСТВА
 # =========================
-@dp.message_handler(content_types=['text'])
-async def handle_url(message: types.Message):
-    """Обработка текстовых сообщений с URL"""
-    print(f"\n=== НОВОЕ СООБЩЕНИЕ ===")
-    print(f"User ID: {message.from_user.id}")
-    print(f"Username: {message.from_user.username}")
-    print(f"Text: {message.text}")
+@dp.callback_query_handler(lambda c: c.data.startswith('quality_'))
+async def process_quality(callback: CallbackQuery):
+    """Обработка выбора качества: проверка кэша и постановка в очередь"""
+    # Отвечаем на callback
+    await callback.answer()
     
-    # Игнорируем команды
-    if message.text and message.text.startswith('/'):
-        print("❌ Команда игнорируется")
+    user_id = callback.from_user.id
+    quality = callback.data.replace('quality_', '')
+    
+    # Проверяем блокировку
+    if await user_locks.get(user_id):
+        await callback.answer("⏳ Подожди, предыдущее скачивание ещё идёт!", show_alert=True)
         return
     
-    # Извлекаем URL
-    url = extract_url_from_message(message)
-    print(f"Extracted URL: {url}")
+    # Получаем URL
+    url = await user_urls.get(user_id)
     
     if not url:
-        await message.answer(
-            "❌ Не могу найти ссылку в сообщении\n\n"
-            "Отправь мне прямую ссылку на видео"
+        await callback.message.edit_text(
+            "❌ Ссылка потерялась. Отправь её заново.\n\n"
+            "Нажми /start"
         )
         return
     
-    # Проверяем поддержку
-    if not is_supported_url(url):
-        await message.answer(
-            "❌ Эта платформа не поддерживается\n\n"
-            "📱 Поддерживаю:\n"
-            "• YouTube\n"
-            "• Instagram\n"
-            "• TikTok\n"
-            "• Facebook\n"
-            "• VK, Twitter, Reddit, Twitch"
-        )
-        return
+    # Список ссылок — пакет: кэш и дедупликация проверяются для каждого элемента
+    items = None
+    if isinstance(url, list):
+        items, url = url, url[0]
     
-    user_id = message.from_user.id
+    job = Job(
+        user_id=user_id,
+        chat_id=callback.message.chat.id,
+        message_id=callback.message.message_id,
+        url=url,
+        quality=quality,
+        items=items,
+        platform=(platform_of(url) or GENERIC_PLATFORM).name
+    )
     
-    # Очищаем старые файлы и блокировку при новой ссылке
-    await cleanup_user_files(user_id)
-    if user_id in user_locks:
-        del user_locks[user_id]
+    # Проверяем кэш готовых результатов — без очереди
+    media_key = canonical_media_key(url)
+    log("job_created", job, url=url, quality=quality, media_key=media_key,
+        items=len(items) if items else None)
+    cached = None if items else await in_thread(result_cache.get, media_key, quality)
+    if cached:
+        log("cache_hit", job, media_key=media_key)
+        if await send_cached_result(job, cached):
+            return
+        await in_thread(result_cache.invalidate, media_key, quality)
     
-    # Сохраняем новый URL
-    user_urls[user_id] = url
-    print(f"✅ URL сохранён для пользователя {user_id}")
+    # То же видео уже скачивается для кого-то — присоединяемся
+    leader = None if items else inflight.get(inflight_key(job))
+    leader_id = leader.job_id if leader else None
+    if leader:
+        attach_follower(leader, job)
+    elif ROLE == "front" and not items:
+        leader_id = await attach_remote(job)
+    if leader_id:
+        await user_locks.set(user_id, True)
+        log("job_attached", job, leader=leader_id)
+        await job_status(job, "🔗 Это видео уже скачивается — пришлю, как только будет готово")
+        return
     
-    # Создаём меню выбора
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    keyboard.add(
-        InlineKeyboardButton("🎬 Видео (лучшее)", callback_data="quality_best"),
-        InlineKeyboardButton("🎵 Аудио", callback_data="quality_audio")
-    )
+    # Блокируем пользователя и занимаем роль ведущего до публикации: воркер может
+    # взять задание сразу, и его release_* не должны опередить эти записи
+    await user_locks.set(user_id, True)
+    if not items:
+        await state.set(inflight_store_key(job), job.job_id, ttl=LOCK_TTL)
+    if ROLE != "front":
+        if not items:
+            inflight[inflight_key(job)] = job
+        hold_files(job.job_id, user_id)
     
-    await message.answer(
-        "🎯 <b>Выбери формат:</b>\n\n"
-        "🎬 <b>Видео</b> — максимальное качество\n"
-        "🎵 <b>Аудио</b> — только звук",
-        reply_markup=keyboard,
-        parse_mode="HTML"
+    # Ставим в очередь (на фронте — в общую, её разбирают воркеры)
+    try:
+        if ROLE == "front":
+            await submit_remote(job)
+        else:
+            await scheduler.submit(job)
+    except QueueFull as e:
+        metrics.inc("bot_errors_total", kind="queue_full")
+        log("queue_full", job)
+        minutes = max(1, round(e.eta / 60))
+        # Снимаем регистрацию; успевшие присоединиться получают тот же отказ
+        await release_inflight(job)
+        await reject_job(
+            job,
+            f"🚦 Сейчас слишком много запросов\n\n"
+            f"Попробуй через ~{minutes} мин"
+        )
+        return
+    log("job_queued", job, position=job.position + 1)
+    await job_status(job, queue_text(job))
+
+class DownloadFailed(Exception):
+    """Скачивание не удалось. kind — класс ошибки для метрик, text — сообщение пользователю"""
+
+    def __init__(self, kind, text, detail=None):
+        super().__init__(text)
+        self.kind = kind
+        self.text = text
+        self.detail = detail
+
+# (признаки в stderr yt-dlp, класс ошибки, сообщение пользователю)
+DOWNLOAD_ERRORS = [
+    # Instagram: "rate-limit reached or login required" — это лимит, а не приватность
+    (("http error 429", "too many requests", "rate-limit", "rate limit"), "rate_limited",
+     "❌ Платформа ограничивает запросы, попробуй через несколько минут"),
+    (("http error 403", "forbidden"), "blocked", "❌ Платформа отклонила запрос, попробуй позже"),
+    (("private", "login"), "private", "❌ Видео приватное или требует авторизации"),
+    (("unavailable", "not available"), "unavailable", "❌ Видео недоступно или удалено"),
+    (("no video formats",), "no_formats", "❌ Не найдено видео для скачивания"),
+]
+# Ошибки, которые зависят от выхода (IP): повторяем через другой
+EGRESS_ERRORS = ("rate_limited", "blocked")
+
+def download_error(stderr):
+    """DownloadFailed по выводу yt-dlp"""
+    error = stderr.decode('utf-8', errors='ignore')
+    for markers, kind, text in DOWNLOAD_ERRORS:
+        if any(marker in error.lower() for marker in markers):
+            return DownloadFailed(kind, text, error[-500:])
+    return DownloadFailed(
+        "download", "❌ Не удалось скачать видео\n\nПроверь ссылку и попробуй снова", error[-500:]
     )
 
-# =========================
-# ОБРАБОТКА ВЫБОРА КАЧЕСТВА
-# =========================
-@dp.callback_query_handler(lambda c: c.data.startswith('quality_'))
-async def process_quality(callback: CallbackQuery):
-    """Обработка выбора качества"""
-    # Отвечаем на callback
-    await callback.answer()
+async def download(job, allow_stream=True):
+    """Скачивает задание: метаданные, резерв места, yt-dlp (поток, пул или CLI).
+    При 429/403 повторяет через другой выход (EGRESS_RETRIES попыток).
+    Возвращает (путь к файлу, None) или (None, (сервис, ссылка, байт)),
+    если файл ушёл в облако потоком. DownloadFailed — при ошибке"""
+    url = job.url
+    quality = job.quality
+    profile = job.profile
+    platform = profile.name.split("-")[0]
     
-    user_id = callback.from_user.id
-    quality = callback.data.replace('quality_', '')
+    # Определяем параметры скачивания
+    prefix = job_prefix(job.job_id)
+    template = f"{prefix}_%(id)s.%(ext)s"
+    info_path = f"{prefix}.info.json"
+    options = ytdlp_options(url, quality, profile)
     
-    print(f"\n=== ОБРАБОТКА КАЧЕСТВА ===")
-    print(f"User ID: {user_id}")
-    print(f"Quality: {quality}")
-    
-    # Проверяем блокировку
-    if user_locks.get(user_id):
-        await callback.answer("⏳ Подожди, предыдущее скачивание ещё идёт!", show_alert=True)
-        return
+    # Метаданные обычно уже получены при отправке ссылки — не извлекаем повторно
+    info = await get_info(url, timeout=INFO_TIMEOUT)
+    if info:
+        job.expected_bytes = expected_size(info, quality)
     
-    # Блокируем пользователя
-    user_locks[user_id] = True
+    # Скачиваем: без слияния форматов — потоком (большие файлы сразу уходят в облако),
+    # иначе — в файл через CLI или пул воркеров
+    merge = needs_merge(info, quality, options)
+    streaming = allow_stream and STREAM_UPLOADS and not merge
+    if quality == "audio" and not audio_only_formats(info):
+        streaming = False  # из видео сначала извлекаем звук — в облако уйдёт уже он
     
+    # Резервируем место под файлы; если бюджет исчерпан — ждём освобождения
     try:
-        # Получаем URL
-        url = user_urls.get(user_id)
+        await disk.reserve(
+            job.job_id, disk_estimate(job, merge, streaming), timeout=DISK_WAIT_TIMEOUT,
+            on_wait=lambda: job_status(job, "💾 Жду свободного места на сервере...")
+        )
+    except DiskFull as e:
+        raise DownloadFailed("disk_full", "❌ Сейчас не хватает места на сервере, попробуй позже", e)
+    
+    await in_thread(make_job_dir, job.job_id)
+    tried = []
+    attempt = stalls = 0
+    # Ссылки на форматы в метаданных бывают привязаны к IP — тот же выход, если можно
+    prefer = info and info.get("_egress")
+    while True:
+        egress = pick_egress(platform, prefer=prefer, exclude=tried)
+        attempt_options = {**options, **egress.options()}
+        attempt_info = info if info and info.get("_egress") == egress.name else None
+        source = [url]
+        if attempt_info:
+            await in_thread(write_json, info_path, attempt_info)
+            source = ["--load-info-json", info_path]
+        cmd = [
+            "yt-dlp", "--newline", "--progress-template", PROGRESS_TEMPLATE,
+            *ytdlp_args(attempt_options)
+        ]
+        file_path = None
+        uploaded = None
         
-        if not url:
-            await callback.message.edit_text(
-                "❌ Ссылка потерялась. Отправь её заново.\n\n"
-                "Нажми /start"
+        try:
+            await platform_turn(profile, egress)
+            attempt_streaming = streaming
+            if attempt_streaming:
+                try:
+                    returncode, stderr, file_path, uploaded = await stream_download(job, cmd, source)
+                except StreamUploadError as e:
+                    job_error(job, "stream_upload", e)
+                    await remove_job_files(job.job_id)
+                    attempt_streaming = False
+                    await in_thread(make_job_dir, job.job_id)
+                    if attempt_info:
+                        await in_thread(write_json, info_path, attempt_info)
+            
+            if not attempt_streaming:
+                if engine_pool:
+                    log("download_start", job, engine="pool", format=options["format"],
+                        egress=egress.name)
+                    returncode, stderr, file_path = await run_engine(
+                        job, {**attempt_options, "outtmpl": template}, info=attempt_info
+                    )
+                else:
+                    cmd.extend([
+                        "--print-to-file", MEDIA_TEMPLATE, f"{prefix}.media.json",
+                        "-o", template, *source
+                    ])
+                    log("download_start", job, engine="cli", cmd=loggable_cmd(cmd), egress=egress.name)
+                    returncode, stderr = await run_ytdlp(job, cmd)
+        except asyncio.TimeoutError:
+            raise DownloadFailed(
+                "timeout", f"❌ Таймаут скачивания ({download_budget(job) // 60:.0f} мин)"
             )
-            # Очищаем всё состояние только при отсутствии URL
-            if user_id in user_locks:
-                del user_locks[user_id]
-            return
-        
-        print(f"URL: {url}")
-        
-        # Обновляем сообщение
-        await callback.message.edit_text("⏳ Скачиваю...")
-        
-        # Определяем параметры скачивания
-        template = f"{DOWNLOAD_DIR}/{user_id}_%(id)s.%(ext)s"
-        is_instagram = "instagram.com" in url.lower() or "insta" in url.lower()
-        is_shorts = "shorts" in url.lower() or "youtu.be" in url.lower()
-        
-        # Формат для yt-dlp
-        if quality == "audio":
-            format_str = "bestaudio/best"
-            merge_format = None
-        else:  # best
-            if is_instagram:
-                format_str = "best"
-            elif is_shorts:
-                format_str = "best"
-            else:
-                format_str = "bestvideo[ext=mp4]+bestaudio[ext=m4a]/bestvideo+bestaudio/best"
-            merge_format = "mp4"
-        
-        # Формируем команду
-        cmd = ["yt-dlp", "--no-playlist"]
-        
-        if is_instagram:
-            cmd.extend([
-                "--user-agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-            ])
-        
-        cmd.extend(["-f", format_str])
+        except DownloadStalled as e:
+            # Недокачанные .part остаются: yt-dlp продолжит их (--continue) через тот же выход
+            stalls += 1
+            log("download_stalled", job, egress=egress.name, stalls=stalls,
+                bytes=job.downloaded_bytes, detail=str(e))
+            if stalls > STALL_RETRIES:
+                raise DownloadFailed("stalled", "❌ Скачивание зависло, попробуй позже", e)
+            prefer = egress.name
+            job.downloaded_bytes, job.part = 0, 1
+            await retry_delay(stalls - 1)
+            continue
         
-        if merge_format:
-            cmd.extend(["--merge-output-format", merge_format])
+        if returncode == 0:
+            egress.succeeded(platform)
+            break
         
-        cmd.extend(["-o", template, url])
+        # Проверяем результат: лимит или бан выхода — пробуем другой
+        error = download_error(stderr)
+        if error.kind not in EGRESS_ERRORS:
+            raise error
+        egress.limited(platform)
+        attempt += 1
+        if attempt == EGRESS_RETRIES:
+            raise error
+        tried.append(egress.name)
+        prefer = None
+        log("egress_retry", job, egress=egress.name, kind=error.kind, attempt=attempt)
+        await in_thread(remove_job_parts, job.job_id)  # недокачанные части
+        await retry_delay(attempt - 1)
+    
+    if uploaded:
+        observe_download_rate(job, uploaded[2])
+        return None, uploaded
+    
+    # Ищем скачанный файл
+    if not file_path:
+        files = await in_thread(job_files, job.job_id)
+        if not files:
+            raise DownloadFailed("not_found", "❌ Файл не найден после скачивания")
+        file_path = files[0]
+    job.media = job.media or await in_thread(load_media, f"{prefix}.media.json")
+    observe_download_rate(job, await in_thread(os.path.getsize, file_path))
+    return file_path, None
+
+async def file_media(job, file_path):
+    """Параметры потоков — из метаданных yt-dlp; ffprobe только если их нет"""
+    media = job.media or {}
+    if job.quality != "audio" and not media.get("vcodec"):
+        media = {**media, **await probe_media(job, file_path)}
+    return media
+
+async def run_job(job: Job):
+    """Выполнение задания воркером: скачивание и отправка"""
+    user_id = job.user_id
+    url = job.url
+    quality = job.quality
+    
+    try:
+        if job.items:
+            await run_batch(job)
+            return
         
-        print(f"Команда: {' '.join(cmd)}")
+        # Обложка и теги готовятся параллельно со скачиванием
+        enrichment = await start_enrichment(job)
         
-        # Скачиваем
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
+        # Обновляем сообщение
+        await job_status(job, "⏳ Скачиваю...")
         
         try:
-            _, stderr = await asyncio.wait_for(process.communicate(), timeout=600)
-        except asyncio.TimeoutError:
-            process.kill()
-            await callback.message.edit_text("❌ Таймаут скачивания (10 минут)")
-            return
-        
-        # Проверяем результат
-        if process.returncode != 0:
-            error = stderr.decode('utf-8', errors='ignore')
-            print(f"❌ Ошибка yt-dlp: {error[:500]}")
-            
-            if "private" in error.lower() or "login" in error.lower():
-                await callback.message.edit_text("❌ Видео приватное или требует авторизации")
-            elif "unavailable" in error.lower() or "not available" in error.lower():
-                await callback.message.edit_text("❌ Видео недоступно или удалено")
-            elif "no video formats" in error.lower():
-                await callback.message.edit_text("❌ Не найдено видео для скачивания")
-            else:
-                await callback.message.edit_text(
-                    "❌ Не удалось скачать видео\n\n"
-                    "Проверь ссылку и попробуй снова"
-                )
+            file_path, uploaded = await download(job)
+        except DownloadFailed as e:
+            job_error(job, e.kind, e.detail)
+            await job_status(job, e.text)
             return
         
-        # Ищем скачанный файл
-        files = glob.glob(f"{DOWNLOAD_DIR}/{user_id}_*")
-        if not files:
-            await callback.message.edit_text("❌ Файл не найден после скачивания")
+        # Файл уже загружен в облако потоком
+        if uploaded:
+            service, link, size_bytes = uploaded
+            size_mb = size_bytes / (1024 * 1024)
+            log("stream_uploaded", job, service=service, link=link, bytes=size_bytes)
+            await record_result(job, "link", link=link, size_mb=size_mb)
+            await job_status(
+                job,
+                f"✅ <b>Загружено в {service}!</b>\n\n"
+                f"📦 Размер: {size_mb:.1f} MB\n"
+                f"🔗 Ссылка:\n<code>{link}</code>\n\n"
+                f"💡 Нажми на ссылку чтобы скопировать",
+                parse_mode="HTML"
+            )
             return
         
-        file_path = files[0]
-        size_mb = os.path.getsize(file_path) / (1024 * 1024)
-        
-        print(f"✅ Файл скачан: {file_path} ({size_mb:.1f} MB)")
+        size_bytes = await in_thread(os.path.getsize, file_path)
+        log("downloaded", job, path=file_path, bytes=size_bytes)
         
-        # Проверяем наличие видеопотока
-        has_video = False
-        if quality != "audio":
-            try:
-                probe = await asyncio.create_subprocess_exec(
-                    "ffprobe", "-v", "error",
-                    "-select_streams", "v:0",
-                    "-show_entries", "stream=codec_type",
-                    "-of", "csv=p=0",
-                    file_path,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                stdout, _ = await probe.communicate()
-                has_video = b"video" in stdout
-                print(f"Видеопоток: {has_video}")
-            except Exception as e:
-                print(f"⚠️ Не удалось проверить видеопоток: {e}")
-                has_video = True  # По умолчанию считаем что есть
+        media = await file_media(job, file_path)
+        enrichment = await enrich_from_file(job, enrichment, file_path, media)
+        file_path, media = await postprocess(job, file_path, media)
+        size_mb = await in_thread(os.path.getsize, file_path) / (1024 * 1024)
+        # Неизвестный кодек (ffprobe недоступен) — считаем, что видео есть
+        has_video = media.get("vcodec") != "none"
+        label = f"{media['height']}p" if media.get("height") else "Лучшее качество"
         
         # Если запросили видео но есть только аудио
-        if quality == "best" and not has_video:
-            await callback.message.edit_text(
+        if quality != "audio" and not has_video and size_mb <= TELEGRAM_VIDEO_LIMIT:
+            await job_status(
+                job,
                 f"⚠️ Видео недоступно, скачалось только аудио\n"
                 f"📤 Отправляю аудио ({size_mb:.1f} MB)..."
             )
             
-            with open(file_path, "rb") as audio:
-                await callback.message.answer_audio(
-                    audio,
-                    caption=f"🎵 Аудио | {size_mb:.1f} MB"
-                )
+            attributes = {**audio_attributes(media), **await enrichment_attributes(enrichment, "audio")}
+            async with scheduler.stage(job, "upload"):
+                async with upload_source(file_path) as audio:
+                    sent = await bot.send_audio(
+                        job.chat_id,
+                        audio,
+                        caption=f"🎵 Аудио | {size_mb:.1f} MB",
+                        **attributes
+                    )
+            await record_result(job, "audio", file_id=sent.audio.file_id, size_mb=size_mb)
             
-            try:
-                await callback.message.delete()
-            except:
-                pass
+            await delete_status(job)
             return
         
         # Отправляем аудио
-        if quality == "audio":
-            await callback.message.edit_text(f"📤 Отправляю аудио ({size_mb:.1f} MB)...")
+        if quality == "audio" and size_mb <= TELEGRAM_VIDEO_LIMIT:
+            await job_status(job, f"📤 Отправляю аудио ({size_mb:.1f} MB)...")
             
-            with open(file_path, "rb") as audio:
-                await callback.message.answer_audio(
-                    audio,
-                    caption=f"🎵 Аудио | {size_mb:.1f} MB"
-                )
+            attributes = {**audio_attributes(media), **await enrichment_attributes(enrichment, "audio")}
+            async with scheduler.stage(job, "upload"):
+                async with upload_source(file_path) as audio:
+                    sent = await bot.send_audio(
+                        job.chat_id,
+                        audio,
+                        caption=f"🎵 Аудио | {size_mb:.1f} MB",
+                        **attributes
+                    )
+            await record_result(job, "audio", file_id=sent.audio.file_id, size_mb=size_mb)
             
-            try:
-                await callback.message.delete()
-            except:
-                pass
+            await delete_status(job)
         
-        # Отправляем видео (до 2 GB)
+        # Отправляем видео (до лимита Bot API)
         elif size_mb <= TELEGRAM_VIDEO_LIMIT:
-            await callback.message.edit_text(f"📤 Отправляю видео ({size_mb:.1f} MB)...")
+            await job_status(job, f"📤 Отправляю видео ({size_mb:.1f} MB)...")
             
-            with open(file_path, "rb") as video:
-                await callback.message.answer_video(
-                    video,
-                    caption=f"🎬 Лучшее качество | {size_mb:.1f} MB",
-                    supports_streaming=True
-                )
+            attributes = {**video_attributes(media), **await enrichment_attributes(enrichment, "video")}
+            async with scheduler.stage(job, "upload"):
+                async with upload_source(file_path) as video:
+                    sent = await bot.send_video(
+                        job.chat_id,
+                        video,
+                        caption=f"🎬 {label} | {size_mb:.1f} MB",
+                        supports_streaming=True,
+                        **attributes
+                    )
+            # Telegram может прислать документ вместо видео (неизвестный кодек)
+            if sent.video:
+                await record_result(job, "video", file_id=sent.video.file_id, size_mb=size_mb)
+            elif sent.document:
+                await record_result(job, "document", file_id=sent.document.file_id, size_mb=size_mb)
             
-            try:
-                await callback.message.delete()
-            except:
-                pass
+            await delete_status(job)
         
-        # Загружаем на облако (больше 2 GB)
-        else:
-            await callback.message.edit_text(
-                f"⚠️ Файл слишком большой: {size_mb:.1f} MB\n"
-                f"☁️ Загружаю на GoFile..."
-            )
+        # Загружаем на облако (больше лимита)
+        elif ranked_backends():
+            async def on_start(backend, hedged):
+                if hedged:
+                    note = f"☁️ Загрузка идёт медленно — параллельно загружаю в {backend.name}..."
+                else:
+                    note = f"☁️ Загружаю в {backend.name}..."
+                await job_status(job, f"⚠️ Файл слишком большой: {size_mb:.1f} MB\n{note}")
             
             try:
-                link = await upload_to_gofile(file_path)
+                async with scheduler.stage(job, "upload"):
+                    service, link = await race_upload(file_path, on_start)
+                await record_result(job, "link", link=link, size_mb=size_mb)
                 
-                await callback.message.edit_text(
-                    f"✅ <b>Загружено на GoFile!</b>\n\n"
+                await job_status(
+                    job,
+                    f"✅ <b>Загружено в {service}!</b>\n\n"
                     f"📦 Размер: {size_mb:.1f} MB\n"
                     f"🔗 Ссылка:\n<code>{link}</code>\n\n"
                     f"💡 Нажми на ссылку чтобы скопировать",
                     parse_mode="HTML"
                 )
             
-            except Exception as gofile_error:
-                print(f"❌ GoFile ошибка: {gofile_error}")
-                
-                # Пробуем Google Drive
-                if drive:
-                    await callback.message.edit_text(
-                        f"⚠️ GoFile недоступен\n"
-                        f"☁️ Загружаю в Google Drive..."
-                    )
-                    
-                    try:
-                        link = await upload_to_drive(file_path)
-                        await callback.message.edit_text(
-                            f"✅ <b>Загружено в Google Drive!</b>\n\n"
-                            f"📦 Размер: {size_mb:.1f} MB\n"
-                            f"🔗 <code>{link}</code>",
-                            parse_mode="HTML"
-                        )
-                    except Exception as drive_error:
-                        print(f"❌ Google Drive ошибка: {drive_error}")
-                        await callback.message.edit_text(
-                            f"❌ Не удалось загрузить файл\n\n"
-                            f"Размер: {size_mb:.1f} MB (слишком большой)\n"
-                            f"Попробуй скачать напрямую: {url}"
-                        )
-                else:
-                    await callback.message.edit_text(
-                        f"❌ Файл слишком большой: {size_mb:.1f} MB\n"
-                        f"Лимит Telegram: {TELEGRAM_VIDEO_LIMIT} MB\n\n"
-                        f"Скачай напрямую: {url}"
-                    )
+            except Exception as upload_error:
+                job_error(job, "upload", upload_error)
+                await job_status(
+                    job,
+                    f"❌ Не удалось загрузить файл\n\n"
+                    f"Размер: {size_mb:.1f} MB (слишком большой)\n"
+                    f"Попробуй скачать напрямую: {url}"
+                )
+        
+        else:
+            job_error(job, "too_large")
+            await job_status(
+                job,
+                f"❌ Файл слишком большой: {size_mb:.1f} MB\n"
+                f"Лимит Telegram: {TELEGRAM_VIDEO_LIMIT} MB\n\n"
+                f"Скачай напрямую: {url}"
+            )
+    
+    except asyncio.CancelledError:
+        if job.interrupted:
+            # Остановка бота: файлы и блокировки остаются до продолжения
+            log("job_interrupted", job, stage=job.stage)
+            await job_status(job, "🔄 Бот перезапускается — продолжу скачивание сразу после запуска")
+            raise
+        log("job_cancelled", job)
+        # Ожидающие тот же файл не должны пострадать — передаём им задание
+        await promote_followers(job)
+        await job_status(job, "🛑 Скачивание отменено")
+        raise
     
     except Exception as e:
-        print(f"❌ Критическая ошибка: {e}")
-        import traceback
+        job_error(job, "critical", e)
         traceback.print_exc()
         
         try:
-            await callback.message.edit_text(
+            await bot.edit_message_text(
                 f"❌ Произошла ошибка\n\n"
-                f"Попробуй позже или отправь другую ссылку"
+                f"Попробуй позже или отправь другую ссылку",
+                chat_id=job.chat_id,
+                message_id=job.message_id
             )
         except:
-            await callback.message.answer("❌ Произошла критическая ошибка")
+            await bot.send_message(job.chat_id, "❌ Произошла критическая ошибка")
     
     finally:
-        # Очистка только файлов и блокировки
-        print("🧹 Очистка файлов...")
-        await cleanup_user_files(user_id)
-        # Снимаем блокировку
-        if user_id in user_locks:
-            del user_locks[user_id]
+        if not job.interrupted:
+            # Раздаём результат присоединившимся пользователям
+            await release_inflight(job)
+            await deliver_followers(job)
+            # Очистка только файлов и блокировки
+            await release_files(job.job_id, user_id)
+            await disk.release(job.job_id)
+            # Снимаем блокировку
+            await user_locks.delete(user_id)
         # URL НЕ удаляем - пусть остаётся для повторных попыток
-        print("✅ Очистка завершена")
+
+# =========================
+# ПАКЕТЫ
+# =========================
+BATCH_SUMMARY_LINES = 20  # строк со ссылками и ошибками в итоговом сообщении
+
+async def run_batch(job: Job):
+    """Пакет: элементы скачиваются параллельно (не больше BATCH_PARALLEL),
+    готовые отправляются альбомами по MEDIA_GROUP_SIZE, в конце — сводка.
+    Элементы — обычные задания без статусного сообщения, с кэшем по каждому"""
+    total = len(job.items)
+    items = [
+        Job(user_id=job.user_id, chat_id=job.chat_id, message_id=None, url=url, quality=job.quality,
+            platform=(platform_of(url) or GENERIC_PLATFORM).name)
+        for url in job.items
+    ]
+    slots = asyncio.Semaphore(BATCH_PARALLEL)
+    progress = {"done": 0, "sent": 0}
+    links, failed = [], []
+    
+    async def prepare(item):
+        """Элемент альбома: file_id из кэша или скачанный файл.
+        None — элемент не попадает в альбом (ссылка на облако или ошибка)"""
+        try:
+            cached = await in_thread(result_cache.get, canonical_media_key(item.url), item.quality)
+            if cached and cached["kind"] == "link":
+                links.append(cached["link"])
+                return None
+            if cached:
+                log("cache_hit", item, batch=job.job_id)
+                return {"item": item, "kind": cached["kind"], "file_id": cached["file_id"],
+                        "size_mb": cached["size_mb"] or 0, "media": {}}
+            
+            hold_files(item.job_id, item.user_id)
+            enrichment = await start_enrichment(item)
+            async with slots:
+                file_path, _ = await download(item, allow_stream=False)
+            size_bytes = await in_thread(os.path.getsize, file_path)
+            size_mb = size_bytes / (1024 * 1024)
+            log("downloaded", item, path=file_path, bytes=size_bytes, batch=job.job_id)
+            media = await file_media(item, file_path)
+            enrichment = await enrich_from_file(item, enrichment, file_path, media)
+            file_path, media = await postprocess(item, file_path, media)
+            size_mb = await in_thread(os.path.getsize, file_path) / (1024 * 1024)
+            
+            if size_mb > TELEGRAM_VIDEO_LIMIT:
+                if not ranked_backends():
+                    job_error(item, "too_large")
+                    failed.append((item.url, f"слишком большой ({size_mb:.0f} MB)"))
+                    return None
+                async with scheduler.stage(item, "upload"):
+                    _, link = await race_upload(file_path)
+                await record_result(item, "link", link=link, size_mb=size_mb)
+                links.append(link)
+                return None
+            
+            kind = "audio" if item.quality == "audio" or media.get("vcodec") == "none" else "video"
+            return {"item": item, "kind": kind, "path": file_path, "size_mb": size_mb, "media": media,
+                    "enrichment": enrichment}
+        
+        except DownloadFailed as e:
+            job_error(item, e.kind, e.detail)
+            failed.append((item.url, e.text.removeprefix("❌ ").split("\n")[0]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job_error(item, "critical", e)
+            failed.append((item.url, "ошибка"))
+        finally:
+            progress["done"] += 1
+            offer_status(job, f"📚 Скачиваю: готово {progress['done']} из {total}")
+    
+    def caption(entry):
+        title = entry["media"].get("title")
+        icon = "🎵" if entry["kind"] == "audio" else "🎬"
+        name = html.escape(title[:200]) if title else ("Аудио" if entry["kind"] == "audio" else "Видео")
+        return f"{icon} {name} | {entry['size_mb']:.1f} MB"
+    
+    async def deliver(group):
+        """Отправляет готовые элементы одного вида: альбомом или одним сообщением"""
+        extras = await asyncio.gather(*(
+            enrichment_attributes(entry.get("enrichment"), entry["kind"]) for entry in group
+        ))
+        attributes = [
+            {**(audio_attributes if entry["kind"] == "audio" else video_attributes)(entry["media"]), **extra}
+            for entry, extra in zip(group, extras)
+        ]
+        try:
+            async with scheduler.stage(job, "upload"):
+                async with AsyncExitStack() as stack:
+                    sources = [
+                        entry.get("file_id") or await stack.enter_async_context(upload_source(entry["path"]))
+                        for entry in group
+                    ]
+                    if len(group) == 1:
+                        entry, source = group[0], sources[0]
+                        if entry["kind"] == "audio":
+                            sent = [await bot.send_audio(
+                                job.chat_id, source, caption=caption(entry), parse_mode="HTML",
+                                **attributes[0]
+                            )]
+                        else:
+                            sent = [await bot.send_video(
+                                job.chat_id, source, caption=caption(entry), parse_mode="HTML",
+                                supports_streaming=True, **attributes[0]
+                            )]
+                    else:
+                        album = types.MediaGroup()
+                        for entry, source, extra in zip(group, sources, attributes):
+                            if entry["kind"] == "audio":
+                                album.attach_audio(
+                                    source, caption=caption(entry), parse_mode="HTML", **extra
+                                )
+                            else:
+                                album.attach_video(
+                                    source, caption=caption(entry), parse_mode="HTML",
+                                    supports_streaming=True, **extra
+                                )
+                        sent = await bot.send_media_group(job.chat_id, album)
+        except Exception as e:
+            job_error(job, "upload", e)
+            failed.extend((entry["item"].url, "не удалось отправить") for entry in group)
+            return
+        
+        progress["sent"] += len(group)
+        # file_id новых файлов — в кэш, следующий запрос этих видео пройдёт без скачивания
+        for entry, message in zip(group, sent):
+            if entry.get("file_id"):
+                continue
+            if message.video:
+                await record_result(entry["item"], "video", file_id=message.video.file_id, size_mb=entry["size_mb"])
+            elif message.audio:
+                await record_result(entry["item"], "audio", file_id=message.audio.file_id, size_mb=entry["size_mb"])
+            elif message.document:
+                await record_result(entry["item"], "document", file_id=message.document.file_id, size_mb=entry["size_mb"])
+    
+    await job_status(job, f"📚 Скачиваю пакет: {total} шт.")
+    for start in range(0, total, MEDIA_GROUP_SIZE):
+        chunk = items[start:start + MEDIA_GROUP_SIZE]
+        tasks = [asyncio.create_task(prepare(item)) for item in chunk]
+        try:
+            ready = [entry for entry in await asyncio.gather(*tasks) if entry]
+            # Альбом не смешивает аудио с видео
+            for kind in ("video", "audio"):
+                group = [entry for entry in ready if entry["kind"] == kind]
+                if group:
+                    await deliver(group)
+        finally:
+            # Отмена: дожидаемся остановки скачиваний, прежде чем удалять их файлы
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks)
+            for item in chunk:
+                await release_files(item.job_id, item.user_id)
+                await disk.release(item.job_id)
+    
+    text = f"📚 <b>Готово: отправлено {progress['sent']} из {total}</b>"
+    if links:
+        text += "\n\n☁️ Большие файлы:\n" + "\n".join(
+            f"• <code>{link}</code>" for link in links[:BATCH_SUMMARY_LINES]
+        )
+    if failed:
+        text += "\n\n❌ Не удалось:\n" + "\n".join(
+            f"• {html.escape(url)} — {html.escape(reason)}" for url, reason in failed[:BATCH_SUMMARY_LINES]
+        )
+        if len(failed) > BATCH_SUMMARY_LINES:
+            text += f"\n…и ещё {len(failed) - BATCH_SUMMARY_LINES}"
+    log("batch_finished", job, items=total, sent=progress["sent"], links=len(links), failed=len(failed))
+    # Сводка — новым сообщением, под отправленными альбомами
+    await delete_status(job)
+    await bot.send_message(job.chat_id, text, parse_mode="HTML", disable_web_page_preview=True)
+    if progress["sent"] or links:
+        job.result = {"kind": "batch", "file_id": None, "link": None, "size_mb": 0.0}
+
+# =========================
+# ФРОНТ И ВОРКЕРЫ
+# =========================
+def job_record(job):
+    """Задание для общей очереди (то, что нужно воркеру для запуска)"""
+    return {
+        "job_id": job.job_id, "user_id": job.user_id, "chat_id": job.chat_id,
+        "message_id": job.message_id, "url": job.url, "quality": job.quality,
+        "created_at": job.created_at, "items": job.items, "platform": job.platform,
+    }
+
+def job_from_record(record):
+    return Job(**record)
+
+async def submit_remote(job):
+    """Фронт: ставит задание в общую очередь. QueueFull — если мест нет"""
+    queued = await state.size("jobs")
+    if queued >= MAX_QUEUE:
+        raise QueueFull(scheduler.eta(queued))
+    job.position = queued
+    await state.push("jobs", job_record(job))
+
+async def attach_remote(job):
+    """Фронт: присоединяет задание к ведущему на воркере. Возвращает id ведущего или None.
+    Запись кладётся, только пока ключ ведущего на месте: воркер сначала удаляет ключ,
+    потом забирает присоединившихся (release_inflight), поэтому запись не потеряется"""
+    key = inflight_store_key(job)
+    leader_id = await state.get(key)
+    if leader_id and await state.push_if(key, leader_id, f"followers:{leader_id}", job_record(job)):
+        return leader_id
+    return None
+
+async def claim_followers(job):
+    """Воркер: забирает присоединившихся к заданию через фронт"""
+    while (record := await state.pop(f"followers:{job.job_id}")) is not None:
+        attach_follower(job, job_from_record(record))
+
+async def cancelled_since(user_id, created_at):
+    """Пользователь отправил /cancel после создания задания"""
+    stamp = await state.get(f"cancel:{user_id}")
+    return stamp is not None and stamp >= created_at
+
+async def job_feed():
+    """Воркер: забирает задания из общей очереди, пока есть свободные воркеры"""
+    while True:
+        record = None
+        if scheduler.queued + len(scheduler.active) < scheduler.workers:
+            record = await state.pop("jobs")
+        if record is None:
+            await asyncio.sleep(WORKER_POLL_INTERVAL)
+            continue
+        
+        job = job_from_record(record)
+        inflight[inflight_key(job)] = job
+        hold_files(job.job_id, job.user_id)
+        if await cancelled_since(job.user_id, job.created_at):
+            log("job_cancelled", job)
+            await release_files(job.job_id, job.user_id)
+            await promote_followers(job)
+            continue
+        await scheduler.submit(job)
+        log("job_claimed", job)
+
+async def sync_remote_jobs():
+    """Воркер: подбирает присоединившихся и применяет /cancel, отправленные на фронт"""
+    while True:
+        await asyncio.sleep(1)
+        jobs = [*scheduler.active.values(), *(job for jobs in scheduler.pending.values() for job in jobs)]
+        for job in jobs:
+            await claim_followers(job)
+        for job in [*jobs, *(follower for job in jobs for follower in job.followers)]:
+            if job.task and job.task.cancelling():
+                continue  # уже отменяется
+            if await cancelled_since(job.user_id, job.created_at):
+                await cancel_user_jobs(job.user_id)
+
+async def run_worker():
+    """Процесс-воркер: апдейты не принимает, только выполняет задания из общей очереди"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    await on_startup(dp)
+    tasks = [asyncio.create_task(job_feed()), asyncio.create_task(sync_remote_jobs())]
+    print(f"✅ Воркер: общая очередь {STATE_STORE}")
+    await stop.wait()
+    for task in tasks:
+        task.cancel()
+    await on_shutdown(dp)
+
+# =========================
+# ЖУРНАЛ ЗАДАНИЙ
+# =========================
+class JobJournal:
+    """Журнал заданий в SQLite (WAL): состояние каждого задания переживает
+    перезапуск и падение процесса. Владелец — WORKER_ID; задания остановленного
+    или упавшего процесса продолжает другой (или он сам после запуска)"""
+
+    ACTIVE = ("queued", "running", "interrupted")
+
+    def __init__(self, path, owner):
+        self.owner = owner
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, owner TEXT, "
+            "state TEXT NOT NULL, record TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, updated_at)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS owners (owner TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+
+    def record(self, job, state, owned=True):
+        """Переход состояния. owned=False — задание может забрать любой процесс"""
+        record = {**job_record(job), "followers": [job_record(f) for f in job.followers]}
+        self.db.execute(
+            "INSERT INTO jobs VALUES (?, ?, ?, ?, ?) ON CONFLICT(job_id) DO UPDATE SET "
+            "owner = excluded.owner, state = excluded.state, record = excluded.record, "
+            "updated_at = excluded.updated_at",
+            (job.job_id, self.owner if owned else None, state, json.dumps(record), time.time())
+        )
+
+    def heartbeat(self):
+        """Отметка «процесс жив» и удаление старых завершённых записей"""
+        now = time.time()
+        self.db.execute(
+            "INSERT INTO owners VALUES (?, ?) ON CONFLICT(owner) DO UPDATE SET seen_at = excluded.seen_at",
+            (self.owner, now)
+        )
+        self.db.execute(
+            "DELETE FROM jobs WHERE state NOT IN (?, ?, ?) AND updated_at < ?",
+            (*self.ACTIVE, now - JOURNAL_KEEP)
+        )
+
+    def live_owners(self):
+        """Сколько процессов отмечались в последние JOURNAL_STALE s"""
+        return self.db.execute(
+            "SELECT COUNT(*) FROM owners WHERE seen_at >= ?", (time.time() - JOURNAL_STALE,)
+        ).fetchone()[0]
+
+    def claim(self, limit, own=False):
+        """Забирает до limit незавершённых заданий: ничьи (после плавной остановки),
+        тех, кто давно не отмечался (упал), и при own — свои (после перезапуска)"""
+        if limit <= 0:
+            return []
+        rows = self.db.execute(
+            "UPDATE jobs SET owner = ?, state = 'queued', updated_at = ? WHERE job_id IN ("
+            " SELECT job_id FROM jobs WHERE state IN (?, ?, ?) AND (owner IS NULL OR owner = ?"
+            " OR owner NOT IN (SELECT owner FROM owners WHERE seen_at >= ?))"
+            " ORDER BY updated_at LIMIT ?) RETURNING record",
+            (self.owner, time.time(), *self.ACTIVE, self.owner if own else None,
+             time.time() - JOURNAL_STALE, limit)
+        ).fetchall()
+        return [json.loads(record) for (record,) in rows]
+
+journal = JobJournal(JOURNAL_DB, WORKER_ID) if ROLE != "front" else None
+journal_task = None
+
+async def resume_jobs(own=False):
+    """Ставит в очередь незавершённые задания из журнала. Возвращает их число"""
+    records = await in_thread(journal.claim, MAX_QUEUE - scheduler.queued, own)
+    for record in records:
+        followers = record.pop("followers", None) or []
+        job = job_from_record(record)
+        job.followers = [job_from_record(follower) for follower in followers]
+        for user_id in {job.user_id, *(follower.user_id for follower in job.followers)}:
+            hold_files(job.job_id, user_id)
+            await user_locks.set(user_id, True)
+        if not job.items:
+            inflight[inflight_key(job)] = job
+            await state.set(inflight_store_key(job), job.job_id, ttl=LOCK_TTL)
+        await scheduler.submit(job)
+        log("job_resumed", job)
+        offer_status(job, "🔄 Продолжаю скачивание после перезапуска...")
+    return len(records)
+
+async def journal_loop():
+    """Пульс процесса; при свободных воркерах — подбирает задания упавших процессов"""
+    while True:
+        await in_thread(journal.heartbeat)
+        if scheduler.queued + len(scheduler.active) < scheduler.workers:
+            await resume_jobs()
+        await asyncio.sleep(JOURNAL_HEARTBEAT)
 
 # =========================
 # ОБРАБОТКА ОШИБОК
@@ -557,45 +4495,120 @@ async def process_quality(callback: CallbackQuery):
 async def errors_handler(update, exception):
     """Глобальный обработчик ошибок"""
     print(f"❌ Ошибка: {exception}")
-    import traceback
     traceback.print_exc()
     return True
 
 # =========================
 # ЗАПУСК
 # =========================
+def stop_polling():
+    raise SystemExit
+
 async def on_startup(dp):
     """Действия при запуске бота"""
-    print("🔧 Очистка webhook...")
-    await bot.delete_webhook(drop_pending_updates=True)
-    print("✅ Webhook очищен")
+    if ROLE != "worker":
+        if WEBHOOK_URL:
+            # Апдейты, пришедшие во время перезапуска, не теряем
+            await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, drop_pending_updates=False)
+            print(f"✅ Webhook: {WEBHOOK_URL}{WEBHOOK_PATH}")
+        else:
+            print("🔧 Очистка webhook...")
+            await bot.delete_webhook(drop_pending_updates=False)
+            # executor ловит SystemExit и вызывает on_shutdown; по умолчанию SIGTERM убивает сразу
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_polling)
+            print("✅ Webhook очищен")
+    if LOOP_LAG_THRESHOLD > 0:
+        loop_monitor.start()
+    status_updater.start()
+    if ROLE != "front":
+        # Незавершённые задания прошлого запуска — до GC диска, чтобы он не удалил .part
+        await in_thread(journal.heartbeat)
+        resumed = await resume_jobs(own=True)
+        if resumed:
+            print(f"🔄 Продолжаю {resumed} заданий после перезапуска")
+        # Один процесс — все файлы без владельца остались от прошлого запуска
+        await disk.start(0 if ROLE == "all" else DISK_FILE_MAX_AGE)
+        print(
+            f"✅ Диск: {disk.usage / 1024**3:.1f} GB занято, бюджет {disk.limit / 1024**3:.1f} GB"
+            + (f" (1/{disk.share_count} на воркер)" if disk.share_count > 1 else "")
+        )
+        if engine_pool:
+            start_engine_pump(asyncio.get_running_loop())
+        scheduler.start(run_job)
+        global journal_task
+        journal_task = asyncio.create_task(journal_loop())
+        print(f"✅ Планировщик: {JOB_WORKERS} воркеров, очередь до {MAX_QUEUE}")
+    if METRICS_PORT:
+        await start_metrics_server()
 
 async def on_shutdown(dp):
     """Действия при остановке бота"""
+    if ROLE != "front":
+        print(f"🧹 Завершение заданий (до {SHUTDOWN_GRACE} s)...")
+        if journal_task:
+            journal_task.cancel()
+        await scheduler.drain(SHUTDOWN_GRACE)
+    print("🧹 Остановка планировщика...")
+    await scheduler.stop()
+    await disk.stop()
+    await loop_monitor.stop()
+    if metrics_runner:
+        await metrics_runner.cleanup()
     print("🧹 Очистка сессий...")
+    if http_session:
+        await http_session.close()
     await bot.close()
     print("✅ Бот остановлен корректно")
 
-if __name__ == "__main__":
+def main():
+    """Запуск процесса в роли ROLE"""
     print("=" * 50)
     print("🤖 BOT STARTING")
     print("=" * 50)
     print(f"🎬 Лимит Telegram: {TELEGRAM_VIDEO_LIMIT} MB")
-    print(f"☁️ Google Drive: {'✅ Включен' if drive else '❌ Отключен'}")
+    print(f"📡 Bot API: {BOT_API_URL or 'api.telegram.org'}{' (local)' if BOT_API_LOCAL else ''}")
+    print(f"☁️ Google Drive: {'✅ Включен' if drive_info else '❌ Отключен'}")
     print(f"📁 Директория: {DOWNLOAD_DIR}")
+    print(f"⚙️ Движок yt-dlp: {YTDLP_ENGINE}")
+    print(f"🧩 Роль: {ROLE}, состояние: {STATE_STORE}")
+    print(f"⚡ Кэш: {CACHE_DB} (TTL {CACHE_TTL} s, до {CACHE_MAX_ENTRIES} записей)")
+    if LOOP_LAG_THRESHOLD > 0:
+        print(f"🩺 Монитор event loop: порог {LOOP_LAG_THRESHOLD * 1000:.0f} ms")
     print("=" * 50)
     
+    if YTDLP_ENGINE == "pool" and ROLE != "front":
+        start_engine()
+    
     try:
-        executor.start_polling(
-            dp, 
-            skip_updates=True,
-            on_startup=on_startup,
-            on_shutdown=on_shutdown
-        )
+        if ROLE == "worker":
+            asyncio.run(run_worker())
+        elif WEBHOOK_URL:
+            executor.start_webhook(
+                dispatcher=dp,
+                webhook_path=WEBHOOK_PATH,
+                skip_updates=False,
+                on_startup=on_startup,
+                on_shutdown=on_shutdown,
+                host=WEBAPP_HOST,
+                port=WEBAPP_PORT
+            )
+        else:
+            executor.start_polling(
+                dp, 
+                skip_updates=False,
+                on_startup=on_startup,
+                on_shutdown=on_shutdown
+            )
     except KeyboardInterrupt:
         print("\n🛑 Бот остановлен пользователем")
     except Exception as e:
         print(f"\n❌ Критическая ошибка: {e}")
     finally:
         executor_pool.shutdown(wait=True)
+        if engine_pool:
+            engine_progress.put(None)
+            engine_pool.shutdown(wait=False, cancel_futures=True)
         print("👋 Завершение работы")
+
+if __name__ == "__main__":
+    main()